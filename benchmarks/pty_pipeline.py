@@ -0,0 +1,195 @@
+#
+# Benchmark for the Linux pipeline: PyCmd (pty_control + bash) running in a
+# pseudo-terminal, driven by a script, compared against a bare bash
+#
+# Measured:
+#   * throughput: bytes/sec of a large command output passed to the terminal
+#   * prompt round-trip: time from Enter on a no-op command to the next prompt
+#   * keystroke echo: time from a key press to the key showing on the terminal
+#
+# The results are written as JSON, so that they can be compared between
+# releases. Everything runs in a throw-away HOME and needs no real terminal.
+#
+# Usage (Linux only):
+#       python benchmarks/pty_pipeline.py [-o results.json] [--megabytes N] [--samples N]
+#
+import os, sys, re, pty, time, json, fcntl, struct, termios, select, shutil, tempfile
+import argparse, platform, statistics
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+# The prompts are numbered, so that a new one can be told apart from a repaint
+# of the current one
+PYCMD_INIT = """
+import itertools
+_prompt_counter = itertools.count(1)
+appearance.prompt = lambda: 'BENCH%d> ' % next(_prompt_counter)
+"""
+BASH_PS1 = r'BENCH\#> '
+
+
+class Session:
+    """A program running in a pseudo-terminal"""
+
+    def __init__(self, argv, env, cwd, rows=50, columns=120):
+        (self.pid, self.fd) = pty.fork()
+        if self.pid == 0:
+            fcntl.ioctl(0, termios.TIOCSWINSZ, struct.pack('HHHH', rows, columns, 0, 0))
+            os.chdir(cwd)
+            os.execvpe(argv[0], argv, env)
+        self.tail = b''
+
+    def send(self, data):
+        os.write(self.fd, data)
+
+    def expect(self, regex, timeout=60, keep=64):
+        """
+        Read the output until it matches a (compiled, bytes) regex; return the
+        match. Only the last keep bytes are retained between reads, which
+        must be enough for the regex to match across two chunks.
+        """
+        data = self.tail
+        deadline = time.time() + timeout
+        while not (match := regex.search(data)):
+            if not select.select([self.fd], [], [], max(0, deadline - time.time()))[0]:
+                raise TimeoutError('Timed out waiting for %r' % regex.pattern)
+            data = data[-keep:] + os.read(self.fd, 65536)
+        self.tail = data[match.end():]
+        return match
+
+    def drain(self):
+        """Discard any pending output"""
+        self.tail = b''
+        while select.select([self.fd], [], [], 0)[0]:
+            os.read(self.fd, 65536)
+
+    def close(self):
+        try:
+            os.kill(self.pid, 9)
+            os.waitpid(self.pid, 0)
+        except OSError:
+            pass
+        os.close(self.fd)
+
+
+class Shell:
+    """Helper for running commands in a session and waiting for their prompts"""
+
+    prompt_regex = re.compile(rb'BENCH(\d+)> ')
+
+    def __init__(self, session):
+        self.session = session
+        self.prompt = 0
+        self.wait_prompt()
+
+        # PyCmd shows its first prompt before bash is done starting up; any
+        # keys pressed in the meantime would go directly to bash
+        time.sleep(1)
+
+    def wait_prompt(self):
+        """Wait for a new prompt (not just a repaint of the current one)"""
+        while (number := int(self.session.expect(self.prompt_regex).group(1))) <= self.prompt:
+            pass
+        self.prompt = number
+
+    def run(self, command):
+        """Run a command, return the time until the next prompt"""
+        start = time.perf_counter()
+        self.session.send(command + b'\r')
+        self.wait_prompt()
+        return time.perf_counter() - start
+
+
+def summary(samples):
+    """Summarize a list of durations, in milliseconds"""
+    samples = sorted(s * 1000 for s in samples)
+    return {'min': round(samples[0], 3),
+            'median': round(statistics.median(samples), 3),
+            'p90': round(samples[int(len(samples) * 0.9)], 3),
+            'max': round(samples[-1], 3),
+            'samples': len(samples)}
+
+
+keystroke_regex = re.compile(b'z')
+
+def measure(shell, big_file, size, num_samples):
+    results = {}
+
+    # Warm up (first command, caches etc.)
+    shell.run(b':')
+
+    elapsed = shell.run(b'cat ' + big_file.encode())
+    results['throughput_mb_per_s'] = round(size / elapsed / 1024 / 1024, 2)
+
+    results['prompt_round_trip_ms'] = summary([shell.run(b':') for i in range(num_samples)])
+
+    samples = []
+    for i in range(num_samples):
+        shell.session.drain()
+        start = time.perf_counter()
+        shell.session.send(b'z')
+        shell.session.expect(keystroke_regex)
+        samples.append(time.perf_counter() - start)
+        if i % 20 == 19:
+            # Keep the line short
+            shell.session.send(b'\x7f' * 20)
+            time.sleep(0.05)
+        else:
+            time.sleep(0.005)
+    results['keystroke_echo_ms'] = summary(samples)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark PyCmd vs. bash in a pseudo-terminal')
+    parser.add_argument('-o', '--output', help='write the results to this file (default: stdout)')
+    parser.add_argument('--megabytes', type=int, default=32, help='size of the output for the throughput test')
+    parser.add_argument('--samples', type=int, default=100, help='number of samples for the latency tests')
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    try:
+        home = os.path.join(tmp, 'home')
+        cwd = os.path.join(tmp, 'cwd')
+        os.makedirs(os.path.join(home, '.PyCmd'))
+        os.mkdir(cwd)
+        open(os.path.join(home, '.bashrc'), 'w').close()
+        with open(os.path.join(home, '.PyCmd', 'init.py'), 'w') as f:
+            f.write(PYCMD_INIT)
+
+        size = args.megabytes * 1024 * 1024
+        big_file = os.path.join(tmp, 'output.txt')
+        line = b'x' * 79 + b'\n'
+        with open(big_file, 'wb') as f:
+            f.write(line * (size // len(line)))
+        size = os.path.getsize(big_file)
+
+        env = dict(os.environ, HOME=home, TERM='xterm-256color', PYTHONPATH=os.path.join(ROOT, 'src'))
+        env.pop('PROMPT_COMMAND', None)
+        results = {'python': platform.python_version(),
+                   'system': platform.platform(),
+                   'output_bytes': size}
+
+        # The bare bash is the reference: this is what PyCmd adds on top of it
+        targets = [('bash', ['bash', '--norc', '--noprofile', '-c',
+                             "export PS1='%s'; exec bash --norc --noprofile -i" % BASH_PS1]),
+                   ('pycmd', [sys.executable, os.path.join(ROOT, 'PyCmd.py'), '-q'])]
+        for (name, argv) in targets:
+            session = Session(argv, env, cwd)
+            try:
+                results[name] = measure(Shell(session), big_file, size, args.samples)
+            finally:
+                session.close()
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#
+# Throughput benchmark for the relay of the shell output in pty_control.py
+#
+# A writer thread plays the shell: it floods a pseudo-terminal with lines of
+# output, then prints a MARKER-framed prompt. The relay under test reads the
+# other end until it detects the prompt. The current relay (read_shell) is
+# compared against the previous byte-at-a-time implementation, kept below as
+# a reference.
+#
+# Usage (Linux only):
+#       python benchmarks/pty_relay.py [megabytes]
+#
+import os, sys, time, threading, tty, select
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+from pycmd import pty_control
+from pycmd.pty_control import MARKER_BYTES
+
+
+def read_shell_bytewise(fd, state):
+    """The previous relay: one os.read() per byte, flush at newlines"""
+    poll = state.setdefault('poll', select.poll())
+    poll.register(fd, select.POLLIN)
+    output_acc = state.setdefault('output_acc', bytearray())
+    marker_acc = state.setdefault('marker_acc', bytearray())
+    while True:
+        ch = os.read(fd, 1)[0] if poll.poll(30) else 0
+        if ch == MARKER_BYTES[len(marker_acc)]:
+            marker_acc.append(ch)
+            if len(marker_acc) == len(MARKER_BYTES):
+                capture_buffer = bytearray()
+                while capture_buffer[-len(MARKER_BYTES):] != MARKER_BYTES:
+                    capture_buffer.append(os.read(fd, 1)[0])
+                state['done'] = True
+                output = bytes(output_acc)
+                output_acc.clear()
+                return output + b'\0'
+        else:
+            output_acc.extend(marker_acc)
+            output_acc.append(ch)
+            marker_acc.clear()
+            if ch == 10 or ch == 0:
+                output = bytes(output_acc)
+                output_acc.clear()
+                return output
+
+
+def read_shell_chunked(fd, state):
+    """The current relay"""
+    output = pty_control.read_shell(fd)
+    state['done'] = not pty_control.pass_through
+    return output
+
+
+def run(relay, size):
+    """Relay size bytes of output; return the elapsed time"""
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    line = b'x' * 79 + b'\n'
+    block = line * (65536 // len(line))
+
+    def shell():
+        written = 0
+        while written < size:
+            os.write(slave, block)
+            written += len(block)
+        os.write(slave, MARKER_BYTES + b'/tmp|0' + MARKER_BYTES)
+
+    pty_control.pass_through = True
+    pty_control.command_to_run = None
+    pty_control.marker_acc = b''
+    state = {'done': False}
+    writer = threading.Thread(target=shell)
+    start = time.perf_counter()
+    writer.start()
+    while not state['done']:
+        select.select([master], [], [])
+        relay(master, state)
+    elapsed = time.perf_counter() - start
+    writer.join()
+    os.close(master)
+    os.close(slave)
+    return elapsed
+
+
+def main():
+    size = int(sys.argv[1] if len(sys.argv) > 1 else 16) * 1024 * 1024
+
+    # The relayed output goes to stdout, keep it off the terminal
+    stdout = os.dup(1)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    try:
+        results = [(name, run(relay, size)) for (name, relay) in
+                   [('bytewise', read_shell_bytewise), ('chunked', read_shell_chunked)]]
+    finally:
+        os.dup2(stdout, 1)
+
+    # Importing pycmd replaced sys.stdout with the console writer, which wants
+    # a terminal; report on stderr instead
+    for (name, elapsed) in results:
+        print('%-10s %8.2f MB/s' % (name, size / elapsed / 1024 / 1024), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,7 +4,9 @@ sys.path.append(os.path.join(os.path.dirname(__file__), "src"))
 import unittest
 from tests import common_tests, completion_tests, console_tests, command_tests
 from tests import InputState_tests, Window_tests
-from tests import pycmd_public_tests
+from tests import pycmd_public_tests, CommandHistory_tests, HistoryFile_tests, DirCache_tests, PathIndex_tests
+from tests import CompletionEngine_tests, pty_control_tests, EnvSync_tests, LineRenderer_tests
+from tests import GitRepository_tests, SvnWorkingCopy_tests
 
 def suite():
     suite = unittest.TestSuite()
@@ -15,6 +17,16 @@ def suite():
     suite.addTest(InputState_tests.suite())
     suite.addTest(Window_tests.suite())
     suite.addTest(pycmd_public_tests.suite())
+    suite.addTest(CommandHistory_tests.suite())
+    suite.addTest(HistoryFile_tests.suite())
+    suite.addTest(DirCache_tests.suite())
+    suite.addTest(PathIndex_tests.suite())
+    suite.addTest(CompletionEngine_tests.suite())
+    suite.addTest(pty_control_tests.suite())
+    suite.addTest(EnvSync_tests.suite())
+    suite.addTest(LineRenderer_tests.suite())
+    suite.addTest(GitRepository_tests.suite())
+    suite.addTest(SvnWorkingCopy_tests.suite())
     return suite
 
 if __name__ == '__main__':
@@ -1,31 +1,111 @@
 import re
+from pycmd.common import fuzzy_score
 
 class CommandHistory:
     """
     Handle all things related to managing and navigating the command history
     """
     def __init__(self):
-        # The actual command list
-        self.list = []
+        # The actual commands, oldest first (a dict is used as an ordered set,
+        # so that lookups, additions and removals are O(1))
+        self._entries = {}
+
+        # The commands as a list, computed on demand (see the list property)
+        self._list = None
+
+        # Trigram index over the command list (built on demand, see _build_index)
+        self.index = None
 
         # The current search filter
         self.filter = ''
 
-        # A filtered list based on the current filter
+        # Lazily computed matches for the current filter (strongest first), and
+        # a stack of matches we have navigated back from (these come first)
+        self.matches = iter(())
         self.filtered_list = []
 
         # A trail of visited indices (while navigating)
         self.trail = []
 
+    @property
+    def list(self):
+        """The command list, oldest first"""
+        if self._list is None:
+            self._list = list(self._entries)
+        return self._list
+
+    @list.setter
+    def list(self, lines):
+        self._entries = dict.fromkeys(lines)
+        if len(self._entries) != len(lines):
+            # For duplicate lines, the last occurrence wins
+            self._entries = dict.fromkeys(reversed(dict.fromkeys(reversed(lines))))
+        self._list = None
+        self.index = None
+
+    def recent(self):
+        """Iterate over the commands, most recent first"""
+        return reversed(self._entries)
+
     def start(self, line):
         """
         Start history navigation
         """
         #print '\n\nStart\n\n'
         self.filter = line
+        self.filtered_list = []
+        self.matches = self._matches(line)
+
+        # We use the trail to navigate back in the same order
+        self.trail = [(self.filter, [(0, len(self.filter))])]
+
+    def _matches(self, line):
+        """
+        Generate the (line, spans) matches for the given filter, best first.
+
+        The patterns are tried in turn, from the strongest to the weakest; for
+        each of them the history is traversed starting with the most recent
+        line. Lines are only matched as the navigation asks for them, so the
+        first results are available without looking at the whole history.
+
+        The matches of the weakest patterns (substrings found anywhere) say
+        little about the relevance of a line, so these are ranked by
+        fuzzy_score() -- only once the stronger patterns are exhausted.
+        """
+        patterns, required, num_ordered = self._patterns(line)
+
+        # Only look at the lines that contain all the required substrings
+        candidates = self._candidates(required)
+
+        history = self.list
+        seen = set()
+        for (tier, pattern) in enumerate(patterns):
+            ranked = []
+            for i in range(len(history) - 1, -1, -1):
+                line = history[i]
+                if line in seen or (candidates is not None and line not in candidates):
+                    continue
+                matches = pattern.search(line)
+                if matches:
+                    seen.add(line)
+                    spans = [matches.span(g) for g in range(1, matches.lastindex + 1)]
+                    if tier < num_ordered:
+                        yield (line, spans)
+                    else:
+                        score = fuzzy_score(line, spans, (i + 1) / len(history))
+                        ranked.append((-score, len(ranked), line, spans))
+            ranked.sort()
+            for (_, _, line, spans) in ranked:
+                yield (line, spans)
 
-        # Create a list of regex patterns to use when navigating the history
-        # using a filter
+    def _patterns(self, line):
+        """
+        Compile the list of regex patterns to use when navigating the history
+        using a filter, from the strongest to the weakest. Also return a list of
+        substrings that must be present (ignoring case) in any matching line,
+        and the number of patterns whose matches are simply taken in the order
+        of the history (the remaining ones are ranked).
+        """
         # A. First use just the space as word separator; these are the most
         # useful matches (think acronyms 'g c m' for 'git checkout master' etc)
         words = [re.escape(w) for w in re.findall('[^\\s]+', line)] # Split the filter into words
@@ -40,7 +120,8 @@ class CommandHistory:
         ]
 
         # B. Then split based on other separator characters as well
-        words = [re.escape(w) for w in re.findall('[a-zA-Z0-9]+', line)] # Split the filter into words
+        plain_words = re.findall('[a-zA-Z0-9]+', line)
+        words = [re.escape(w) for w in plain_words] # Split the filter into words
         boundary = '[\\s\\.\\-\\\\_]+'   # Word boundary characters
         patterns += [
             # Prefixes match for each word in the command (strongest, these will be the
@@ -65,24 +146,51 @@ class CommandHistory:
             # simple (one-word) filters -- this saves a lot of computation effort
             # as these filters will yield a long list of matched lines!
             patterns = [patterns[4]]
+            required = [line]
+        else:
+            # Any of the patterns above implies a match for each of the words
+            required = plain_words
 
-        # Traverse the history and build the filtered list
-        self.filtered_list = []
-        for pattern in patterns:
-            #print '\n\n', pattern, '\n\n'
-            for line in reversed(self.list):
-                if line in [l for (l, p) in self.filtered_list]:
-                    # We already added this line, skip
-                    continue
-                # No need to re.compile() this, the re library automatically caches compiled
-                # versions of the recently used expressions
-                matches = re.search(pattern, line, re.IGNORECASE)
-                if matches:
-                    self.filtered_list.insert(0, (line, [matches.span(i) for i in range(1, matches.lastindex + 1)]))
-                    #print '\n\n', self.filtered_list[-1], '\n\n'
+        # The substring matches (the last two patterns) are ranked; a single
+        # word filter is only matched as a substring, and the most recent
+        # line is the one expected first
+        num_ordered = len(patterns) - 2 if len(patterns) > 1 else 1
 
-        # We use the trail to navigate back in the same order
-        self.trail = [(self.filter, [(0, len(self.filter))])]
+        return [re.compile(p, re.IGNORECASE) for p in patterns], required, num_ordered
+
+    def _build_index(self):
+        """Build the trigram index: lowercase trigram -> set of lines containing it"""
+        self.index = {}
+        for line in self._entries:
+            self._index_line(line)
+
+    def _index_line(self, line):
+        for trigram in trigrams(line.lower()):
+            self.index.setdefault(trigram, set()).add(line)
+
+    def _unindex_line(self, line):
+        for trigram in trigrams(line.lower()):
+            lines = self.index.get(trigram)
+            if lines is not None:
+                lines.discard(line)
+                if not lines:
+                    del self.index[trigram]
+
+    def _candidates(self, required):
+        """
+        Return the set of lines that contain all of the required substrings
+        (ignoring case), or None if the index cannot narrow down the search
+        """
+        if not all(s.isascii() for s in required):
+            # Case-insensitive regex matching and str.lower() only agree for ASCII
+            return None
+        required_trigrams = set(t for s in required for t in trigrams(s.lower()))
+        if not required_trigrams:
+            return None
+        if self.index is None:
+            self._build_index()
+        postings = sorted((self.index.get(t, set()) for t in required_trigrams), key=len)
+        return postings[0].intersection(*postings[1:])
 
     def up(self):
         """
@@ -91,6 +199,10 @@ class CommandHistory:
         if self.filtered_list:
             self.trail.append(self.filtered_list.pop())
             return True
+        match = next(self.matches, None)
+        if match:
+            self.trail.append(match)
+            return True
         else:
             return False
 
@@ -108,13 +220,17 @@ class CommandHistory:
         """
         Zap current entry out of the history list
         """
-        if line in self.list:
-            self.list.remove(line)
+        if line in self._entries:
+            del self._entries[line]
+            self._list = None
+            if self.index is not None:
+                self._unindex_line(line)
         self.reset()
 
     def reset(self):
         """Reset browsing through the history"""
         self.filter = ''
+        self.matches = iter(())
         self.filtered_list = []
         self.trail = []
 
@@ -122,11 +238,19 @@ class CommandHistory:
         """Add a new line to the history"""
         if line:
             #print 'Adding "' + line + '"'
-            if line in self.list:
-                self.list.remove(line)
-            self.list.append(line)
+            if line in self._entries:
+                del self._entries[line]
+            elif self.index is not None:
+                self._index_line(line)
+            self._entries[line] = None
+            self._list = None
             self.reset()
 
     def current(self):
         """Return the current history item"""
         return self.trail[-1] if self.trail else ('', [])
+
+
+def trigrams(string):
+    """Return the set of all the 3-character substrings of a string"""
+    return set(string[i:i + 3] for i in range(len(string) - 2))
@@ -0,0 +1,105 @@
+import os, sys, threading
+from pycmd.completion import complete_universal
+
+
+class CompletionEngine:
+    """
+    Compute completions in a background thread, ahead of time.
+
+    While the user is typing, the completions for the current line are
+    speculatively prefetched; when Tab is pressed, the result is usually
+    already available (or at least on its way). There is at most one pending
+    request: prefetching a new line supersedes the previous request if the
+    worker has not started on it yet, so a fast typist only causes a few
+    actual computations.
+
+    The results depend on the current directory, which is part of the key
+    they are stored under. A result is only used once: since a line is
+    prefetched after each key press, Tab never shows completions computed
+    before the last key press (files might have been created or deleted
+    since then).
+    """
+
+    def __init__(self, complete=complete_universal):
+        # The completion function, called as complete(line)
+        self.complete = complete
+
+        self._cond = threading.Condition()
+        self._thread = None
+
+        # Key of the next line to complete (waiting for the worker)
+        self._request = None
+
+        # Key of the line currently being completed by the worker
+        self._busy = None
+
+        # Key and result of the last completed line
+        self._done = None
+        self._result = None
+        self._exc_info = None
+
+    def prefetch(self, line):
+        """Start computing the completions for a line in the background"""
+        key = (line, os.getcwd())
+        with self._cond:
+            if key not in (self._done, self._busy):
+                self._submit(key)
+
+    def result(self, line, timeout=None):
+        """
+        Return the completions of a line (same as complete(line)), waiting
+        for the background computation as needed.
+
+        Return None if the result is not available within the specified
+        timeout (in seconds); the computation goes on in the background.
+        """
+        key = (line, os.getcwd())
+        with self._cond:
+            if key not in (self._done, self._busy):
+                self._submit(key)
+            if not self._cond.wait_for(lambda: self._done == key, timeout):
+                return None
+            (result, exc_info) = (self._result, self._exc_info)
+            self._done = self._result = self._exc_info = None
+            if exc_info:
+                raise exc_info[1].with_traceback(exc_info[2])
+            return result
+
+    def cancel(self):
+        """Forget all requests and results, e.g. after running a command"""
+        with self._cond:
+            self._request = self._busy = self._done = None
+            self._result = self._exc_info = None
+
+    def _submit(self, key):
+        """Make key the next line to complete; the lock must be held by the caller"""
+        self._request = key
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='completion', daemon=True)
+            self._thread.start()
+        self._cond.notify_all()
+
+    def _run(self):
+        """Worker thread: complete the requested lines"""
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._request is not None)
+                key = self._busy = self._request
+                self._request = None
+
+            result = exc_info = None
+            try:
+                result = self.complete(key[0])
+            except Exception:
+                exc_info = sys.exc_info()
+
+            with self._cond:
+                if self._busy == key:
+                    # Still relevant (not cancelled or superseded)
+                    self._done, self._result, self._exc_info = key, result, exc_info
+                    self._busy = None
+                self._cond.notify_all()
+
+
+# Engine used for the Tab completion in the command line
+completion_engine = CompletionEngine()
@@ -0,0 +1,113 @@
+import os, time, threading
+from collections import OrderedDict
+
+
+# A listing taken less than this many seconds after the last modification of
+# the directory is not trusted: on filesystems with a coarse timestamp
+# resolution (FAT, some network shares) further changes made within the same
+# tick would leave the modification time unchanged
+RACY_INTERVAL = 2
+
+
+class DirCache:
+    """
+    Cache of directory listings, used for completing file names.
+
+    Each listing stores the names of the directory entries together with
+    their type (directory, regular file), as reported by os.scandir(). A
+    listing is reused for as long as the modification time of the directory
+    stays the same -- this costs a single stat() instead of reading the
+    whole directory, which matters for large (network) directories.
+
+    Only the most recently used directories are kept. The cache can be used
+    from several threads.
+    """
+
+    def __init__(self, max_dirs=64):
+        self.max_dirs = max_dirs
+
+        # Map absolute path -> (mtime_ns, trusted, entries), least recently
+        # used first
+        self._listings = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Directories being read in the background, after a timeout
+        self._reading = set()
+
+    def entries(self, path, timeout=None):
+        """
+        Return the list of (name, is_dir, is_file) tuples describing the
+        entries in the given directory.
+
+        Return None if the directory had to be read and this took longer
+        than the specified timeout (in seconds); the reading then goes on in
+        the background, so that the listing is cached for the next call.
+        Raise OSError if the directory cannot be read at all.
+        """
+        path = dir_key(path)
+        mtime = os.stat(path).st_mtime_ns
+        with self._lock:
+            listing = self._listings.get(path)
+            if listing is not None and listing[0] == mtime and listing[1]:
+                self._listings.move_to_end(path)
+                return listing[2]
+            if timeout is not None and path in self._reading:
+                # Still being read in the background
+                return None
+
+        start = time.time()
+        entries = []
+        it = os.scandir(path)
+        for elem in it:
+            entries.append((elem.name, elem.is_dir(), elem.is_file()))
+            if timeout is not None and time.time() - start > timeout:
+                with self._lock:
+                    self._reading.add(path)
+                threading.Thread(target=self._read_rest, args=(path, mtime, start, it, entries),
+                                 daemon=True).start()
+                return None
+        it.close()
+        self._store(path, mtime, start, entries)
+        return entries
+
+    def _read_rest(self, path, mtime, start, it, entries):
+        """Finish reading a directory in the background, then cache the listing"""
+        try:
+            with it:
+                for elem in it:
+                    entries.append((elem.name, elem.is_dir(), elem.is_file()))
+            self._store(path, mtime, start, entries)
+        except OSError:
+            pass
+        finally:
+            with self._lock:
+                self._reading.discard(path)
+
+    def _store(self, path, mtime, start, entries):
+        trusted = abs(start - mtime / 1e9) > RACY_INTERVAL
+        with self._lock:
+            self._listings[path] = (mtime, trusted, entries)
+            self._listings.move_to_end(path)
+            if len(self._listings) > self.max_dirs:
+                self._listings.popitem(last=False)
+
+    def clear(self):
+        """Drop all the cached listings"""
+        with self._lock:
+            self._listings.clear()
+
+
+def dir_key(path):
+    """
+    The absolute path of a directory, as the OS resolves it: ".." is not
+    collapsed, as it follows a symlink to the parent of its target.
+    """
+    path = os.path.join(os.getcwd(), path)
+    stripped = path.rstrip(os.sep + (os.altsep or ''))
+    if stripped and not stripped.endswith(':'):
+        path = stripped
+    return path
+
+
+# Listings shared by all the completion functions
+dir_cache = DirCache()
@@ -0,0 +1,69 @@
+import os, sys
+from pycmd.common import debug
+
+
+class EnvSync:
+    """
+    Keep os.environ in sync with the environment of the shell that runs the
+    commands (bash or cmd.exe).
+
+    Only the variables whose values actually changed are assigned or removed
+    -- each assignment to os.environ is a putenv() call, which adds up for
+    large environments. Caches and prompt functions can subscribe in order
+    to be told the names of the variables changed by each command.
+    """
+
+    def __init__(self, environ=os.environ):
+        self.environ = environ
+        self._subscribers = []
+
+    def subscribe(self, callback):
+        """Call callback(names) each time some variables have changed"""
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        """Stop notifying a callback"""
+        self._subscribers.remove(callback)
+
+    def apply(self, changes):
+        """
+        Apply a dict mapping names to new values (None to remove the
+        variable); return the set of names whose value actually changed.
+        """
+        changed = set()
+        for (name, value) in changes.items():
+            if value is None:
+                if name in self.environ:
+                    del self.environ[name]
+                    changed.add(normalize_name(name))
+            elif self.environ.get(name) != value:
+                self.environ[name] = value
+                changed.add(normalize_name(name))
+
+        if changed:
+            for callback in list(self._subscribers):
+                try:
+                    callback(changed)
+                except Exception as e:
+                    debug('Environment change callback failed: %s' % e)
+        return changed
+
+    def update(self, new_environ):
+        """
+        Make the environment equal to new_environ; return the set of names
+        whose value actually changed.
+        """
+        new_names = {normalize_name(name) for name in new_environ}
+        changes = {name: None for name in self.environ
+                   if normalize_name(name) not in new_names}
+        changes.update(new_environ)
+        return self.apply(changes)
+
+
+def normalize_name(name):
+    """Variable names are case-insensitive on Windows"""
+    return name.upper() if sys.platform == 'win32' else name
+
+
+# Synchronizer for the environment of PyCmd itself
+env_sync = EnvSync()
@@ -0,0 +1,740 @@
+import os, sys, re, struct, zlib, hashlib, heapq, mmap
+from bisect import bisect_left
+
+
+# Object types, as stored in the pack files
+OBJ_COMMIT, OBJ_TREE, OBJ_BLOB, OBJ_TAG, OBJ_OFS_DELTA, OBJ_REF_DELTA = 1, 2, 3, 4, 6, 7
+TYPE_NAMES = {OBJ_COMMIT: b'commit', OBJ_TREE: b'tree', OBJ_BLOB: b'blob', OBJ_TAG: b'tag'}
+
+# Modes of the index and tree entries
+MODE_TREE = 0o40000
+MODE_GITLINK = 0o160000
+
+# Flags of the index entries
+INDEX_ASSUME_VALID = 0x8000
+INDEX_EXTENDED = 0x4000
+INDEX_SKIP_WORKTREE = 0x4000    # In the extended flags
+INDEX_INTENT_TO_ADD = 0x2000    # In the extended flags
+
+# Give up counting the commits ahead/behind the upstream beyond this
+MAX_WALKED_COMMITS = 100000
+
+# Data is read from the pack files in chunks of this size
+CHUNK_SIZE = 65536
+
+# Number of delta bases kept in memory per pack file
+MAX_CACHED_BASES = 256
+
+
+class Unsupported(Exception):
+    """The repository uses a feature that is not handled here; ask git instead"""
+
+
+class GitRepository(object):
+    """
+    Read the metadata of a git repository directly from the .git directory,
+    without running git: the current branch, the upstream branch and the
+    number of commits ahead of/behind it, whether the working tree has
+    changes (and whether some of them are staged).
+
+    This covers the common case for the git prompt; Unsupported is raised
+    when git should be asked instead (SHA-256 repositories, split indexes,
+    unmerged entries, submodules, possible content filters etc.).
+
+    The files that are parsed (packed-refs, config, pack index headers) are
+    cached for as long as their modification time stays the same; the pack
+    files are only mapped until close() is called.
+    """
+
+    def __init__(self, git_dir, work_tree=None):
+        self.git_dir = git_dir
+        self.work_tree = work_tree if work_tree else os.path.dirname(git_dir)
+
+        # Linked worktrees keep their own HEAD and index, the rest is shared
+        self.common_dir = git_dir
+        commondir_file = os.path.join(git_dir, 'commondir')
+        if os.path.isfile(commondir_file):
+            with open(commondir_file) as f:
+                self.common_dir = os.path.normpath(os.path.join(git_dir, f.read().strip()))
+
+        # Parsed files: path -> (mtime_ns, contents)
+        self._parsed = {}
+
+        # Pack files: list of (idx path, Pack), reloaded when objects/pack changes
+        self._packs = None
+        self._packs_mtime = None
+
+        # Parsed commits: sha -> (parent shas, commit time)
+        self._commits = {}
+
+    #
+    # References
+    #
+    def head(self):
+        """Return (branch, sha) for HEAD; branch is None for a detached HEAD"""
+        target = self._read_ref_file('HEAD')
+        if target is None:
+            return (None, None)
+        if target.startswith('ref: '):
+            ref = target[5:]
+            return (ref[len('refs/heads/'):] if ref.startswith('refs/heads/') else ref,
+                    self.resolve_ref(ref))
+        return (None, target)
+
+    def resolve_ref(self, ref):
+        """Return the sha a reference points to (following symbolic refs), or None"""
+        for _ in range(10):
+            target = self._read_ref_file(ref)
+            if target is None:
+                target = self.packed_refs().get(ref)
+            if target is None or not target.startswith('ref: '):
+                return target
+            ref = target[5:]
+        return None
+
+    def packed_refs(self):
+        """Return the dict of the references listed in the packed-refs file"""
+        return self._parse(os.path.join(self.common_dir, 'packed-refs'), parse_packed_refs, {})
+
+    def _read_ref_file(self, ref):
+        """Contents of a loose ref (or HEAD); None if there is no such file"""
+        for base in (self.git_dir, self.common_dir):
+            try:
+                with open(os.path.join(base, ref)) as f:
+                    return f.read().strip()
+            except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+                continue
+        return None
+
+    def config(self):
+        """Return the parsed config, see parse_config()"""
+        return self._parse(os.path.join(self.common_dir, 'config'), parse_config, {})
+
+    def upstream(self, branch):
+        """Return the ref of the upstream of a local branch, or None"""
+        config = self.config()
+        section = config.get(('branch', branch), {})
+        remote = section.get('remote', [None])[-1]
+        merge = section.get('merge', [None])[-1]
+        if not remote or not merge:
+            return None
+        if remote == '.':
+            return merge
+        for refspec in config.get(('remote', remote), {}).get('fetch', []):
+            tracking = map_refspec(refspec, merge)
+            if tracking:
+                return tracking
+        return None
+
+    #
+    # Objects
+    #
+    def read_object(self, sha):
+        """Return the (type, data) of an object; raise KeyError if it is not found"""
+        loose = os.path.join(self.common_dir, 'objects', sha[:2], sha[2:])
+        try:
+            with open(loose, 'rb') as f:
+                raw = zlib.decompress(f.read())
+        except FileNotFoundError:
+            pass
+        else:
+            header, _, data = raw.partition(b'\0')
+            return (header.split(b' ')[0], data)
+
+        binsha = bytes.fromhex(sha)
+        for pack in self._get_packs():
+            offset = pack.find(binsha)
+            if offset is not None:
+                (obj_type, data) = pack.read(offset, self._read_raw)
+                return (TYPE_NAMES[obj_type], data)
+        raise KeyError(sha)
+
+    def _read_raw(self, binsha):
+        """Read an object as (pack type, data), for resolving REF_DELTAs"""
+        (type_name, data) = self.read_object(binsha.hex())
+        return ({v: k for (k, v) in TYPE_NAMES.items()}[type_name], data)
+
+    def _get_packs(self):
+        pack_dir = os.path.join(self.common_dir, 'objects', 'pack')
+        try:
+            mtime = os.stat(pack_dir).st_mtime_ns
+        except FileNotFoundError:
+            return []
+        if self._packs is None or mtime != self._packs_mtime:
+            previous = dict(self._packs or [])
+            self._packs = []
+            for name in sorted(os.listdir(pack_dir)):
+                if name.endswith('.idx') and os.path.exists(os.path.join(pack_dir, name[:-4] + '.pack')):
+                    path = os.path.join(pack_dir, name)
+                    self._packs.append((path, previous.pop(path, None) or Pack(path)))
+            for pack in previous.values():
+                pack.close()
+            self._packs_mtime = mtime
+        return [pack for (_, pack) in self._packs]
+
+    def close(self):
+        """Unmap the pack files, until objects are read again"""
+        for (_, pack) in self._packs or []:
+            pack.close()
+
+    def commit(self, sha):
+        """Return the (parent shas, commit time) of a commit"""
+        commit = self._commits.get(sha)
+        if commit is None:
+            (obj_type, data) = self.read_object(sha)
+            if obj_type != b'commit':
+                raise Unsupported('%s is a %s, not a commit' % (sha, obj_type.decode()))
+            commit = self._commits[sha] = parse_commit(data)
+        return commit
+
+    def ahead_behind(self, local, upstream):
+        """
+        Count the commits reachable from local but not from upstream, and
+        the other way around (like git rev-list --left-right --count).
+
+        The commits are visited newest first, starting from both sides; the
+        walk stops as soon as all the commits left to visit are reachable
+        from both sides.
+        """
+        if len(self._commits) > MAX_WALKED_COMMITS:
+            self._commits.clear()
+        flags = {local: 1}
+        flags[upstream] = flags.get(upstream, 0) | 2
+        queue = [(-self.commit(sha)[1], sha) for sha in flags]
+        heapq.heapify(queue)
+        walked = 0
+        while queue and any(flags[sha] != 3 for (_, sha) in queue):
+            (_, sha) = heapq.heappop(queue)
+            walked += 1
+            if walked > MAX_WALKED_COMMITS:
+                raise Unsupported('too many commits between %s and %s' % (local, upstream))
+            for parent in self.commit(sha)[0]:
+                parent_flags = flags.get(parent, 0)
+                if parent_flags | flags[sha] != parent_flags:
+                    flags[parent] = parent_flags | flags[sha]
+                    heapq.heappush(queue, (-self.commit(parent)[1], parent))
+
+        # Commits with the same date are not necessarily visited children
+        # first: mark the ancestors of the remaining commits (reachable from
+        # both sides) down to the oldest of those reachable from one side
+        dates = [self.commit(sha)[1] for (sha, f) in flags.items() if f != 3]
+        oldest = min(dates) if dates else None
+        pending = [sha for (_, sha) in queue] if dates else []
+        while pending:
+            for parent in self.commit(pending.pop())[0]:
+                if flags.get(parent) != 3 and self.commit(parent)[1] >= oldest:
+                    flags[parent] = 3
+                    pending.append(parent)
+        return (sum(1 for f in flags.values() if f == 1),
+                sum(1 for f in flags.values() if f == 2))
+
+    #
+    # Index and working tree
+    #
+    def worktree_status(self, head_sha):
+        """
+        Return (dirty, staged): whether the working tree has changes that
+        are not in the index, and whether the index has changes that are not
+        in the HEAD commit (as shown by git status -uno).
+        """
+        if self.config().get(('extensions', ''), {}).get('objectformat', ['sha1'])[-1] != 'sha1':
+            raise Unsupported('object format')
+        index_path = os.path.join(self.git_dir, 'index')
+        try:
+            index_mtime = os.stat(index_path).st_mtime_ns
+        except FileNotFoundError:
+            return (False, head_sha is not None and self._tree_of(head_sha) != EMPTY_TREE)
+        (entries, tree_cache) = self._parse(index_path, parse_index, ([], {}))
+
+        self._check_mode = self._config_bool('core', 'filemode', True)
+        dirty = any(self._entry_changed(entry, index_mtime, entries) for entry in entries)
+        if head_sha is None:
+            staged = bool(entries)
+        else:
+            staged = self._index_differs(entries, tree_cache, self._tree_of(head_sha))
+        return (dirty, staged)
+
+    def _tree_of(self, commit_sha):
+        (obj_type, data) = self.read_object(commit_sha)
+        return data[5:45].decode()
+
+    def _entry_changed(self, entry, index_mtime, entries):
+        """Whether the file of an index entry differs from the entry"""
+        (path, mode, sha, mtime, size, flags) = entry
+        if flags & (INDEX_ASSUME_VALID | INDEX_SKIP_WORKTREE | INDEX_INTENT_TO_ADD):
+            return False
+        full_path = os.path.join(self.work_tree, path)
+        try:
+            st = os.lstat(full_path)
+        except (FileNotFoundError, NotADirectoryError):
+            return True
+        if mode_of(st.st_mode) != mode and (self._check_mode or (mode_of(st.st_mode) ^ mode) & 0o170000):
+            return True
+        if (st.st_mtime_ns == mtime and st.st_size & 0xFFFFFFFF == size
+            and mtime < index_mtime):
+            # Same stat data, and not modified in the same tick as the index
+            # was written ("racily clean", see git's racy-git.txt)
+            return False
+
+        # The stat data is not conclusive, compare the contents
+        if mode == 0o120000:
+            content = os.fsencode(os.readlink(full_path))
+        else:
+            with open(full_path, 'rb') as f:
+                content = f.read()
+        if hash_object(b'blob', content) == sha:
+            return False
+        if self._may_filter(entries):
+            # The contents might be converted (eol, filters) when added
+            raise Unsupported('content filters')
+        return True
+
+    def _may_filter(self, entries):
+        """Whether contents might be converted when added to the index"""
+        # Git for Windows enables autocrlf in its system config
+        autocrlf = self._config_bool('core', 'autocrlf', sys.platform == 'win32', True)
+        return (autocrlf
+                or any(section == 'filter' for config in self._configs() for (section, _) in config)
+                or any(path == '.gitattributes' or path.endswith('/.gitattributes')
+                       for (path, _, _, _, _, _) in entries)
+                or os.path.exists(os.path.join(self.common_dir, 'info', 'attributes'))
+                or self._config_value('core', 'attributesfile') is not None)
+
+    def _configs(self):
+        """The parsed configs, the repository one first, then the global ones"""
+        home = os.path.expanduser('~')
+        xdg = os.environ.get('XDG_CONFIG_HOME') or os.path.join(home, '.config')
+        return [self.config(),
+                self._parse(os.path.join(home, '.gitconfig'), parse_config, {}),
+                self._parse(os.path.join(xdg, 'git', 'config'), parse_config, {})]
+
+    def _config_value(self, section, key):
+        """The value of a setting (from the repository or the global configs), or None"""
+        for config in self._configs():
+            values = config.get((section, ''), {}).get(key)
+            if values:
+                return values[-1]
+        return None
+
+    def _config_bool(self, section, key, default, other=False):
+        """A boolean setting; other is the value of non-boolean strings (e.g. autocrlf=input)"""
+        value = self._config_value(section, key)
+        if value is None:
+            return default
+        value = value.lower()
+        if value in ('true', 'yes', 'on', '1'):
+            return True
+        if value in ('false', 'no', 'off', '0', ''):
+            return False
+        return other
+
+    def _index_differs(self, entries, tree_cache, tree_sha):
+        """
+        Whether the index entries differ from the given tree; the subtrees
+        recorded as unchanged by the cache tree of the index are skipped.
+        """
+        head = {}
+        unchanged_dirs = set()
+
+        def walk(sha, prefix):
+            if tree_cache.get(prefix) == sha:
+                unchanged_dirs.add(prefix)
+                return
+            (obj_type, data) = self.read_object(sha)
+            for (mode, name, entry_sha) in parse_tree(data):
+                path = prefix + '/' + name if prefix else name
+                if mode == MODE_TREE:
+                    walk(entry_sha, path)
+                else:
+                    head[path] = (mode, entry_sha)
+
+        walk(tree_sha, '')
+        if '' in unchanged_dirs:
+            return False
+        for (path, mode, sha, _, _, flags) in entries:
+            if flags & INDEX_INTENT_TO_ADD:
+                continue
+            if unchanged_dirs and any(d in unchanged_dirs for d in parent_dirs(path)):
+                continue
+            if head.pop(path, None) != (mode, sha):
+                return True
+        return bool(head)
+
+    def _parse(self, path, parser, default):
+        """Parse a file with the given function, reuse the result while it is unchanged"""
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return default
+        cached = self._parsed.get(path)
+        if cached is None or cached[0] != mtime:
+            with open(path, 'rb') as f:
+                cached = self._parsed[path] = (mtime, parser(f.read()))
+        return cached[1]
+
+
+class Pack(object):
+    """
+    A pack file and its index (version 1 or 2). Only the header of the index
+    is kept; both files are mapped when first needed and stay mapped until
+    close(), so that git can delete or replace them in the meantime.
+    """
+
+    def __init__(self, idx_path):
+        self.idx_path = idx_path
+        with open(idx_path, 'rb') as f:
+            header = f.read(8 + 256 * 4)
+        if header[:4] == b'\xfftOc':
+            if struct.unpack('>I', header[4:8])[0] != 2:
+                raise Unsupported('pack index version')
+            self.fanout_start = 8
+            self.count = struct.unpack('>I', header[8 + 255 * 4: 8 + 256 * 4])[0]
+            self.shas_start = 8 + 256 * 4
+            self.sha_step = 20
+        else:
+            self.fanout_start = 0
+            self.count = struct.unpack('>I', header[255 * 4: 256 * 4])[0]
+            self.shas_start = 256 * 4
+            self.sha_step = 24
+        self.version = 2 if self.fanout_start else 1
+        self.shas = _ShaList(self)
+        self.idx = None
+        self.data = None
+
+        # Recently used delta bases: offset -> (type, data)
+        self._bases = {}
+
+    def close(self):
+        """Unmap the files (they are mapped again when needed)"""
+        for mapped in (self.idx, self.data):
+            if mapped is not None:
+                mapped.close()
+        self.idx = self.data = None
+        self._bases.clear()
+
+    def _map(self, path):
+        with open(path, 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def find(self, binsha):
+        """Return the offset of an object in the pack, or None"""
+        if self.idx is None:
+            self.idx = self._map(self.idx_path)
+        first = binsha[0]
+        fanout = self.fanout_start
+        lo = struct.unpack('>I', self.idx[fanout + (first - 1) * 4: fanout + first * 4])[0] if first else 0
+        hi = struct.unpack('>I', self.idx[fanout + first * 4: fanout + (first + 1) * 4])[0]
+        i = bisect_left(self.shas, binsha, lo, hi)
+        if i == hi or self.shas[i] != binsha:
+            return None
+        if self.version == 1:
+            pos = self.shas_start + i * 24
+            return struct.unpack('>I', self.idx[pos: pos + 4])[0]
+        pos = self.shas_start + self.count * 24 + i * 4
+        offset = struct.unpack('>I', self.idx[pos: pos + 4])[0]
+        if offset & 0x80000000:
+            pos = self.shas_start + self.count * 28 + (offset & 0x7FFFFFFF) * 8
+            offset = struct.unpack('>Q', self.idx[pos: pos + 8])[0]
+        return offset
+
+    def read(self, offset, read_raw):
+        """Return the (type, data) of the object at the given offset"""
+        if self.data is None:
+            self.data = self._map(self.idx_path[:-4] + '.pack')
+        data = self.data
+        c = data[offset]
+        obj_type = (c >> 4) & 7
+        pos = offset + 1
+        while c & 0x80:
+            c = data[pos]
+            pos += 1
+
+        if obj_type == OBJ_OFS_DELTA:
+            c = data[pos]
+            pos += 1
+            base_offset = c & 0x7F
+            while c & 0x80:
+                c = data[pos]
+                pos += 1
+                base_offset = ((base_offset + 1) << 7) | (c & 0x7F)
+            (base_type, base) = self._read_base(offset - base_offset, read_raw)
+            return (base_type, apply_delta(base, self._inflate(pos)))
+        elif obj_type == OBJ_REF_DELTA:
+            (base_type, base) = read_raw(bytes(data[pos: pos + 20]))
+            return (base_type, apply_delta(base, self._inflate(pos + 20)))
+        return (obj_type, self._inflate(pos))
+
+    def _read_base(self, offset, read_raw):
+        base = self._bases.get(offset)
+        if base is None:
+            if len(self._bases) >= MAX_CACHED_BASES:
+                self._bases.clear()
+            base = self._bases[offset] = self.read(offset, read_raw)
+        return base
+
+    def _inflate(self, pos):
+        inflater = zlib.decompressobj()
+        chunks = []
+        while not inflater.eof:
+            chunk = self.data[pos: pos + CHUNK_SIZE]
+            if not chunk:
+                raise Unsupported('truncated pack')
+            chunks.append(inflater.decompress(chunk))
+            pos += CHUNK_SIZE
+        return b''.join(chunks)
+
+
+class _ShaList(object):
+    """The sorted list of the (binary) shas in a pack index, for bisect"""
+
+    def __init__(self, pack):
+        self.pack = pack
+
+    def __len__(self):
+        return self.pack.count
+
+    def __getitem__(self, i):
+        pos = self.pack.shas_start + i * self.pack.sha_step + (4 if self.pack.version == 1 else 0)
+        return self.pack.idx[pos: pos + 20]
+
+
+EMPTY_TREE = '4b825dc642cb6eb9a060e54bf8d69288fbee4904'
+
+
+def hash_object(obj_type, content):
+    """The sha of an object, as computed by git hash-object"""
+    return hashlib.sha1(obj_type + b' %d\0' % len(content) + content).hexdigest()
+
+
+def apply_delta(base, delta):
+    """Rebuild an object from its base and a delta (as stored in the packs)"""
+    pos = 0
+    for _ in range(2):
+        # Skip the sizes of the source and of the target
+        while delta[pos] & 0x80:
+            pos += 1
+        pos += 1
+    out = []
+    while pos < len(delta):
+        c = delta[pos]
+        pos += 1
+        if c & 0x80:
+            # Copy from the base
+            offset = size = 0
+            for i in range(4):
+                if c & (1 << i):
+                    offset |= delta[pos] << (8 * i)
+                    pos += 1
+            for i in range(3):
+                if c & (0x10 << i):
+                    size |= delta[pos] << (8 * i)
+                    pos += 1
+            out.append(base[offset: offset + (size or 0x10000)])
+        elif c:
+            # Insert new data
+            out.append(delta[pos: pos + c])
+            pos += c
+        else:
+            raise Unsupported('invalid delta')
+    return b''.join(out)
+
+
+def parse_commit(data):
+    """Return the (parent shas, commit time) of a commit object"""
+    parents = []
+    time = 0
+    for line in data.split(b'\n'):
+        if not line:
+            break
+        if line.startswith(b'parent '):
+            parents.append(line[7:].decode())
+        elif line.startswith(b'committer '):
+            time = int(line.rsplit(b' ', 2)[1])
+    return (parents, time)
+
+
+def parse_tree(data):
+    """Generate the (mode, name, sha) of the entries of a tree object"""
+    pos = 0
+    while pos < len(data):
+        space = data.index(b' ', pos)
+        nul = data.index(b'\0', space)
+        yield (int(data[pos: space], 8), os.fsdecode(data[space + 1: nul]), data[nul + 1: nul + 21].hex())
+        pos = nul + 21
+
+
+def parse_packed_refs(data):
+    """Return the dict of the references in a packed-refs file"""
+    refs = {}
+    for line in data.decode('utf-8', 'replace').splitlines():
+        if line and line[0] not in '#^':
+            (sha, _, ref) = line.partition(' ')
+            refs[ref.strip()] = sha
+    return refs
+
+
+CONFIG_SECTION_REGEX = re.compile(r'\s*\[\s*([^\s\]"]+)(?:\s+"((?:[^"\\]|\\.)*)")?\s*\]')
+
+
+def parse_config(data):
+    """
+    Parse a git config file into a dict mapping (section, subsection) to
+    dicts of lists of values (keys may be repeated). The section and key
+    names are lowercased, the subsection names are kept as they are.
+    """
+    config = {}
+    section = None
+    for line in data.decode('utf-8', 'replace').splitlines():
+        match = CONFIG_SECTION_REGEX.match(line)
+        if match:
+            (name, subsection) = match.groups()
+            if subsection is None and '.' in name:
+                # Deprecated [section.subsection] syntax
+                (name, _, subsection) = name.partition('.')
+            subsection = re.sub(r'\\(.)', r'\1', subsection) if subsection else ''
+            section = config.setdefault((name.lower(), subsection), {})
+            line = line[match.end():]
+        line = line.strip()
+        if not line or line[0] in '#;' or section is None:
+            continue
+        (key, eq, value) = line.partition('=')
+        section.setdefault(key.strip().lower(), []).append(config_value(value) if eq else 'true')
+    return config
+
+
+def config_value(value):
+    """Unquote a config value, drop the trailing comment"""
+    out = []
+    quoted = False
+    i = 0
+    while i < len(value):
+        c = value[i]
+        if c == '"':
+            quoted = not quoted
+        elif c == '\\' and i + 1 < len(value):
+            i += 1
+            out.append({'n': '\n', 't': '\t', 'b': '\b'}.get(value[i], value[i]))
+        elif c in '#;' and not quoted:
+            break
+        else:
+            out.append(c)
+        i += 1
+    return ''.join(out).strip()
+
+
+def map_refspec(refspec, ref):
+    """Map a ref through a fetch refspec (src:dst, with an optional *); None if it does not apply"""
+    (src, _, dst) = refspec.lstrip('+').partition(':')
+    if '*' in src:
+        (prefix, _, suffix) = src.partition('*')
+        if ref.startswith(prefix) and ref.endswith(suffix) and len(ref) >= len(prefix) + len(suffix):
+            return dst.replace('*', ref[len(prefix): len(ref) - len(suffix)])
+    elif ref == src:
+        return dst
+    return None
+
+
+def parse_index(data):
+    """
+    Parse an index file into a list of (path, mode, sha, mtime_ns, size,
+    flags) entries, and the cache tree: a dict mapping directory paths to
+    the sha of their tree (for the valid entries of the TREE extension).
+    """
+    if data[:4] != b'DIRC':
+        raise Unsupported('not an index file')
+    (version, count) = struct.unpack('>II', data[4:12])
+    if version not in (2, 3, 4):
+        raise Unsupported('index version %d' % version)
+    entries = []
+    pos = 12
+    path = b''
+    for _ in range(count):
+        (mtime_s, mtime_ns, mode, size, flags) = struct.unpack('>8xII8xI8xI20xH', data[pos: pos + 62])
+        sha = data[pos + 40: pos + 60].hex()
+        if (flags >> 12) & 3:
+            raise Unsupported('unmerged entries')
+        if (mode & 0o170000) == MODE_GITLINK:
+            raise Unsupported('submodules')
+        entry_start = pos
+        pos += 62
+        if flags & INDEX_EXTENDED:
+            flags = (flags & INDEX_ASSUME_VALID) | struct.unpack('>H', data[pos: pos + 2])[0]
+            pos += 2
+        else:
+            flags &= INDEX_ASSUME_VALID
+        if version == 4:
+            # The path is given relative to the previous one
+            (strip, pos) = read_offset_varint(data, pos)
+            nul = data.index(b'\0', pos)
+            path = path[: len(path) - strip] + data[pos: nul]
+            pos = nul + 1
+        else:
+            nul = data.index(b'\0', pos)
+            path = data[pos: nul]
+            pos = entry_start + ((nul - entry_start + 8) // 8) * 8
+        entries.append((os.fsdecode(path), mode, sha, mtime_s * 1000000000 + mtime_ns, size, flags))
+
+    tree_cache = {}
+    while pos + 8 <= len(data) - 20:
+        signature = data[pos: pos + 4]
+        size = struct.unpack('>I', data[pos + 4: pos + 8])[0]
+        ext = data[pos + 8: pos + 8 + size]
+        pos += 8 + size
+        if signature == b'TREE':
+            tree_cache = parse_cache_tree(ext)
+        elif not b'A' <= signature[:1] <= b'Z':
+            # Extensions starting with a lowercase letter must be understood
+            raise Unsupported('index extension %r' % signature)
+    return (entries, tree_cache)
+
+
+def parse_cache_tree(data):
+    """Return the valid entries of the TREE index extension, as {dir path: sha}"""
+    tree_cache = {}
+    stack = []
+    pos = 0
+    while pos < len(data):
+        nul = data.index(b'\0', pos)
+        name = os.fsdecode(data[pos: nul])
+        newline = data.index(b'\n', nul)
+        (entry_count, subtrees) = (int(n) for n in data[nul + 1: newline].split(b' '))
+        pos = newline + 1
+        while stack and stack[-1][1] == 0:
+            stack.pop()
+        path = (stack[-1][0] + '/' + name if stack[-1][0] else name) if stack else ''
+        if stack:
+            stack[-1][1] -= 1
+        if entry_count >= 0:
+            tree_cache[path] = data[pos: pos + 20].hex()
+            pos += 20
+        stack.append([path, subtrees])
+    return tree_cache
+
+
+def read_offset_varint(data, pos):
+    """Read a variable length integer as encoded in v4 indexes and OFS_DELTAs"""
+    c = data[pos]
+    pos += 1
+    value = c & 0x7F
+    while c & 0x80:
+        c = data[pos]
+        pos += 1
+        value = ((value + 1) << 7) | (c & 0x7F)
+    return (value, pos)
+
+
+def mode_of(st_mode):
+    """The git mode corresponding to the stat mode of a file"""
+    if (st_mode & 0o170000) == 0o120000:
+        return 0o120000
+    if (st_mode & 0o170000) == 0o040000:
+        return MODE_TREE
+    return 0o100755 if st_mode & 0o100 else 0o100644
+
+
+def parent_dirs(path):
+    """Generate the ancestor directories of a path, e.g. 'a/b' and 'a' for 'a/b/c'"""
+    pos = path.rfind('/')
+    while pos > 0:
+        yield path[:pos]
+        pos = path.rfind('/', 0, pos)
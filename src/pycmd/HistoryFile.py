@@ -0,0 +1,187 @@
+import os, sys, tempfile
+from contextlib import contextmanager
+
+if sys.platform == 'win32':
+    import msvcrt
+else:
+    import fcntl
+
+
+# Prefix marking a removed ("zapped") entry; the input line never contains
+# NUL characters (they are purged on paste), so this cannot clash with an
+# actual command
+TOMBSTONE = '\0'
+
+
+class HistoryFile:
+    """
+    Persistent storage for a history (commands, chat inputs, directories).
+
+    The file is an append-only journal: adding a line appends it, removing
+    a line appends a tombstone record for it. Reading replays the journal,
+    so that an entry which is added again moves to the end and a removed
+    entry disappears. Once the journal grows well past the history limit
+    it is compacted, i.e. rewritten to contain only the surviving entries.
+
+    All writes are done while holding a lock on a companion .lock file, so
+    several PyCmd sessions can share the same history without losing each
+    other's updates. A plain list of lines (the format used by previous
+    versions) is a valid journal.
+    """
+
+    def __init__(self, filename, limit):
+        self.filename = filename
+        self.limit = limit
+
+        # Number of records in the journal (as far as we know -- other
+        # sessions might have appended in the meantime)
+        self.num_records = 0
+
+        # Identity of the journal file and the position up to which we have
+        # read it; used to pick up the records appended by other sessions
+        self.file_id = None
+        self.offset = 0
+
+    def read(self):
+        """Read and return the list of lines stored in the history file"""
+        if os.path.isfile(self.filename):
+            with self._locked():
+                records = self._read_records()
+        else:
+            print('Warning: Can\'t open ' + os.path.basename(self.filename) + '!')
+            records = []
+        self.num_records = len(records)
+        return replay(records)[-self.limit:]
+
+    def read_new(self):
+        """
+        Return the records appended to the journal (by any session) since the
+        last read, or None if the journal has been rewritten in the meantime
+        (i.e. compacted), in which case the history should be read again.
+
+        This only costs a stat() if the file has not changed.
+        """
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            return []
+        if (stat.st_dev, stat.st_ino) != self.file_id or stat.st_size < self.offset:
+            return None
+        if stat.st_size == self.offset:
+            return []
+
+        with self._locked():
+            with open(self.filename, 'rb') as history_file:
+                if self._file_id(history_file) != self.file_id:
+                    return None
+                history_file.seek(self.offset)
+                data = history_file.read()
+        data = data[:data.rfind(b'\n') + 1]
+        self.offset += len(data)
+        records = decode(data)
+        self.num_records += len(records)
+        return records
+
+    def add(self, line):
+        """Add (or move to the end) a line"""
+        self._append(line)
+
+    def remove(self, line):
+        """Remove a line"""
+        self._append(TOMBSTONE + line)
+
+    def compact(self):
+        """Rewrite the journal so that it only contains the surviving lines"""
+        with self._locked():
+            self._compact()
+
+    def _append(self, record):
+        data = (record + '\n').encode('utf8')
+        with self._locked():
+            with open(self.filename, 'ab') as history_file:
+                up_to_date = (self._file_id(history_file) == self.file_id
+                              and os.fstat(history_file.fileno()).st_size == self.offset)
+                history_file.write(data)
+            if up_to_date:
+                # No one else has written in the meantime, skip our own record
+                # when looking for new ones
+                self.offset += len(data)
+            self.num_records += 1
+            if self.num_records > 2 * self.limit:
+                self._compact()
+
+    def _compact(self):
+        """Compact the journal; the lock must be held by the caller"""
+        lines = replay(self._read_records())[-self.limit:]
+        (handle, temp_name) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.filename)))
+        with os.fdopen(handle, 'wb') as history_file:
+            history_file.write(''.join([l + '\n' for l in lines]).encode('utf8'))
+        os.replace(temp_name, self.filename)
+        self.num_records = len(lines)
+
+        # Records appended by other sessions might have been folded into the
+        # rewritten journal before we saw them; force a complete re-read
+        self.file_id = None
+
+    def _read_records(self):
+        """Read all the records in the journal; the lock must be held by the caller"""
+        try:
+            with open(self.filename, 'rb') as history_file:
+                self.file_id = self._file_id(history_file)
+                data = history_file.read()
+        except FileNotFoundError:
+            self.file_id = None
+            data = b''
+        self.offset = len(data)
+        return decode(data)
+
+    @staticmethod
+    def _file_id(file):
+        stat = os.fstat(file.fileno())
+        return (stat.st_dev, stat.st_ino)
+
+    @contextmanager
+    def _locked(self):
+        """Hold an exclusive lock on the history file (blocks until acquired)"""
+        with open(self.filename + '.lock', 'a+') as lock_file:
+            if sys.platform == 'win32':
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                try:
+                    yield
+                finally:
+                    lock_file.seek(0)
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def decode(data):
+    """Split the raw contents of a journal into records"""
+    records = data.decode('utf8', errors='replace').replace('\r\n', '\n').split('\n')
+    if records[-1] == '':
+        del records[-1]
+    return records
+
+
+def replay(records):
+    """Compute the list of lines resulting from a sequence of journal records"""
+    if TOMBSTONE not in ''.join(records):
+        # Fast path (no removals): keep the last occurrence of each line
+        lines = dict.fromkeys(reversed(records))
+        lines.pop('', None)
+        return list(reversed(lines))
+
+    lines = {}
+    for record in records:
+        if record.startswith(TOMBSTONE):
+            lines.pop(record[len(TOMBSTONE):], None)
+        elif record:
+            # Re-inserting moves the line to the end
+            lines.pop(record, None)
+            lines[record] = None
+    return list(lines)
@@ -1,7 +1,7 @@
 from enum import Enum, auto
 import sys, subprocess
 from pycmd.CommandHistory import CommandHistory
-from pycmd.common import word_sep, tokenize, seq_tokens
+from pycmd.common import word_sep, seq_tokens, IncrementalTokenizer
 from pycmd.completion import complete_file, complete_env_var, has_wildcards, ends_in_env_var
 from pycmd.common import word_sep
 import re
@@ -80,6 +80,9 @@ class InputState:
         # Command history
         self.history = CommandHistory()
 
+        # Tokens of the text before the cursor, updated incrementally
+        self.tokenizer = IncrementalTokenizer()
+
         # Text selection
         self.selection_start = 0
 
@@ -172,6 +175,11 @@ class InputState:
     def line(self):
         return self.before_cursor + self.after_cursor
 
+    @property
+    def tokens(self):
+        """Tokens of the text before the cursor, same as tokenize(self.before_cursor)"""
+        return self.tokenizer.tokenize(self.before_cursor)
+
     def step_line(self):
         """Prepare for a new key event"""
         self.prev_prompt = self.prompt
@@ -232,13 +240,13 @@ class InputState:
         suggestion = None
         if self.before_cursor and not self.after_cursor:
             # Try to suggest perfect match from history
-            prefix_suggestions = [l for l in reversed(self.history.list) if l.startswith(self.before_cursor)]
+            prefix_suggestions = [l for l in self.history.recent() if l.startswith(self.before_cursor)]
             if prefix_suggestions:
                 suggestion = prefix_suggestions[0]
 
             if not suggestion:
                 # Try to suggest similar multi-command match from history
-                tokens = tokenize(self.before_cursor)
+                tokens = self.tokens
                 seq_indexes = [i for i in range(len(tokens)) if tokens[i] in seq_tokens]
                 if seq_indexes:
                     pattern = [re.escape(tokens[0] + ' ') + '.*']
@@ -246,7 +254,7 @@ class InputState:
                     pattern += ['(' + ' '.join(re.escape(t) for t in tokens[seq_indexes[-1]:]) + '.*' + ')']
                     pattern = ' '.join(pattern)
                     # print(pattern)
-                    for l in reversed(self.history.list):
+                    for l in self.history.recent():
                         if m := re.match(pattern, l):
                             last_typed_command = ' '.join(tokens[seq_indexes[-1]:])
                             last_matched_command = m.group(1)
@@ -260,9 +268,10 @@ class InputState:
                 # Try to suggest a file or an environment variable
                 if not has_wildcards(tokens[-1]):
                     if ends_in_env_var(tokens[-1]):
-                        completed, completions = complete_env_var(self.before_cursor)
+                        completed, completions = complete_env_var(self.before_cursor, tokens)
                     else:
-                        completed, completions = complete_file(self.before_cursor, timeout=0.1, exactly_one=True)
+                        completed, completions = complete_file(self.before_cursor, timeout=0.1, exactly_one=True,
+                                                               tokens=tokens)
                     normalize_case = lambda s: s.lower() if sys.platform == 'win32' else s
                     if normalize_case(completed).startswith(normalize_case(self.before_cursor)) and len(completions) == 1:
                         suggestion = completed
@@ -696,7 +705,7 @@ class InputState:
 
             context_matches = []
             no_context_matches = []
-            for line in reversed(self.history.list):
+            for line in self.history.recent():
                 line_words = [''] + line.split(' ')
                 for i in range(len(line_words) - 1, 0, -1):
                     word = line_words[i]
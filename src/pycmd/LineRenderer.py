@@ -0,0 +1,120 @@
+from pycmd.console import get_buffer_size, get_text_attributes, set_text_attributes
+from pycmd.console import cursor_backward, cursor_forward, write_with_sane_cursor
+from pycmd.console import parse_color_codes, remove_escape_sequences
+from pycmd.pycmd_public import color
+from sys import stdout
+
+
+class LineRenderer(object):
+    """
+    Draw the input line (prompt, text, suggestion) after each key event.
+
+    The renderer remembers the cells (character and attributes) it has
+    drawn last time, together with the position of the cursor; a new
+    version of the line is drawn by only rewriting the cells that have
+    changed. Typing at the end of the line thus costs a few bytes instead
+    of a repaint of the whole line -- this matters over slow connections.
+
+    The line is fully repainted (as before) if the screen might not show
+    what the renderer remembers: when the console was resized, when the
+    line was drawn by someone else, or after invalidate().
+    """
+
+    def __init__(self):
+        # The line as last drawn: the (prompt, before_cursor, after_cursor,
+        # suggestion) strings, and the corresponding (attributes, char) cells
+        self.line = None
+        self.cells = []
+        self.width = 0
+
+    def invalidate(self):
+        """Forget the drawn line, e.g. after clearing the screen"""
+        self.line = None
+
+    def render(self, text, line, prev_line):
+        """
+        Draw a new version of the line and place the cursor.
+
+        text is the whole line including the color codes; line and prev_line
+        are the new and the previous (prompt, before_cursor, after_cursor,
+        suggestion), as found in the InputState (the cursor is currently
+        at the end of the previous before_cursor).
+        """
+        width = get_buffer_size()[0]
+        (runs, attr) = parse_color_codes(text, get_text_attributes())
+        cells = [(run_attr, c) for (run_attr, run_text) in runs for c in run_text]
+        if (prev_line != self.line or width != self.width
+            or any(c < ' ' for (_, c) in cells)):
+            self.repaint(text, line, prev_line)
+        else:
+            self.update(cells, attr, cursor_index(line))
+        self.line = line
+        self.cells = cells
+        self.width = width
+
+    def repaint(self, text, line, prev_line):
+        """Write the whole line again, starting from the beginning"""
+        prev_len = len(remove_escape_sequences(''.join(prev_line)))
+        new_len = len(remove_escape_sequences(''.join(line)))
+        cursor_backward(cursor_index(prev_line))
+        stdout.write('\r' + text)
+
+        # Erase remaining chars from old line
+        to_erase = prev_len - new_len
+        if to_erase > 0:
+            stdout.write(color.Fore.DEFAULT + color.Back.DEFAULT + ' ' * to_erase)
+            cursor_backward(to_erase)
+
+        # Move cursor to the correct position
+        cursor_backward(new_len - cursor_index(line))
+
+    def update(self, cells, attr, cursor):
+        """Rewrite the cells that differ from the ones drawn last time"""
+        prev_cells = self.cells
+        prev_cursor = cursor_index(self.line)
+
+        # Find the first and the last changed cell
+        common = min(len(cells), len(prev_cells))
+        start = 0
+        while start < common and cells[start] == prev_cells[start]:
+            start += 1
+        end = max(len(cells), len(prev_cells))
+        if len(cells) == len(prev_cells):
+            while end > start and cells[end - 1] == prev_cells[end - 1]:
+                end -= 1
+
+        if start < end:
+            move_to(prev_cursor, start)
+            pos = start
+            while pos < min(end, len(cells)):
+                # Write the cells with the same attributes at once
+                run_end = pos + 1
+                while run_end < min(end, len(cells)) and cells[run_end][0] == cells[pos][0]:
+                    run_end += 1
+                if get_text_attributes() != cells[pos][0]:
+                    set_text_attributes(cells[pos][0])
+                write_with_sane_cursor(''.join(c for (_, c) in cells[pos:run_end]))
+                pos = run_end
+            if end > len(cells):
+                # Erase remaining chars from old line
+                stdout.write(color.Fore.DEFAULT + color.Back.DEFAULT + ' ' * (end - len(cells)))
+                pos = end
+            elif get_text_attributes() != attr:
+                set_text_attributes(attr)
+            prev_cursor = pos
+
+        move_to(prev_cursor, cursor)
+
+
+def cursor_index(line):
+    """Position of the cursor (number of chars before it) within a line"""
+    (prompt, before_cursor, _, _) = line
+    return len(remove_escape_sequences(prompt) + before_cursor)
+
+
+def move_to(current, target):
+    """Move the cursor from one position within the line to another"""
+    if target < current:
+        cursor_backward(current - target)
+    elif target > current:
+        cursor_forward(target - current)
@@ -0,0 +1,120 @@
+import os, sys, time, threading
+from bisect import bisect_left
+from pycmd.common import expand_env_vars, is_executable
+from pycmd.DirCache import RACY_INTERVAL
+from pycmd.EnvSync import env_sync
+
+
+class PathIndex:
+    """
+    Index of the executables found in the directories listed in the PATH,
+    used for completing command names.
+
+    The executables in each directory are remembered together with the
+    modification time of the directory; when the PATH or one of the
+    directories changes, only the affected directories are read again.
+    The names are kept sorted (case ignored), so that looking up the ones
+    starting with a given prefix is a binary search. The index can be used
+    from several threads.
+    """
+
+    def __init__(self, check_interval=1):
+        # Minimum time (in seconds) between two checks for changes in the
+        # PATH directories
+        self.check_interval = check_interval
+
+        self.path = None
+        self.dirs = []
+        self._last_check = 0
+
+        # Map directory -> (mtime_ns, trusted, names of executables)
+        self._listings = {}
+
+        # Names of all executables, sorted; and their lowercase versions, for
+        # the lookups (both are replaced at once)
+        self._index = ([], [])
+        self._lock = threading.Lock()
+
+    def lookup(self, prefix=''):
+        """Return the names of the executables starting with a prefix (case ignored)"""
+        self.refresh()
+        (names, keys) = self._index
+        key = prefix.lower()
+        begin = bisect_left(keys, key)
+        end = bisect_left(keys, key + '\U0010ffff', begin)
+        return names[begin:end]
+
+    def refresh(self, force=False):
+        """Update the index if the PATH or any of its directories changed"""
+        with self._lock:
+            self._refresh(force)
+
+    def env_changed(self, names):
+        """Re-index in the background as soon as the PATH changes"""
+        if 'PATH' in names:
+            threading.Thread(target=self.refresh, name='path_index', daemon=True).start()
+
+    def _refresh(self, force):
+        path = os.environ.get('PATH', '')
+        now = time.time()
+        if path == self.path and not force and now - self._last_check < self.check_interval:
+            return
+        self._last_check = now
+
+        changed = False
+        if path != self.path:
+            self.path = path
+            self.dirs = path_dirs(path)
+            for dir in list(self._listings):
+                if dir not in self.dirs:
+                    del self._listings[dir]
+            changed = True
+
+        for dir in self.dirs:
+            try:
+                mtime = os.stat(dir).st_mtime_ns
+            except OSError:
+                mtime = None
+            listing = self._listings.get(dir)
+            if listing is not None and listing[0] == mtime and listing[1]:
+                continue
+            self._listings[dir] = (mtime, abs(now - (mtime or 0) / 1e9) > RACY_INTERVAL,
+                                   list_executables(dir) if mtime is not None else [])
+            changed = changed or listing is None or listing[2] != self._listings[dir][2]
+
+        if changed:
+            names = set()
+            for (_, _, executables) in self._listings.values():
+                names.update(executables)
+            names = sorted(names, key=str.lower)
+            self._index = (names, [name.lower() for name in names])
+
+
+def path_dirs(path):
+    """Split a PATH string into the list of directories searched for commands"""
+    dirs = []
+    for elem in path.split(os.pathsep):
+        if sys.platform == 'linux' and (elem.lower().startswith('/mnt/c/windows') or
+                                        elem.lower().startswith('/mnt/c/program files')):
+            # Skip the (huge and slow) Windows directories under WSL
+            continue
+        elem = expand_env_vars(elem)
+        if elem and elem not in dirs:
+            dirs.append(elem)
+    return dirs
+
+
+def list_executables(dir):
+    """Return the names of the executable files in a directory"""
+    try:
+        with os.scandir(dir) as it:
+            return [elem.name for elem in it
+                    if elem.is_file() and is_executable(os.path.join(dir, elem.name))]
+    except OSError:
+        # Cannot read, probably access denied
+        return []
+
+
+# Index shared by all the completion functions
+path_index = PathIndex()
+env_sync.subscribe(path_index.env_changed)
@@ -3,9 +3,13 @@ from pycmd.common import pycmd_data_dir, pycmd_install_dir
 from pycmd.common import tokenize, unescape, escape_special_chars_in_quotes, sep_tokens, sep_chars, exec_extensions, pseudo_vars
 from pycmd.common import expand_tilde, expand_env_vars
 from pycmd.common import associated_application, full_executable_path, is_gui_application
-from pycmd.completion import find_common_prefix, has_wildcards, wildcard_to_regex, complete_universal, adjust_completion
+from pycmd.completion import find_common_prefix, has_wildcards, wildcard_to_regex, adjust_completion
+from pycmd.CompletionEngine import completion_engine
+from pycmd.EnvSync import env_sync
 from pycmd.InputState import ActionCode, InputState
 from pycmd.DirHistory import DirHistory
+from pycmd.LineRenderer import LineRenderer
+from pycmd.HistoryFile import HistoryFile, TOMBSTONE
 from pycmd import console
 import re
 import shlex
@@ -13,12 +17,12 @@ import threading
 import copy
 from sys import stdout, stderr
 from pycmd.console import move_cursor, get_cursor, cursor_backward, set_cursor_attributes
-from pycmd.console import read_input, write_input
+from pycmd.console import read_input, write_input, input_ready
 from pycmd.console import is_ctrl_pressed, is_left_ctrl_pressed, is_right_ctrl_pressed, is_alt_pressed, is_left_alt_pressed, is_right_alt_pressed, is_shift_pressed, is_control_only
 from pycmd.console import scroll_buffer, get_viewport, get_buffer_size, clear_screen
 from pycmd.console import remove_escape_sequences
 from pycmd.Window import Window
-from pycmd.pycmd_public import color, appearance, behavior
+from pycmd.pycmd_public import color, appearance, behavior, prompt_updates
 from pycmd.common import apply_settings, sanitize_settings
 from pycmd.common import debug
 
@@ -30,9 +34,12 @@ state_command = None
 state_chat = None
 state = None
 dir_hist = None
+command_history_file = None
+chat_history_file = None
+dir_history_file = None
 pushd_stack = []
 tmpfile = None
-save_history_limit = 2000
+line_renderer = LineRenderer()
 
 def init():
     # Create temporary file
@@ -47,19 +54,22 @@ def deinit():
     if os.path.isfile(tmpfile):
         os.remove(tmpfile)
     if sys.platform == 'linux':
+        sys.stdout.flush()
         os.system('reset -I')
 
 def init_state():
     # State of the "command" input (prompt, entered chars, history)
-    global state_command
+    global state_command, command_history_file
     state_command = InputState()
-    state_command.history.list = read_history(pycmd_data_dir + '/history')
+    command_history_file = HistoryFile(pycmd_data_dir + '/history', behavior.history_limit)
+    state_command.history.list = command_history_file.read()
 
     # State of the "chat" input (prompt, entered chars, history)
-    global state_chat
+    global state_chat, chat_history_file
     state_chat = InputState()
+    chat_history_file = HistoryFile(pycmd_data_dir + '/chat_history', behavior.history_limit)
     if behavior.chat.template:
-        state_chat.history.list = read_history(pycmd_data_dir + '/chat_history')
+        state_chat.history.list = chat_history_file.read()
 
     # Start in command mode
     global state
@@ -67,9 +77,10 @@ def init_state():
 
 def init_dir_history():
     # Read/initialize directory history
-    global dir_hist
+    global dir_hist, dir_history_file
     dir_hist = DirHistory()
-    dir_hist.locations = read_history(pycmd_data_dir + '/dir_history')
+    dir_history_file = HistoryFile(pycmd_data_dir + '/dir_history', dir_hist.max_len)
+    dir_hist.locations = dir_history_file.read()
     dir_hist.index = len(dir_hist.locations) - 1
     dir_hist.visit_cwd()
 
@@ -88,7 +99,7 @@ def main():
         run_command(['echo', '>', 'NUL'])
     else:
         # Start a bash instance and control its pty
-        pty_control.start(env_dump_file=tmpfile)
+        pty_control.start()
         
     # Parse arguments
     arg = 1
@@ -169,6 +180,12 @@ def main():
     global state
     while True:
         # Prepare buffer for reading one line
+        if behavior.share_history:
+            sync_history(state_command.history, command_history_file)
+            if behavior.chat.template:
+                sync_history(state_chat.history, chat_history_file)
+        completion_engine.cancel()
+        prompt_updates.next_prompt()
         prompt = appearance.prompt()
         state_command.reset_line(prompt)
         pre, _, post = prompt.rpartition('>')
@@ -195,9 +212,8 @@ def main():
                 cursor_height = 10
 
             if state.changed() or force_repaint:
-                prev_total_len = len(remove_escape_sequences(state.prev_prompt) + state.prev_before_cursor + state.prev_after_cursor + state.prev_suggestion)
+                prev_line = (state.prev_prompt, state.prev_before_cursor, state.prev_after_cursor, state.prev_suggestion)
                 set_cursor_attributes(cursor_height, False)
-                cursor_backward(len(remove_escape_sequences(state.prev_prompt) + state.prev_before_cursor))
 
                 # Switch state if needed
                 if state != change_state:
@@ -206,37 +222,28 @@ def main():
                     state.reset_selection()
 
                 # Write current line
-                stdout.write(u'\r' + color.Fore.DEFAULT + color.Back.DEFAULT + appearance.colors.prompt +
-                          state.prompt +
-                          color.Fore.DEFAULT + color.Back.DEFAULT + appearance.colors.text)
+                text = (color.Fore.DEFAULT + color.Back.DEFAULT + appearance.colors.prompt +
+                        state.prompt +
+                        color.Fore.DEFAULT + color.Back.DEFAULT + appearance.colors.text)
                 line = state.line
                 if state.history.filter == '':
                     sel_start, sel_end = state.get_selection_range()
-                    stdout.write(line[:sel_start] +
-                                 appearance.colors.selection +
-                                 line[sel_start: sel_end] +
-                                 color.Fore.DEFAULT + color.Back.DEFAULT + appearance.colors.text +
-                                 line[sel_end:])
-                    stdout.write(appearance.colors.suggestion + state.suggestion + color.Fore.DEFAULT + color.Back.DEFAULT + appearance.colors.text)
+                    text += (line[:sel_start] +
+                             appearance.colors.selection +
+                             line[sel_start: sel_end] +
+                             color.Fore.DEFAULT + color.Back.DEFAULT + appearance.colors.text +
+                             line[sel_end:])
+                    text += appearance.colors.suggestion + state.suggestion + color.Fore.DEFAULT + color.Back.DEFAULT + appearance.colors.text
                 else:
                     pos = 0
-                    colored_line = ''
                     for (start, end) in state.history.current()[1]:
-                        colored_line += color.Fore.DEFAULT + color.Back.DEFAULT + appearance.colors.text + line[pos : start]
-                        colored_line += appearance.colors.search_filter + line[start : end]
+                        text += color.Fore.DEFAULT + color.Back.DEFAULT + appearance.colors.text + line[pos : start]
+                        text += appearance.colors.search_filter + line[start : end]
                         pos = end
-                    colored_line += color.Fore.DEFAULT + color.Back.DEFAULT + appearance.colors.text + line[pos:]
-                    stdout.write(colored_line)
-
-                # Erase remaining chars from old line
-                to_erase = prev_total_len - len(remove_escape_sequences(state.prompt) + state.line + state.suggestion)
-                if to_erase > 0:
-                    stdout.write(color.Fore.DEFAULT + color.Back.DEFAULT + ' ' * to_erase)
-                    cursor_backward(to_erase)
-
-                # Move cursor to the correct position
+                    text += color.Fore.DEFAULT + color.Back.DEFAULT + appearance.colors.text + line[pos:]
+                line_renderer.render(text, (state.prompt, state.before_cursor, state.after_cursor, state.suggestion),
+                                     prev_line)
                 set_cursor_attributes(cursor_height, True)
-                cursor_backward(len(state.after_cursor + state.suggestion))
 
             # Bell if a notification is pending
             if state.bell:
@@ -246,6 +253,19 @@ def main():
             # Prepare new input state
             state.step_line()
 
+            # Get ready for a Tab press while waiting for the user
+            if state == state_command and state.before_cursor:
+                completion_engine.prefetch(state.before_cursor)
+
+            # Redraw the prompt in place if the parts of it that are computed
+            # in the background (e.g. the git status) change while we wait
+            if not scrolling and wait_prompt_update():
+                prompt = appearance.prompt()
+                state_command.prompt = prompt
+                pre, _, post = prompt.rpartition('>')
+                state_chat.prompt = pre + '?' + post
+                continue
+
             # Read and process a keyboard event
             rec = read_input()
             select = auto_select or is_shift_pressed(rec)
@@ -281,10 +301,11 @@ def main():
                         auto_select = False
                 elif rec.VirtualKeyCode == 76:          # Ctrl-L
                     console.clear_screen()
+                    line_renderer.invalidate()
                     force_repaint = True
                 elif rec.VirtualKeyCode == 82:          # Ctrl-R
                     w = Window(state.history.list, pattern=re.compile('(.*)$'),
-                               height=optimal_window_height())
+                               height=optimal_window_height(), history=True)
                     w.display()
                     w.filter = state.history.filter if state.history.filter else state.line
                     action, selection = w.interact(default_selection_last=True, can_zap=True)
@@ -295,7 +316,7 @@ def main():
                         state.history.reset()
                     elif action == 'zap':
                         state.zap(selection)
-                        update_history('remove', selection, pycmd_data_dir + ('/history' if state == state_command else '/chat_history'), save_history_limit)
+                        (command_history_file if state == state_command else chat_history_file).remove(selection)
                 elif rec.VirtualKeyCode == 65:          # Ctrl-A
                     state.handle(ActionCode.ACTION_HOME, select)
                 elif rec.VirtualKeyCode == 69:          # Ctrl-E
@@ -410,7 +431,7 @@ def main():
                 # Left-Ctrl + Right-Alt with rec.Char != '\0' typically comes from an AltGr-combo
                 not (is_left_ctrl_pressed(rec) and is_right_alt_pressed(rec) and rec.Char != '\0' )):  # Ctrl-Alt-Something
                 if rec.VirtualKeyCode == 75:                # Ctrl-Alt-K
-                    update_history('remove', state.line, pycmd_data_dir + ('/history' if state == state_command else '/chat_history'), save_history_limit)
+                    (command_history_file if state == state_command else chat_history_file).remove(state.line)
                     state.handle(ActionCode.ACTION_ZAP)
                 elif rec.VirtualKeyCode == 73:              # Ctrl-Alt-I
                     if state.line or not behavior.chat.template:
@@ -465,12 +486,13 @@ def main():
                         break
                     state.history.reset()
                     if state == state_chat:
+                        line_renderer.invalidate()
                         set_cursor_attributes(cursor_height, False)
                         stdout.write(state.after_cursor)
                         stdout.write(' ' * len(state.suggestion))
                         cursor_backward(len(state.suggestion))
                         state.history.add(state.line.strip())
-                        update_history('add', state.history.list[-1], pycmd_data_dir + '/chat_history', save_history_limit)
+                        chat_history_file.add(state.line.strip())
                         chat = copy.deepcopy(behavior.chat.template)
                         try:
                             response = run_with_busy_indicator(lambda: chat.chat(state.line, echo='none'))
@@ -512,9 +534,11 @@ def main():
                             debug('Tab bell input_processed.set')
                             pty_control.input_processed.set()
                         continue
+                    line_renderer.invalidate()
                     set_cursor_attributes(cursor_height, False)
                     prev_len = len(state.line)
-                    (completed, suggestions) = run_with_busy_indicator(lambda: complete_universal(state.before_cursor))
+                    (completed, suggestions) = (completion_engine.result(state.before_cursor, timeout=0) or
+                                                run_with_busy_indicator(lambda: completion_engine.result(state.before_cursor)))
                     stdout.write(state.after_cursor + ' ' * len(state.suggestion))
                     cursor_backward(len(state.suggestion) + len(state.after_cursor) + len(state.before_cursor))
                     completed, state.after_cursor = adjust_completion(completed, state.after_cursor, len(suggestions) == 1)
@@ -537,7 +561,7 @@ def main():
                         state.bell = True
                     elif len(suggestions) > 1:
                         # Multiple completions possible
-                        tokens = tokenize(state.before_cursor)
+                        tokens = state.tokens
                         path_sep = '/' if '/' in expand_env_vars(tokens[-1]) else os.sep
                         if tokens[-1]:
                             # Tokenize again in case the original line has been appended to
@@ -596,8 +620,6 @@ def main():
                                 cursor_backward(len(state.after_cursor) + len(state.suggestion))
                                 action, selection = w.interact()
                                 if action == 'select' and selection:
-                                    orig_last_token = tokenize(state.before_cursor)[-1]
-
                                     # Replace initial completion prefix with selection
                                     pos = state.before_cursor.lower().rfind(prefix.lower())
                                     state.before_cursor = (state.before_cursor[:pos]
@@ -615,10 +637,8 @@ def main():
                 elif rec.Char == chr(8):                # Backspace
                     state.handle(ActionCode.ACTION_BACKSPACE)
                 else:                                   # Regular character
-                    tokens_before = tokenize(state.before_cursor)
                     state.handle(ActionCode.ACTION_INSERT, rec.Char)
-                    tokens_after = tokenize(state.before_cursor)
-                    
+
             if sys.platform == 'linux':
                 debug('Step input_processed.set')
                 pty_control.input_processed.set()
@@ -640,10 +660,8 @@ def main():
             run_command(tokens)
 
         # Add to history
-        state.history.add(line.strip())
-        update_history('add', state.history.list[-1],
-                       pycmd_data_dir + '/history',
-                       save_history_limit)
+        state.history.add(line)
+        command_history_file.add(line)
 
         # Add to dir history
         dir_hist.visit_cwd()
@@ -708,6 +726,7 @@ def run_command(tokens):
 
 def run_command_linux(tokens):
     #print('Running', tokens)
+    sys.stdout.flush()
     pty_control.command_completed.clear()
     pty_control.command_to_run = ' '.join(tokens)
     pty_control.pass_through = True
@@ -722,23 +741,11 @@ def run_command_linux(tokens):
     # print(f'Captured[{captured_prompt}]')
     curdir, exit_code = pty_control.captured_prompt.split('|')
     os.chdir(curdir)
-    os.environ['ERRORLEVEL'] = exit_code
 
-    # Update environment and state
-    new_environ = {}
-    env_file = open(tmpfile, 'r')
-    for line in [l for l in env_file.readlines() if not l.isspace()]:
-        [variable, value] = line.split('=', 1)
-        value = value.rstrip('\n ')
-        new_environ[variable] = value
-    env_file.close()
-    if new_environ != {}:
-        for variable in os.environ.keys():
-            if not variable in new_environ.keys() and variable != 'ERRORLEVEL':
-                del os.environ[variable]
-        for variable in new_environ:
-            if variable != 'ERRORLEVEL':
-                os.environ[variable] = new_environ[variable]
+    # Update environment with the variables changed in bash
+    changes = pty_control.take_env_changes()
+    changes['ERRORLEVEL'] = exit_code
+    env_sync.apply(changes)
 
 
 def run_command_win(tokens):
@@ -900,13 +907,11 @@ def run_in_cmd(tokens):
         pushd_stack.append(lines[i])
         i += 1
 
-    if new_environ != {}:
-        for variable in os.environ.keys():
-            if not variable in new_environ.keys() \
-                   and sorted(new_environ.keys()) != sorted(pseudo_vars):
-                del os.environ[variable]
-        for variable in new_environ:
-            os.environ[variable] = new_environ[variable]
+    if sorted(new_environ.keys()) == sorted(pseudo_vars):
+        # Only got the pseudo-variables, leave the others alone
+        env_sync.apply(new_environ)
+    elif new_environ != {}:
+        env_sync.update(new_environ)
     cd = os.environ['CD']
     os.chdir(cd.encode(sys.getfilesystemencoding()))
 
@@ -920,6 +925,19 @@ def signal_handler(signum, frame):
         # Emulate a Ctrl-C press
         write_input(67, u'c', 0x0008)
 
+def wait_prompt_update():
+    """
+    Wait for input while some parts of the prompt are computed in the
+    background; return True as soon as they have changed the prompt
+    """
+    while prompt_updates.pending():
+        if prompt_updates.take_changed():
+            return True
+        if input_ready(0.05):
+            return False
+    return False
+
+
 def optimal_window_height():
     _, viewport_top, _, viewport_bottom  = get_viewport()
     window_height = viewport_bottom - get_cursor()[1] - 2
@@ -928,54 +946,21 @@ def optimal_window_height():
     return window_height
 
 
-def update_history(action, line, filename, length):
-    """
-    Append/remove a line to/from a history file.  
-    When adding, if the line was already present in the file, we move it to
-    the end. The resulting file is then truncated to the specified number of 
-    lines.
-    """
-    if os.path.isfile(filename):
-        # Read previously saved history and merge with current
-        history_file = open(filename, 'r', encoding='utf8', errors='replace')
-        history_to_save = [l.rstrip(u'\r\n') for l in history_file]
-        history_file.close()
-        if line in history_to_save:
-            history_to_save.remove(line)
-        if action == 'add':
-            history_to_save.append(line)
-    else:
-        # No previous history, save current (only if adding)
-        history_to_save = [line] if action == 'add' else []
-
-    if len(history_to_save) > length:
-        history_to_save = history_to_save[-length :]    # Limit history file
-
-    # Write merged history to history file
-    history_file = open(filename, 'w', encoding='utf8')
-    history_file.writelines([l + '\n' for l in history_to_save])
-    history_file.close()
-
-
-def read_history(filename):
-    """
-    Read and return a list of lines from a history file
-    """
-    if os.path.isfile(filename):
-        history_file = open(filename, 'r', encoding='utf8', errors='replace')
-        history = [line.rstrip('\r\n') for line in history_file]
-        history_file.close()
-    else:
-        print('Warning: Can\'t open ' + os.path.basename(filename) + '!')
-        history = []
-    return history
-
+def sync_history(history, history_file):
+    """Merge the entries added/removed by other PyCmd sessions into a history"""
+    records = history_file.read_new()
+    if records is None:
+        # The history file has been compacted, we need to read it all again
+        history.list = history_file.read()
+        return
+    for record in records:
+        if record.startswith(TOMBSTONE):
+            history.zap(record[len(TOMBSTONE):])
+        elif record:
+            history.add(record)
 
 def update_dir_history():
-    update_history('add',
-                   dir_hist.locations[-1],
-                   pycmd_data_dir + '/dir_history',
-                   dir_hist.max_len)
+    dir_history_file.add(dir_hist.locations[-1])
     
 def run_with_busy_indicator(func):
     """Run a function while showing a progress indicator"""
@@ -989,11 +974,13 @@ def run_with_busy_indicator(func):
         while True:
             sys.stdout.write('\u00b7' if visible else ' ')
             move_cursor(x, y)
+            sys.stdout.flush()
             stop_event.wait(0.2)
             if stop_event.is_set():
                 if visible:
                     sys.stdout.write(' ')
                     move_cursor(x, y)
+                    sys.stdout.flush()
                 break
             visible = not visible
 
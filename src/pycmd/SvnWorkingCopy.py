@@ -0,0 +1,112 @@
+import os, hashlib
+from urllib.request import pathname2url
+try:
+    import sqlite3
+except ImportError:
+    # Some Python builds come without sqlite; svn is then always run
+    sqlite3 = None
+
+
+# Formats of .svn/wc.db (PRAGMA user_version) understood here: 29 is used by
+# svn 1.7, 31 by svn 1.8 up to 1.14
+SUPPORTED_FORMATS = (29, 30, 31)
+
+# Properties that make the working files differ from the pristine ones
+# (line endings, expanded keywords, symlinks stored as files)
+TRANSLATION_PROPS = (b'svn:eol-style', b'svn:keywords', b'svn:special')
+
+
+class Unsupported(Exception):
+    """The working copy is in a state that is not handled here; ask svn instead"""
+
+
+class SvnWorkingCopy(object):
+    """
+    Read the status of a Subversion working copy (1.7 or newer) directly
+    from its .svn/wc.db database, without running svn.
+
+    Scheduled changes (additions, deletions, copies, moves), property
+    changes and conflicts are recorded in the database. Text modifications
+    are found like svn does: by comparing the size and mtime of each file
+    with the recorded ones and, if they differ, the checksum of the file
+    with the pristine one.
+
+    Unsupported is raised when svn should be asked instead (older or newer
+    working copy formats, pending work queue items, files whose contents
+    are translated, locked databases etc.).
+    """
+
+    def __init__(self, wc_root):
+        self.wc_root = wc_root
+        self.db_path = os.path.join(wc_root, '.svn', 'wc.db')
+
+    def is_dirty(self):
+        """Whether the working copy has local changes (as shown by svn status -q)"""
+        if sqlite3 is None:
+            raise Unsupported('no sqlite3 module')
+        if not os.path.isfile(self.db_path):
+            raise Unsupported('no wc.db')
+        try:
+            db = sqlite3.connect('file:%s?mode=ro' % pathname2url(self.db_path), uri=True, timeout=0.5)
+        except sqlite3.Error as e:
+            raise Unsupported(str(e))
+        try:
+            return self._is_dirty(db)
+        except sqlite3.Error as e:
+            raise Unsupported(str(e))
+        finally:
+            db.close()
+
+    def _is_dirty(self, db):
+        (db_format,) = db.execute('PRAGMA user_version').fetchone()
+        if db_format not in SUPPORTED_FORMATS:
+            raise Unsupported('working copy format %d' % db_format)
+        if db.execute('SELECT 1 FROM work_queue LIMIT 1').fetchone():
+            # An interrupted operation, the database might not match the files
+            raise Unsupported('svn cleanup needed')
+
+        # Added, deleted, copied, moved or replaced nodes
+        if db.execute('SELECT 1 FROM nodes WHERE op_depth > 0 LIMIT 1').fetchone():
+            return True
+        # Property changes, text/property/tree conflicts
+        if db.execute('SELECT 1 FROM actual_node WHERE properties IS NOT NULL'
+                      ' OR conflict_data IS NOT NULL OR conflict_old IS NOT NULL'
+                      ' OR conflict_working IS NOT NULL OR prop_reject IS NOT NULL'
+                      ' LIMIT 1').fetchone():
+            return True
+
+        for (relpath, kind, props, checksum, size, mtime) in db.execute(
+                "SELECT local_relpath, kind, properties, checksum, translated_size, last_mod_time"
+                " FROM nodes WHERE op_depth = 0 AND presence = 'normal' AND file_external IS NULL"):
+            if self._node_changed(relpath, kind, props, checksum, size, mtime):
+                return True
+        return False
+
+    def _node_changed(self, relpath, kind, props, checksum, size, mtime):
+        """Whether the working file (or dir) of a node is missing or modified"""
+        path = os.path.join(self.wc_root, *relpath.split('/')) if relpath else self.wc_root
+        try:
+            st = os.lstat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            # Missing
+            return True
+        if kind == 'dir':
+            return not os.path.isdir(path)
+        if kind != 'file':
+            raise Unsupported('%s node %s' % (kind, relpath))
+        if (size is not None and mtime is not None
+            and st.st_size == size and st.st_mtime_ns // 1000 == mtime):
+            return False
+
+        # The recorded size/mtime are not conclusive, compare the contents
+        if props and any(prop in props for prop in TRANSLATION_PROPS):
+            raise Unsupported('translated file %s' % relpath)
+        if not checksum or not checksum.startswith('$sha1$'):
+            raise Unsupported('checksum of %s' % relpath)
+        if size is not None and st.st_size != size:
+            return True
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                sha1.update(chunk)
+        return sha1.hexdigest() != checksum[len('$sha1$'):]
@@ -3,7 +3,7 @@ from pycmd.console import read_input, erase_to, is_ctrl_pressed, is_alt_pressed
 from pycmd.pycmd_public import color, appearance
 from math import log10, ceil
 from sys import stdout
-from pycmd.common import fuzzy_match
+from pycmd.common import FuzzyMatcher
 import sys
 from pycmd.common import debug
 if sys.platform == 'linux':
@@ -11,8 +11,12 @@ if sys.platform == 'linux':
 
 
 class Window(object):
-    def __init__(self, entries, pattern, width=0, height=0):
+    def __init__(self, entries, pattern, width=0, height=0, history=False):
         self.all_entries = entries
+        # Entries of a history (oldest first) are ranked with a preference for
+        # the recent ones, and the most relevant are shown last (nearest to
+        # the default selection)
+        self.history = history
         self.pattern = pattern
         self.width = width if width else get_buffer_size()[0]
         self.height = height
@@ -22,6 +26,17 @@ class Window(object):
         self.selected_column = None
         self.orig_cursor = self.final_cursor = get_cursor()
         self.max_lines = self.num_lines = 0
+
+        # Results of the successive filters, each narrowing down the previous
+        # one: list of (filter, ranked indices of the matches, entries)
+        self._filter_results = []
+
+        # Spans of the pattern matches in the displayed strings
+        self._match_spans = {}
+
+        # Rows as drawn by the last display(), unchanged rows are skipped
+        self._drawn_rows = []
+
         self.filter = ''
         if self.height == 0 or self.height > self.num_lines:
             self.height = self.num_lines
@@ -37,7 +52,7 @@ class Window(object):
         self._filter =  ' '.join(value.split())
         if value.endswith(' '):
             self._filter += ' '
-        self.entries = [e for e in self.all_entries if fuzzy_match(self.filter, e)]
+        self.entries = self._filter_entries(self._filter)
         
         self.column_width = max([len(e) for e in self.entries]) + 10 if self.entries else 1
         if self.column_width > self.width - 1:
@@ -68,6 +83,28 @@ class Window(object):
             self._center_on_selection()
 
 
+    def _filter_entries(self, filter):
+        """
+        Return the entries matching a filter, sorted by relevance; when the
+        filter extends a previous one (e.g. one more char was typed), only
+        the entries that matched the previous filter need to be checked again
+        """
+        results = self._filter_results
+        while results and not filter.startswith(results[-1][0]):
+            results.pop()
+        if results and results[-1][0] == filter:
+            return results[-1][2]
+        ranked = FuzzyMatcher(filter).rank(self.all_entries, self.history,
+                                           results[-1][1] if results else None)
+        entries = [self.all_entries[i] for i in ranked]
+        if self.history and filter.strip():
+            # Most relevant last, next to the command line (an empty filter
+            # keeps the history in its order, the most recent last)
+            entries.reverse()
+        results.append((filter, ranked, entries))
+        return entries
+
+
     def shorten(self, s):
             half_len = self.width // 2 - 2
             return s if len(s) < self.width else s[0:half_len] + '\u00b7' * 3 + s[len(s) - half_len:]
@@ -77,30 +114,14 @@ class Window(object):
         set_cursor_attributes(10, False)
         default_color = color.Fore.DEFAULT + color.Back.DEFAULT
         stdout.write('\n')
-        for line in range(self.offset, self.offset + self.height):
-            # Print one line
-            stdout.write('\r')
-            for column in range(0, self.num_columns):
-                if line < self.num_lines and line + column * self.num_lines < len(self.entries):
-                    s = self.shorten(self.entries[line + column * self.num_lines])
-                    if self.selected_line == line and self.selected_column == column:
-                        # Highlight selected line
-                        stdout.write(appearance.colors.selection + s + default_color)
-                    else:
-                        # Print wildcard matches in a different color
-                        match = self.pattern.match(s)
-                        current_index = 0
-                        for i in range(1, match.lastindex + 1):
-                            stdout.write(default_color +
-                                         appearance.colors.completion_match +
-                                         s[current_index : match.start(i)] +
-                                         default_color +
-                                         s[match.start(i) : match.end(i)])
-                            current_index = match.end(i)
-                    stdout.write(default_color + ' ' * (self.column_width - len(s)))
-                else:
-                    stdout.write(default_color + ' ' * (self.column_width))                    
-            stdout.write('\n\r')
+        rows = [self._format_row(line, default_color) for line in range(self.offset, self.offset + self.height)]
+        for (i, row) in enumerate(rows):
+            if i < len(self._drawn_rows) and self._drawn_rows[i] == row:
+                # Already on the screen, skip it
+                stdout.write('\n\r')
+            else:
+                stdout.write('\r' + row + '\n\r')
+        self._drawn_rows = rows
 
         if self.height < self.max_lines:
             format_width = int(ceil(log10(self.max_lines)))
@@ -124,6 +145,40 @@ class Window(object):
         set_cursor_attributes(10, True)
 
 
+    def _format_row(self, line, default_color):
+        """Format one line of the window, including the color codes"""
+        row = ''
+        for column in range(0, self.num_columns):
+            if line < self.num_lines and line + column * self.num_lines < len(self.entries):
+                s = self.shorten(self.entries[line + column * self.num_lines])
+                if self.selected_line == line and self.selected_column == column:
+                    # Highlight selected line
+                    row += appearance.colors.selection + s + default_color
+                else:
+                    # Print wildcard matches in a different color
+                    current_index = 0
+                    for (start, end) in self._get_match_spans(s):
+                        row += (default_color +
+                                appearance.colors.completion_match +
+                                s[current_index : start] +
+                                default_color +
+                                s[start : end])
+                        current_index = end
+                row += default_color + ' ' * (self.column_width - len(s))
+            else:
+                row += default_color + ' ' * (self.column_width)
+        return row
+
+
+    def _get_match_spans(self, s):
+        """Spans of the groups in the match of the pattern, computed once per string"""
+        spans = self._match_spans.get(s)
+        if spans is None:
+            match = self.pattern.match(s)
+            spans = self._match_spans[s] = [match.span(i) for i in range(1, match.lastindex + 1)]
+        return spans
+
+
     def reset_cursor(self):
         move_cursor(self.orig_cursor[0], self.orig_cursor[1])
     
@@ -133,6 +188,7 @@ class Window(object):
         stdout.write('\n')  # Don't erase original line as we did not touch it
         erase_to(self.final_cursor)
         self.reset_cursor()
+        self._drawn_rows = []
 
             
     def interact(self, initial_index=None, default_selection_last=False, can_zap=False):
@@ -3,7 +3,7 @@
 #
 import os, string, mmap, sys, traceback, threading
 import re
-from pycmd import fsm
+from functools import lru_cache
 
 # Stop points when navigating one word at a time
 word_sep = [' ', '\t', '\\', '-', '_', '.', '/', '$', '&', '=', '+', '@', ':', ';', '"']
@@ -36,102 +36,239 @@ exec_extensions = os.environ['PATHEXT'].lower().split(os.pathsep) if sys.platfor
 # Pseudo environment variables
 pseudo_vars = ['CD', 'DATE', 'ERRORLEVEL', 'RANDOM', 'TIME']
 
-def parse_line(line):
-    """Tokenize a command line based on whitespace while observing quotes"""
-
-    def accumulate(fsm):
-        """Action: add current symbol to last token in list."""
-        fsm.memory[-1] = fsm.memory[-1] + fsm.input_symbol
-
-    def start_empty_token(fsm):
-        """Action: start a new token."""
-        if fsm.memory[-1] != '':
-            fsm.memory.append('')
-
-    def start_token(fsm):
-        """Action: start a new token and accumulate."""
-        start_empty_token(fsm)
-        accumulate(fsm)
+# Tokenizer states
+(TOK_INIT, TOK_WHITESPACE, TOK_IN_STRING, TOK_PIPE, TOK_AMP, TOK_GT,
+ TOK_REDIR, TOK_AWAITING_AMP, TOK_AWAITING_NR, TOK_ESCAPE) = range(10)
 
-    def accumulate_last(fsm):
-        """Action: accumulate and start new token."""
-        accumulate(fsm)
-        start_empty_token(fsm)
+def _build_tokenizer_table():
+    """
+    Compile the tokenizer state machine into a transition table.
 
-    def error(fsm):
-        """Action: handle uncovered transition (should never happen)."""
-        print('Unhandled transition:', (fsm.input_symbol, fsm.current_state))
-        accumulate(fsm)
+    The machine is described in terms of the same primitives the original
+    (fsm.FSM-based) parser used: exact transitions, "any" transitions and
+    non-consuming (empty) transitions. Empty transitions are resolved here,
+    once, so that the scanner only does one table lookup per character.
 
-    f = fsm.FSM('init', [''])
+    Each table entry is a (flush_before, accumulate, flush_after, next_state)
+    tuple; "flush" means "start a new (empty) token if the current one is
+    not empty".
+    """
+    start_empty_token = (True, False, False)
+    accumulate = (False, True, False)
+    start_token = (True, True, False)
+    accumulate_last = (False, True, True)
 
-    f.set_default_transition(error, 'init')
+    exact = {}
+    def add(symbols, state, action, next_state):
+        for symbol in symbols:
+            exact[(symbol, state)] = (action, next_state)
 
     # default
-    f.add_transition_list(string.whitespace, 'init', start_empty_token, 'whitespace')
-    f.add_transition('"', 'init', accumulate, 'in_string')
-    f.add_transition('|', 'init', start_token, 'pipe')
-    f.add_transition('&', 'init', start_token, 'amp')
-    f.add_transition('>', 'init', start_token, 'gt')
-    f.add_transition('<', 'init', accumulate, 'awaiting_&')
-    f.add_transition('^', 'init', accumulate, 'escape')
-    f.add_transition_list(string.digits, 'init', accumulate, 'redir')
-    f.add_transition_any('init', accumulate, 'init')
-
+    add(string.whitespace, TOK_INIT, start_empty_token, TOK_WHITESPACE)
+    add('"', TOK_INIT, accumulate, TOK_IN_STRING)
+    add('|', TOK_INIT, start_token, TOK_PIPE)
+    add('&', TOK_INIT, start_token, TOK_AMP)
+    add('>', TOK_INIT, start_token, TOK_GT)
+    add('<', TOK_INIT, accumulate, TOK_AWAITING_AMP)
+    add('^', TOK_INIT, accumulate, TOK_ESCAPE)
+    add(string.digits, TOK_INIT, accumulate, TOK_REDIR)
     # whitespace
-    f.add_transition_list(string.whitespace, 'whitespace', None, 'whitespace')
-    f.add_empty_transition('whitespace', 'init')
-
+    add(string.whitespace, TOK_WHITESPACE, None, TOK_WHITESPACE)
     # strings
-    f.add_transition('"', 'in_string', accumulate, 'init')
-    f.add_transition_any('in_string', accumulate, 'in_string')
-
+    add('"', TOK_IN_STRING, accumulate, TOK_INIT)
     # seen '|'
-    f.add_transition('|', 'pipe', accumulate_last, 'init')
-    f.add_empty_transition('pipe', 'init', start_empty_token)
-
+    add('|', TOK_PIPE, accumulate_last, TOK_INIT)
     # seen '&'
-    f.add_transition('&', 'amp', accumulate_last, 'init')
-    f.add_empty_transition('amp', 'init', start_empty_token)
-
+    add('&', TOK_AMP, accumulate_last, TOK_INIT)
     # seen '>' or '1>' etc.
-    f.add_transition('>', 'gt', accumulate, 'awaiting_&')
-    f.add_transition('&', 'gt', accumulate, 'awaiting_nr')
-    f.add_empty_transition('gt', 'init', start_empty_token)
-
+    add('>', TOK_GT, accumulate, TOK_AWAITING_AMP)
+    add('&', TOK_GT, accumulate, TOK_AWAITING_NR)
     # seen digit
-    f.add_transition('<', 'redir', accumulate, 'awaiting_&')
-    f.add_transition('>', 'redir', accumulate, 'gt')
-    f.add_empty_transition('redir', 'init')
-
+    add('<', TOK_REDIR, accumulate, TOK_AWAITING_AMP)
+    add('>', TOK_REDIR, accumulate, TOK_GT)
     # seen '<' or '>>', '0<', '2>>' etc.
-    f.add_transition('&', 'awaiting_&', accumulate, 'awaiting_nr')
-    f.add_empty_transition('awaiting_&', 'init', start_empty_token)
-
+    add('&', TOK_AWAITING_AMP, accumulate, TOK_AWAITING_NR)
     # seen '<&' or '>&', '>>&', '0<&', '1>&', '2>>&' etc.
-    f.add_transition_list(string.digits, 'awaiting_nr', accumulate_last, 'init')
-    f.add_empty_transition('awaiting_nr', 'init', start_empty_token)
+    add(string.digits, TOK_AWAITING_NR, accumulate_last, TOK_INIT)
+
+    # Transitions on any other symbol
+    any_symbol = {
+        TOK_INIT: (accumulate, TOK_INIT),
+        TOK_IN_STRING: (accumulate, TOK_IN_STRING),
+        TOK_ESCAPE: (accumulate, TOK_INIT),
+    }
+
+    # Transitions that fall through to another state without consuming input
+    empty = {
+        TOK_WHITESPACE: (None, TOK_INIT),
+        TOK_PIPE: (start_empty_token, TOK_INIT),
+        TOK_AMP: (start_empty_token, TOK_INIT),
+        TOK_GT: (start_empty_token, TOK_INIT),
+        TOK_REDIR: (None, TOK_INIT),
+        TOK_AWAITING_AMP: (start_empty_token, TOK_INIT),
+        TOK_AWAITING_NR: (start_empty_token, TOK_INIT),
+    }
+
+    no_action = (False, False, False)
+
+    def resolve(symbol, state):
+        if (symbol, state) in exact:
+            action, next_state = exact[(symbol, state)]
+        elif state in any_symbol:
+            action, next_state = any_symbol[state]
+        else:
+            pre_action, fallback_state = empty[state]
+            action, next_state = resolve(symbol, fallback_state)
+            if pre_action:
+                action = tuple(a or b for a, b in zip(pre_action, action))
+        return (action or no_action), next_state
+
+    def entry(symbol, state):
+        action, next_state = resolve(symbol, state)
+        return action + (next_state,)
+
+    special_symbols = set(symbol for symbol, _ in exact)
+    states = range(TOK_ESCAPE + 1)
+    table = [{symbol: entry(symbol, state) for symbol in special_symbols} for state in states]
+    # '\0' is not special in any state, so it stands for "any other symbol"
+    defaults = [entry('\0', state) for state in states]
+    return table, defaults
 
-    # seen '^'
-    f.add_transition_any('escape', accumulate, 'init')
+_tokenizer_table, _tokenizer_defaults = _build_tokenizer_table()
 
-    f.process_list(line)
-    if len(f.memory) > 0 and f.memory[-1] == '':
-        del f.memory[-1]
 
-    return f.memory
+def scan_tokens(line, spans, pos=0, state=TOK_INIT, token_start=0, token_end=0, checkpoints=None):
+    """
+    Run the tokenizer over line[pos:], appending the (start, end) spans of the
+    completed tokens to spans. The current (possibly empty) token is given by
+    line[token_start:token_end]; it is returned, together with the final
+    state, so that scanning can be resumed later on.
+
+    If a checkpoints list is given, a (pos, state, token_start, token_end,
+    len(spans)) tuple is appended to it each time a token is completed; any
+    of these can be used to resume scanning from the given position.
+    """
+    table = _tokenizer_table
+    defaults = _tokenizer_defaults
+    for i in range(pos, len(line)):
+        flush_before, accumulate, flush_after, next_state = table[state].get(line[i]) or defaults[state]
+        if flush_before and token_end > token_start:
+            if checkpoints is not None:
+                checkpoints.append((i, state, token_start, token_end, len(spans)))
+            spans.append((token_start, token_end))
+            token_start = token_end
+        if accumulate:
+            if token_end == token_start:
+                token_start = i
+            token_end = i + 1
+            if flush_after:
+                spans.append((token_start, token_end))
+                token_start = token_end
+                if checkpoints is not None:
+                    checkpoints.append((i + 1, next_state, token_start, token_end, len(spans)))
+        state = next_state
+    return state, token_start, token_end
+
+
+def parse_line_spans(line):
+    """Tokenize a command line and return the (start, end) spans of the tokens"""
+    spans = []
+    _, token_start, token_end = scan_tokens(line, spans)
+    if token_end > token_start:
+        spans.append((token_start, token_end))
+    return spans
+
+
+def parse_line(line):
+    """Tokenize a command line based on whitespace while observing quotes"""
+    return [line[start:end] for (start, end) in parse_line_spans(line)]
 
 
 def tokenize(line):
     """
     Wrapper for parse_line that appends an empty token if it detects a new token is beginning
     """
-    tokens = parse_line(line)
-    if tokens == [] or (line[-1] in sep_chars and parse_line(line) == parse_line(line + ' ')):
+    spans = []
+    state, token_start, token_end = scan_tokens(line, spans)
+    tokens = [line[start:end] for (start, end) in spans]
+    if token_end > token_start:
+        tokens.append(line[token_start:token_end])
+    # Appending a blank to the line only changes the tokens if the blank
+    # gets accumulated (e.g. inside quotes), so we just look that up
+    if tokens == [] or (line[-1] in sep_chars and not _tokenizer_table[state][' '][1]):
         tokens += ['']   # This saves us some checks later
     return tokens
 
 
+class IncrementalTokenizer:
+    """
+    Tokenizer for a line that changes only a little at a time (as the user
+    types, deletes or completes text).
+
+    Scanning resumes from the last token boundary that is still valid for
+    the new line instead of starting over, so the cost of re-tokenizing is
+    proportional to the size of the change rather than to the line length.
+    """
+
+    def __init__(self):
+        self.line = ''
+        self.spans = []
+        self.span_tokens = []
+        self.checkpoints = [(0, TOK_INIT, 0, 0, 0)]
+        self.state = TOK_INIT
+        self.token_start = 0
+        self.token_end = 0
+        self.tokens = ['']
+
+    def update(self, line):
+        """Re-synchronize with a new version of the line"""
+        if line == self.line:
+            return
+
+        if line.startswith(self.line):
+            # Text was appended, just carry on from where we stopped
+            pos, state, token_start, token_end = len(self.line), self.state, self.token_start, self.token_end
+        else:
+            common_len = common_prefix_len(line, self.line)
+            while self.checkpoints[-1][0] > common_len:
+                self.checkpoints.pop()
+            pos, state, token_start, token_end, num_spans = self.checkpoints[-1]
+            del self.spans[num_spans:]
+            del self.span_tokens[num_spans:]
+
+        self.state, self.token_start, self.token_end = scan_tokens(
+            line, self.spans, pos, state, token_start, token_end, self.checkpoints)
+        self.line = line
+
+        self.span_tokens.extend(line[start:end] for (start, end) in self.spans[len(self.span_tokens):])
+        tokens = list(self.span_tokens)
+        if self.token_end > self.token_start:
+            tokens.append(line[self.token_start:self.token_end])
+        if tokens == [] or (line[-1] in sep_chars and not _tokenizer_table[self.state][' '][1]):
+            tokens.append('')
+        self.tokens = tokens
+
+    def tokenize(self, line):
+        """
+        Equivalent of tokenize(line), reusing as much as possible of the
+        previous work; the returned list should not be modified
+        """
+        self.update(line)
+        return self.tokens
+
+
+def common_prefix_len(str1, str2):
+    """Compute the length of the longest common prefix of two strings"""
+    low, high = 0, min(len(str1), len(str2))
+    while low < high:
+        mid = (low + high + 1) // 2
+        if str1[low:mid] == str2[low:mid]:
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+
 def escape_special_chars_in_quotes(string):
     result = ''
     in_quotes = False
@@ -250,12 +387,88 @@ def fuzzy_match(substr, str, prefix_only = False):
     word boundaries in str.
     """
     #print('\n\nMatch "' + substr + '" in "' + str + '"\n\n')
+    return FuzzyMatcher(substr, prefix_only).match(str)
+
+@lru_cache(maxsize=64)
+def fuzzy_regex(substr, prefix_only = False):
+    """Compile the regular expression used by fuzzy_match()"""
     words = substr.split(' ')
-    pattern = [('\\b' if prefix_only else '') + '(' + re.escape(word) + ').*' for word in words]
+    # Non-greedy, so that each word is matched as early as possible
+    pattern = [('\\b' if prefix_only else '') + '(' + re.escape(word) + ').*?' for word in words]
     # print('\n\n', pattern, '\n\n')
     pattern = ''.join(pattern)
-    matches = re.search(pattern, str, re.IGNORECASE)
-    return [matches.span(i) for i in range(1, len(words) + 1)] if matches else []
+    return re.compile(pattern, re.IGNORECASE)
+
+# Weights of the criteria used when ranking fuzzy matches
+FUZZY_BOUNDARY_BONUS = 8    # for each word matched at a word boundary
+FUZZY_ADJACENT_BONUS = 4    # for each word matched right after the previous one
+FUZZY_MAX_GAP_PENALTY = 4   # for each word matched far from the previous one
+FUZZY_RECENCY_BONUS = 6     # for the most recent entry (less for older ones)
+FUZZY_LENGTH_PENALTY = 1    # for the longest unmatched rest of the string
+
+def fuzzy_score(str, spans, recency = 0):
+    """
+    Score the relevance of a fuzzy match, given the spans of the matched
+    words: words matched at word boundaries and next to each other score
+    higher, as do shorter strings; recency (between 0 and 1) favors the
+    more recent entries of a history.
+    """
+    score = FUZZY_RECENCY_BONUS * recency
+    matched = 0
+    prev_end = None
+    for (start, end) in spans:
+        if start == end:
+            continue
+        if (start == 0 or not str[start - 1].isalnum()
+            or (str[start - 1].islower() and str[start].isupper())):
+            score += FUZZY_BOUNDARY_BONUS
+        if prev_end is not None:
+            gap = start - prev_end
+            score += FUZZY_ADJACENT_BONUS if gap <= 1 else -min(gap, FUZZY_MAX_GAP_PENALTY)
+        prev_end = end
+        matched += end - start
+    return score - FUZZY_LENGTH_PENALTY * min(len(str) - matched, 32) / 32
+
+class FuzzyMatcher:
+    """
+    A fuzzy_match() filter, compiled once and matched against many strings
+    """
+    def __init__(self, substr, prefix_only = False):
+        self.substr = substr
+        self.regex = fuzzy_regex(substr, prefix_only)
+
+    def match(self, str):
+        """Return the spans of the matched words, or [] if str does not match"""
+        matches = self.regex.search(str)
+        return [matches.span(i) for i in range(1, self.regex.groups + 1)] if matches else []
+
+    def rank(self, entries, recency = False, indices = None):
+        """
+        Match a whole list of strings in one call; return the indices of the
+        matching entries, the most relevant first (see fuzzy_score()).
+
+        With recency, the entries are taken to be a history (oldest first)
+        and the recent ones are preferred. The matching can be restricted to
+        some of the entries by passing their indices, e.g. the ones that have
+        matched a shorter filter.
+        """
+        search = self.regex.search
+        if indices is None:
+            indices = range(len(entries))
+        if not self.substr.strip():
+            # Everything matches equally well, keep the original order
+            return sorted(i for i in indices if search(entries[i]))
+
+        groups = range(1, self.regex.groups + 1)
+        scale = 1 / len(entries) if recency else 0
+        scored = []
+        for i in indices:
+            matches = search(entries[i])
+            if matches:
+                spans = [matches.span(g) for g in groups]
+                scored.append((-fuzzy_score(entries[i], spans, (i + 1) * scale), i))
+        scored.sort()
+        return [i for (_, i) in scored]
 
 def abbrev_string(string):
     """Abbreviate a string by keeping uppercase and non-alphabetical characters"""
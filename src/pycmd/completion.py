@@ -5,25 +5,32 @@
 #
 
 import sys, os, re, time
-from pycmd.common import tokenize, expand_env_vars, has_exec_extension, is_executable, strip_extension
+from collections import Counter
+from pycmd.common import tokenize, expand_env_vars, has_exec_extension, strip_extension
 from pycmd.common import contains_special_char, starts_with_special_char
 from pycmd.common import sep_chars, seq_tokens
+from pycmd.DirCache import dir_cache
+from pycmd.PathIndex import path_index
 
-def complete_universal(line):
+def complete_universal(line, tokens=None):
     """
     Universal completion function
+
+    All the complete_* functions accept the result of tokenize(line) as an
+    optional argument, to avoid re-tokenizing when the caller already has it.
     """
-    tokens = tokenize(line)
+    if tokens is None:
+        tokens = tokenize(line)
     if ends_in_env_var(tokens[-1]):
-        (completed, suggestions) = complete_env_var(line)
+        (completed, suggestions) = complete_env_var(line, tokens)
     elif has_wildcards(tokens[-1]):
-        (completed, suggestions)  = complete_wildcard(line)
+        (completed, suggestions)  = complete_wildcard(line, tokens)
     else:
-        (completed, suggestions)  = complete_file(line)
+        (completed, suggestions)  = complete_file(line, tokens=tokens)
 
     return (completed, suggestions)
 
-def complete_file(line, timeout=None, exactly_one=False):
+def complete_file(line, timeout=None, exactly_one=False, tokens=None):
     """
     Complete names of files and/or directories
 
@@ -45,16 +52,18 @@ def complete_file(line, timeout=None, exactly_one=False):
        b) a list of possible subsequent completions
     """
     start = time.time()
-    (completed, completions) = complete_file_simple(line, timeout, exactly_one)
+    if tokens is None:
+        tokens = tokenize(line)
+    (completed, completions) = complete_file_simple(line, timeout, exactly_one, tokens)
     if completed == line and completions == []:
         # Try the alternate completion
         if timeout is not None:
             timeout -= time.time() - start
-        (completed, completions) = complete_file_alternate(line, timeout, exactly_one)
+        (completed, completions) = complete_file_alternate(line, timeout, exactly_one, tokens)
 
     return (completed, completions)
 
-def complete_file_simple(line, timeout=None, exactly_one=False):
+def complete_file_simple(line, timeout=None, exactly_one=False, tokens=None):
     """
     Complete names of files or directories
     This function tokenizes the line and computes file and directory
@@ -65,7 +74,8 @@ def complete_file_simple(line, timeout=None, exactly_one=False):
         completions; quotes are prepended to the last token if needed
       - the list of all possible completions (first dirs, then files)
     """
-    tokens = tokenize(line)
+    if tokens is None:
+        tokens = tokenize(line)
     token = tokens[-1].replace('"', '')
 
     path_sep = '/' if '/' in expand_env_vars(token) else os.sep
@@ -86,25 +96,23 @@ def complete_file_simple(line, timeout=None, exactly_one=False):
     # This is the wildcard matcher used throughout the function
     matcher = wildcard_to_regex(prefix + '*')
 
-    start = time.time()
     completions_dirs = []
     completions_files = []
-    if os.path.isdir(dir_to_complete):
-        try:
-            with os.scandir(dir_to_complete) as it:
-                for elem in it:
-                    if matcher.match(elem.name):
-                        if elem.is_dir():
-                            completions_dirs.append(elem.name + path_sep)
-                        else:
-                            completions_files.append(elem.name)
-                    if timeout is not None and time.time() - start > timeout:
-                        return (line, [])
-                    if exactly_one and len(completions_dirs) + len(completions_files) > 1:
-                        return (line, [])
-        except OSError:
-            # Cannot complete, probably access denied
-            pass
+    try:
+        entries = dir_cache.entries(dir_to_complete, timeout)
+    except OSError:
+        # Cannot complete, probably access denied
+        entries = []
+    if entries is None:
+        return (line, [])
+    for (name, is_dir, _) in entries:
+        if matcher.match(name):
+            if is_dir:
+                completions_dirs.append(name + path_sep)
+            else:
+                completions_files.append(name)
+            if exactly_one and len(completions_dirs) + len(completions_files) > 1:
+                return (line, [])
 
     completions_dirs.sort(key=str.lower)
     completions_files.sort(key=str.lower)
@@ -112,26 +120,13 @@ def complete_file_simple(line, timeout=None, exactly_one=False):
 
     if (len(tokens) == 1 or tokens[-2] in seq_tokens) and path_to_complete == '':
         # We are at the beginning of a command ==> also complete from the path
-        completions_path = []
-        elems_in_path = os.environ['PATH'].split(os.pathsep)
-        if sys.platform == 'linux':
-            elems_in_path = (e for e in elems_in_path
-                             if not (e.lower().startswith('/mnt/c/windows') or
-                                     e.lower().startswith('/mnt/c/program files')))
-        for elem_in_path in elems_in_path:
-            dir_to_complete = expand_env_vars(elem_in_path) + path_sep
-            try:                
-                completions_path += [elem.name for elem in os.scandir(dir_to_complete)
-                                     if matcher.match(elem.name)
-                                     and elem.is_file()
-                                     and is_executable(dir_to_complete + path_sep + elem.name)
-                                     and not elem.name in completions
-                                     and not elem.name in completions_path]
-                if exactly_one and len(completions) + len(completions_path) > 1:
-                    return (line, [])
-            except OSError:
-                # Cannot complete, probably access denied
-                pass
+        completions_set = set(completions)
+        literal_prefix = re.split('[*?]', prefix, 1)[0]
+        completions_path = [name for name in path_index.lookup(literal_prefix)
+                            if matcher.match(name) and not name in completions_set]
+        if exactly_one and len(completions) + len(completions_path) > 1:
+            return (line, [])
+        completions_set.update(completions_path)
 
         # Add internal commands
         if sys.platform == 'win32':
@@ -172,8 +167,7 @@ def complete_file_simple(line, timeout=None, exactly_one=False):
 
         completions_path += [elem for elem in internal_commands
                              if matcher.match(elem)
-                             and not elem in completions
-                             and not elem in completions_path]
+                             and not elem in completions_set]
 
         if exactly_one and len(completions) + len(completions_path) > 1:
             return (line, [])
@@ -183,11 +177,11 @@ def complete_file_simple(line, timeout=None, exactly_one=False):
 
         # Remove .com, .exe or .bat extension where possible
         completions_path_no_ext = [strip_extension(elem) for elem in completions_path]
+        similar = Counter(completions_path_no_ext)
+        similar.update(strip_extension(elem) for elem in completions)
         completions_path_nice = []
         for i in range(0, len(completions_path_no_ext)):
-            similar = [elem for elem in completions_path_no_ext if elem == completions_path_no_ext[i]]
-            similar += [elem for elem in completions if strip_extension(elem) == completions_path_no_ext[i]]
-            if len(similar) == 1 and has_exec_extension(completions_path[i]) and len(prefix) < len(completions_path[i]) - 3:
+            if similar[completions_path_no_ext[i]] == 1 and has_exec_extension(completions_path[i]) and len(prefix) < len(completions_path[i]) - 3:
                 # No similar executables, don't use extension
                 completions_path_nice.append(completions_path_no_ext[i])
             else:
@@ -225,7 +219,7 @@ def complete_file_simple(line, timeout=None, exactly_one=False):
         # No expansion was made, return original line
         return (line, [])
 
-def complete_file_alternate(line, timeout=None, exactly_one=False):
+def complete_file_alternate(line, timeout=None, exactly_one=False, tokens=None):
     """
     Complete names of files or directories using an alternate tokenization
 
@@ -237,7 +231,8 @@ def complete_file_alternate(line, timeout=None, exactly_one=False):
         completions
       - the list of all possible completions (first dirs, then files)
     """
-    tokens = tokenize(line)
+    if tokens is None:
+        tokens = tokenize(line)
     (last_token_prefix, equal_char, last_token) = tokens[-1].replace('"', '').rpartition('=')
     last_token_prefix += equal_char
         
@@ -264,25 +259,23 @@ def complete_file_alternate(line, timeout=None, exactly_one=False):
     # This is the wildcard matcher used throughout the function
     matcher = wildcard_to_regex(prefix + '*')
 
-    start = time.time()
     completions_dirs = []
     completions_files = []
-    if os.path.isdir(dir_to_complete):
-        try:
-            with os.scandir(dir_to_complete) as it:
-                for elem in it:
-                    if matcher.match(elem.name):
-                        if elem.is_dir():
-                            completions_dirs.append(elem.name + path_sep)
-                        else:
-                            completions_files.append(elem.name)
-                    if timeout is not None and time.time() - start > timeout:
-                        return (line, [])
-                    if exactly_one and len(completions_dirs) + len(completions_files) > 1:
-                        return (line, [])
-        except OSError:
-            # Cannot complete, probably access denied
-            pass
+    try:
+        entries = dir_cache.entries(dir_to_complete, timeout)
+    except OSError:
+        # Cannot complete, probably access denied
+        entries = []
+    if entries is None:
+        return (line, [])
+    for (name, is_dir, _) in entries:
+        if matcher.match(name):
+            if is_dir:
+                completions_dirs.append(name + path_sep)
+            else:
+                completions_files.append(name)
+            if exactly_one and len(completions_dirs) + len(completions_files) > 1:
+                return (line, [])
     completions_dirs.sort(key=str.lower)
     completions_files.sort(key=str.lower)
     completions = completions_dirs + completions_files
@@ -320,7 +313,7 @@ def complete_file_alternate(line, timeout=None, exactly_one=False):
         return (line, [])
 
 
-def complete_wildcard(line):
+def complete_wildcard(line, tokens=None):
     """
     Complete file/dir wildcards
     This function tokenizes the line and computes file and directory
@@ -331,7 +324,8 @@ def complete_wildcard(line):
         completions
       - the list of all possible completions (first dirs, then files)
     """
-    tokens = tokenize(line)
+    if tokens is None:
+        tokens = tokenize(line)
     token = tokens[-1].replace('"', '')
 
     path_sep = '/' if '/' in expand_env_vars(token) else os.sep
@@ -352,18 +346,15 @@ def complete_wildcard(line):
     # This is the wildcard matcher used throughout the function
     matcher = wildcard_to_regex(prefix + '*')
 
-    completions = []
-    if os.path.isdir(dir_to_complete):
-        try:
-            completions = [elem for elem in os.scandir(dir_to_complete) if matcher.match(elem.name)]
-        except OSError:
-            # Cannot complete, probably access denied
-            pass
-
+    try:
+        entries = [entry for entry in dir_cache.entries(dir_to_complete) if matcher.match(entry[0])]
+    except OSError:
+        # Cannot complete, probably access denied
+        entries = []
 
     # Sort directories first, also append '\'; then, files
-    completions_dirs = [elem.name + path_sep for elem in completions if elem.is_dir()]
-    completions_files = [elem.name for elem in completions if elem.is_file()]
+    completions_dirs = [name + path_sep for (name, is_dir, _) in entries if is_dir]
+    completions_files = [name for (name, _, is_file) in entries if is_file]
     completions_dirs.sort(key=str.lower)
     completions_files.sort(key=str.lower)
     completions = completions_dirs + completions_files
@@ -409,7 +400,7 @@ def complete_wildcard(line):
         return (line, [])
 
 
-def complete_env_var_win(line):
+def complete_env_var_win(line, tokens=None):
     """
     Complete names of environment variables
     This function tokenizes the line and computes completions
@@ -420,7 +411,8 @@ def complete_env_var_win(line):
         completions (does not include the ending %)
       - the list of all possible completions
     """
-    tokens = tokenize(line)
+    if tokens is None:
+        tokens = tokenize(line)
 
     # Account for the VAR=VALUE syntax
     (token_prefix, equals, token_orig) = tokens[-1].rpartition('=')
@@ -455,7 +447,7 @@ def complete_env_var_win(line):
         return (line, [])
 
 
-def complete_env_var_linux(line):
+def complete_env_var_linux(line, tokens=None):
     """
     Complete names of environment variables
     This function tokenizes the line and computes completions
@@ -466,7 +458,9 @@ def complete_env_var_linux(line):
         completions (does not include the ending })
       - the list of all possible completions
     """
-    token = tokenize(line)[-1]
+    if tokens is None:
+        tokens = tokenize(line)
+    token = tokens[-1]
     start_brace = ''
     [lead, prefix] = token.strip('"').rsplit('$', 1)
     if len(prefix) > 0 and prefix[0] == '{':
@@ -1,4 +1,5 @@
-import sys
+import sys, re
+from functools import lru_cache
 from pycmd.console import console_common
 
 if sys.platform == 'win32':
@@ -81,77 +82,89 @@ def cursor_backward(count):
         count -= 1
     move_cursor(x, y)
 
+def cursor_forward(count):
+    """Move cursor forward with the given number of positions"""
+    (x, y) = get_cursor()
+    (width, _) = get_buffer_size()
+    x += count
+    move_cursor(x % width, y + x // width)
+
 def erase_to(end):
     from pycmd.pycmd_public import color
     to_erase = count_chars(get_cursor(), end)
     sys.stdout.write(color.Fore.DEFAULT + color.Back.DEFAULT + ' ' * to_erase)
     cursor_backward(to_erase)
 
+# PyCmd's color codes (see write_str() for the format)
+COLOR_CODE_REGEX = re.compile('\x1b([FB])([SCT])([RGBX])')
+
+# Bit mask of each (target, component), e.g. ('F', 'R') -> FOREGROUND_RED
+COLOR_MASKS = {(target, component): console_common.__dict__[name_prefix + '_' + name_suffix]
+               for (target, name_prefix) in [('F', 'FOREGROUND'), ('B', 'BACKGROUND')]
+               for (component, name_suffix) in [('R', 'RED'), ('G', 'GREEN'), ('B', 'BLUE'), ('X', 'BRIGHT')]}
+
+@lru_cache(maxsize=256)
+def parse_color_codes(s, attr):
+    """
+    Split a string containing color codes into runs of text to be written
+    with the same attributes, starting from the given attributes; return
+    the (attributes, text) runs and the attributes in effect at the end.
+
+    The results are cached, since the same strings (prompts, completion
+    windows) tend to be written over and over again.
+    """
+    runs = []
+    pos = 0
+    for match in COLOR_CODE_REGEX.finditer(s):
+        if match.start() > pos:
+            if runs and runs[-1][0] == attr:
+                runs[-1] = (attr, runs[-1][1] + s[pos:match.start()])
+            else:
+                runs.append((attr, s[pos:match.start()]))
+        (target, command, component) = match.groups()
+        bit_mask = COLOR_MASKS[target, component]
+        if command == 'S':
+            attr |= bit_mask
+        elif command == 'C':
+            attr &= ~bit_mask
+        else:
+            attr ^= bit_mask
+        pos = match.end()
+    if pos < len(s):
+        if runs and runs[-1][0] == attr:
+            runs[-1] = (attr, runs[-1][1] + s[pos:])
+        else:
+            runs.append((attr, s[pos:]))
+    return (tuple(runs), attr)
+
+@lru_cache(maxsize=256)
+def remove_escape_sequences(s):
+    """
+    Remove color escape sequences from the given string
+
+    """
+    return COLOR_CODE_REGEX.sub('', s)
+
 def write_str(s):
     """
     Output s to stdout, while processing the color sequences
+
+    Escape sequence format is [ESC][TGT][OP][COMP], where:
+     * ESC is the Escape character: chr(27)
+     * TGT is the target: 'F' for foreground, 'B' for background
+     * OP is the operation: 'S' (set), 'C' (clear), 'T' (toggle) a component
+     * COMP is the color component: 'R', 'G', 'B' or 'X' (bright)
     """
-    i = 0
-    buf = ''
-    attr = get_text_attributes()
-    while i < len(s):
-        c = s[i]
-        if c == chr(27):
-            if buf:
-                # We have some characters, apply attributes and write them out
-                set_text_attributes(attr)
-                write_with_sane_cursor(buf)
-                buf = ''
-
-            # Process color commands to compute and set new attributes
-            target = s[i + 1]
-            command = s[i + 2]
-            component = s[i + 3]
-            i += 3
-
-            # Escape sequence format is [ESC][TGT][OP][COMP], where:
-            #  * ESC is the Escape character: chr(27)
-            #  * TGT is the target: 'F' for foreground, 'B' for background
-            #  * OP is the operation: 'S' (set), 'C' (clear), 'T' (toggle) a component
-            #  * COMP is the color component: 'R', 'G', 'B' or 'X' (bright)
-            if target == 'F':
-                name_prefix = 'FOREGROUND'
-            else:
-                name_prefix = 'BACKGROUND'
-
-            if component == 'R':
-                name_suffix = 'RED'
-            elif component == 'G':
-                name_suffix = 'GREEN'
-            elif component == 'B':
-                name_suffix = 'BLUE'
-            else:
-                name_suffix = 'BRIGHT'
+    (runs, attr) = parse_color_codes(s, get_text_attributes())
+    for (run_attr, text) in runs:
+        set_text_attributes(run_attr)
+        write_with_sane_cursor(text)
 
-            if command == 'S':
-                operator = lambda x, y: x | y
-            elif command == 'C':
-                operator = lambda x, y: x & ~y
-            else:
-                operator = lambda x, y: x ^ y
-
-            from pycmd import console
-            # We use the bit masks defined at the end of console.py by computing
-            # the name and accessing the module's dictionary (FOREGROUND_RED,
-            # BACKGROUND_BRIGHT etc)
-            bit_mask = console_common.__dict__[name_prefix + '_' + name_suffix]
-            attr = operator(attr, bit_mask)
-        else:
-            # Regular character, just append to the buffer
-            buf += c
-        i += 1
+    # Apply the last attributes (if not already in effect)
+    if not runs or runs[-1][0] != attr:
+        set_text_attributes(attr)
 
-    # Apply the last attributes and write the remaining chars (if any)
-    set_text_attributes(attr)
-    if buf:
-        write_with_sane_cursor(buf)
 
-    
 class ColorOutputStream:
     """
     We install a custom sys.stdout that handles our color sequences
@@ -163,6 +176,10 @@ class ColorOutputStream:
         """Dispatch printing to our enhanced write function"""
         write_str(str)
 
+    def flush(self):
+        """Send the queued output (if any) to the terminal"""
+        flush_output()
+
     def __getattr__(self, name):
         return getattr(sys.__stdout__, name)
 
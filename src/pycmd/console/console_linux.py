@@ -1,10 +1,9 @@
 #
 # Functions for manipulating the console using ANSI terminal sequences
 #
-import os
+import os, re, atexit, threading
 from pty import STDIN_FILENO
-from itertools import chain
-from functools import reduce
+from functools import lru_cache
 from dataclasses import dataclass
 import ctypes, sys, locale, time
 from ctypes import Structure, Union, c_int, c_long, c_char, c_wchar, c_short, pointer, byref
@@ -103,6 +102,19 @@ current_attributes = FOREGROUND_WHITE | BACKGROUND_BLACK
 # write_with_sane_cursor()
 current_cursor = [0, 0]
 
+# Output for the terminal (text and escape sequences), accumulated until the
+# next call to flush_output(); a repaint is thus sent as a single write,
+# instead of one write (and flush) per character or escape sequence.
+#
+# The output is flushed before waiting for input, so that the frame is
+# complete by the time the user gets to see it.
+output_buffer = []
+output_lock = threading.Lock()
+
+# Characters that move the cursor in special ways; the text in between is
+# processed in runs
+CURSOR_CONTROL_REGEX = re.compile('([\r\n\b])')
+
 # Write-back buffer used to emulate "write_input" (these will be
 # consumed by read_input() before attempting to consume from the
 # input_buffer)
@@ -254,6 +266,13 @@ def get_text_attributes():
 
 def set_text_attributes(color):
     """Set foreground/background RGB components for the text to write"""
+    emit(ansi_attributes(color))
+    global current_attributes
+    current_attributes = color
+
+@lru_cache(maxsize=None)
+def ansi_attributes(color):
+    """Translate (Windows format) text attributes to ANSI escape sequences"""
     R, G, B = (color & FOREGROUND_RED != 0,
                color & FOREGROUND_GREEN != 0,
                color & FOREGROUND_BLUE != 0)
@@ -272,7 +291,7 @@ def set_text_attributes(color):
         seq += 60
     if seq == 37:
         seq = 39  # use "default" instead of white
-    sys.__stdout__.write('\033[%dm' % seq)
+    fore_seq = seq
 
     R, G, B = (color & BACKGROUND_RED != 0,
                color & BACKGROUND_GREEN != 0,
@@ -292,11 +311,7 @@ def set_text_attributes(color):
         seq += 60
     if seq == 40:
         seq = 49  # use "default" instead of black
-    sys.__stdout__.write('\033[%dm' % seq)
-
-    sys.__stdout__.flush()
-    global current_attributes
-    current_attributes = color
+    return '\033[%dm\033[%dm' % (fore_seq, seq)
 
 def get_buffer_attributes(x, y, n):
     """Get the fg/bg/attributes for the n chars in the buffer starting at (x, y)"""
@@ -315,11 +330,11 @@ def set_buffer_attributes(x, y, colors):
 
 def visual_bell():
     """Flash the screen for brief moment to notify the user"""
-    sys.__stdout__.write('\033[?5h')
-    sys.__stdout__.flush()
+    emit('\033[?5h')
+    flush_output()
     time.sleep(0.15)
-    sys.__stdout__.write('\033[?5l')
-    sys.__stdout__.flush()
+    emit('\033[?5l')
+    flush_output()
 
 def set_console_title(title):
     """Set the title of the current console"""
@@ -328,14 +343,13 @@ def set_console_title(title):
 def move_cursor(x, y):
     """Move the cursor to the specified location"""
     if x > current_cursor[0]:
-        sys.__stdout__.write('\033[%dC' % (x - current_cursor[0]))
+        emit('\033[%dC' % (x - current_cursor[0]))
     elif x < current_cursor[0]:
-        sys.__stdout__.write('\033[%dD' % (current_cursor[0] - x))
+        emit('\033[%dD' % (current_cursor[0] - x))
     if y > current_cursor[1]:
-        sys.__stdout__.write('\033[%dB' % (y - current_cursor[1]))
+        emit('\033[%dB' % (y - current_cursor[1]))
     elif y < current_cursor[1]:
-        sys.__stdout__.write('\033[%dA' % (current_cursor[1] - y))
-    sys.__stdout__.flush()
+        emit('\033[%dA' % (current_cursor[1] - y))
     current_cursor[0] = x
     current_cursor[1] = y
 
@@ -356,8 +370,7 @@ def get_viewport():
 
 def set_cursor_attributes(size, visibility):
     """Set the cursor visibility (setting the size is not possible on Linux)"""
-    sys.__stdout__.write('\033[?25%s' % ('h' if visibility else 'l'))
-    sys.__stdout__.flush()
+    emit('\033[?25%s' % ('h' if visibility else 'l'))
 
 def scroll_buffer(lines):
     """Scroll vertically with the given (positive or negative) number of lines"""
@@ -382,8 +395,7 @@ def scroll_to_quarter(line):
 
 def clear_screen():
     """Clear the screen and move the cursor to the top-left corner"""
-    sys.__stdout__.write('\033[2J\033[H')
-    sys.__stdout__.flush()
+    emit('\033[2J\033[H')
     current_cursor[0] = 0
     current_cursor[1] = 0
 
@@ -392,6 +404,9 @@ def read_input():
     if write_back:
         return write_back.pop(0)
 
+    # Show the complete frame before waiting
+    flush_output()
+
     keymap = KEYMAP
     pty_control.input_processed.clear()
     ch = 0
@@ -423,47 +438,64 @@ def read_input():
             debug('read_input input_processed.set')
             pty_control.input_processed.set()
 
+def input_ready(timeout):
+    """Wait (at most timeout seconds) until read_input() can return without blocking"""
+    if write_back:
+        return True
+    flush_output()
+    return pty_control.input_available.wait(timeout)
+
 def write_input(key_code, char, control_state):
     """Emulate a key press with the given key code and control key mask"""
     write_back.append(PyINPUT_RECORDType(True, key_code, char, control_state))
 
-def remove_escape_sequences(s):
-    """
-    Remove color escape sequences from the given string
-    
-    """
-    from pycmd.pycmd_public import color
-    escape_sequences_fore = [v for (k, v) in chain(color.Fore.__dict__.items(),
-                                                   color.Back.__dict__.items())
-                             if not k.startswith('__')]
-    return reduce(lambda x, y: x.replace(y, ''), 
-                  escape_sequences_fore,
-                  s)
-
 def write_with_sane_cursor(s):
     """Write simple text (i.e. no escape sequences) and track the
     (relative) cursor position; also ensure that the cursor is
     automatically moved to the next line when the end of a line is
     reached (this does not happen by default!)
     """
-    buffer_size = get_buffer_size()
-    for c in s:
-        sys.__stdout__.write(c)
-        if c == '\r':
-            current_cursor[0] = 0
-        elif c == '\b':
-            current_cursor[0] -= 1
-            if current_cursor[0] < 0:
-                current_cursor[0] = 0
-        elif c == '\n':
-            current_cursor[1] += 1
-            write_with_sane_cursor('\r')
+    (width, height) = get_buffer_size()
+    (x, y) = current_cursor
+    for run in CURSOR_CONTROL_REGEX.split(s):
+        if run == '\r':
+            emit(run)
+            x = 0
+        elif run == '\b':
+            emit(run)
+            x = max(x - 1, 0)
+        elif run == '\n':
+            emit('\n\r')
+            x = 0
+            y += 1
         else:
-            current_cursor[0] += 1
-            if current_cursor[0] >= buffer_size[0]:
-                sys.__stdout__.write('\r\n')
-                current_cursor[1] += 1
-                current_cursor[0] = 0
-        if current_cursor[1] >= buffer_size[1]:
-            current_cursor[1] = buffer_size[1] - 1
+            # Plain text: fill the current line, then wrap as many times as
+            # needed
+            while run:
+                room = max(width - x, 1)
+                emit(run[:room])
+                x += len(run[:room])
+                run = run[room:]
+                if x >= width:
+                    emit('\r\n')
+                    x = 0
+                    y += 1
+        y = min(y, height - 1)
+    current_cursor[0] = x
+    current_cursor[1] = y
 
+def emit(s):
+    """Queue output for the terminal (see flush_output())"""
+    with output_lock:
+        output_buffer.append(s)
+
+def flush_output():
+    """Send all the queued output to the terminal, at once"""
+    with output_lock:
+        if output_buffer:
+            sys.__stdout__.write(''.join(output_buffer))
+            output_buffer.clear()
+            sys.__stdout__.flush()
+
+# Do not lose the last frame (e.g. messages printed right before exiting)
+atexit.register(flush_output)
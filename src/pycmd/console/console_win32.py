@@ -1,8 +1,6 @@
 #
 # Functions for manipulating the console using Microsoft's Console API
 #
-from itertools import chain
-from functools import reduce
 import ctypes, sys, locale, time
 from ctypes import Structure, Union, c_int, c_long, c_char, c_wchar, c_short, pointer, byref
 from ctypes.wintypes import BOOL, WORD, DWORD
@@ -10,6 +8,7 @@ from win32console import GetStdHandle, STD_INPUT_HANDLE, PyINPUT_RECORDType, KEY
 from win32con import LEFT_CTRL_PRESSED, RIGHT_CTRL_PRESSED
 from win32con import LEFT_ALT_PRESSED, RIGHT_ALT_PRESSED
 from win32con import SHIFT_PRESSED
+from win32event import WaitForSingleObject
 from pycmd.console.console_common import *
 
 def get_text_attributes():
@@ -118,6 +117,21 @@ def read_input():
             # debug('%s %d' % (record.Char, record.VirtualKeyCode))
             return record
 
+def input_ready(timeout):
+    """Wait (at most timeout seconds) until read_input() can return without blocking"""
+    deadline = time.time() + timeout
+    while True:
+        records = stdin_handle.PeekConsoleInput(16)
+        if any(record.EventType == KEY_EVENT and record.KeyDown for record in records):
+            return True
+        if records:
+            # Drop the events that read_input() would ignore anyway
+            stdin_handle.ReadConsoleInput(len(records))
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        WaitForSingleObject(stdin_handle, int(remaining * 1000))
+
 def write_input(key_code, char, control_state):
     """Emulate a key press with the given key code and control key mask"""
     record = PyINPUT_RECORDType(KEY_EVENT)
@@ -127,19 +141,6 @@ def write_input(key_code, char, control_state):
     record.ControlKeyState = control_state
     stdin_handle.WriteConsoleInput([record])
 
-def remove_escape_sequences(s):
-    """
-    Remove color escape sequences from the given string
-    
-    """
-    from pycmd.pycmd_public import color
-    escape_sequences_fore = [v for (k, v) in chain(color.Fore.__dict__.items(),
-                                                   color.Back.__dict__.items())
-                             if not k.startswith('__')]
-    return reduce(lambda x, y: x.replace(y, ''), 
-                  escape_sequences_fore,
-                  s)
-
 def write_with_sane_cursor(s):
     """
     Under Win10, write() no longer advances the cursor to the next line after writing in the last column; so we
@@ -157,6 +158,10 @@ def write_with_sane_cursor(s):
         # ourselves
         sys.__stdout__.write(' \r')
 
+def flush_output():
+    """Nothing to do, the output is written out right away"""
+    sys.__stdout__.flush()
+
 stdin_handle = GetStdHandle(STD_INPUT_HANDLE)
 stdout_handle = ctypes.windll.kernel32.GetStdHandle(-11)
 
@@ -150,6 +150,16 @@ appearance.colors.suggestion = (color.back_to_fore(color.Back.DEFAULT) +
 #  1. Replace appearance.simple_prompt, .git_prompt, .svn_prompt with custom
 #     functions
 #  2. Replace the "top-level" appearance.prompt with a custom function
+#
+# Slow parts of the prompt (e.g. involving network drives) can be wrapped in a
+# PromptSegment: it is computed in the background, and if it takes longer than
+# its time budget (in seconds), a placeholder is shown and the prompt is redrawn
+# when the result is available. join_segments() computes several segments
+# concurrently, e.g.:
+#    def mount_status():
+#        return '[online] ' if os.path.exists(r'\\server\share') else '[offline] '
+#    mount_segment = PromptSegment(mount_status, budget=0.05, placeholder='[?] ')
+#    appearance.prompt = lambda: join_segments(mount_segment, appearance.simple_prompt)
 appearance.prompt = universal_prompt
 
 
@@ -172,6 +182,34 @@ behavior.quiet_mode = False
 behavior.completion_mode = 'zsh'
 
 
+# Set the maximum number of commands to keep in the command history
+#
+# The history is saved after each command and shared by all PyCmd sessions;
+# larger values make for longer startup times and more memory use.
+#
+# The default is to keep the last 2000 commands:
+#       behavior.history_limit = 2000
+behavior.history_limit = 2000
+
+# Share the command history between concurrently running PyCmd sessions: the
+# commands entered (or zapped) in other sessions become available in the
+# history of the current one before each new prompt.
+#
+# The default is to share the history:
+#       behavior.share_history = True
+behavior.share_history = True
+
+
+# Time (in seconds) to wait for the parts of the prompt that are computed in
+# the background, such as the git status, when they are known to be out of
+# date (e.g. after a checkout). Past this, the prompt is shown with the last
+# known values and redrawn in place as soon as the new ones are available.
+#
+# The default is to wait for a tenth of a second:
+#       behavior.prompt_timeout = 0.1
+behavior.prompt_timeout = 0.1
+
+
 # Specify a "chat" template object to be used for the chat mode
 # 
 # You can directly use chatlas (bundled with PyCmd) or create your own 
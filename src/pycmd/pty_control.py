@@ -1,4 +1,4 @@
-import sys, os, threading, tty, pty, fcntl, array, termios, tempfile, select
+import sys, os, re, threading, tty, pty, fcntl, array, termios, tempfile, select
 from pycmd.common import debug
 
 input_processed = threading.Event()
@@ -7,7 +7,6 @@ command_to_run = None
 pass_through = True
 command_completed = threading.Event()
 terminated = False
-poll = select.poll()
 
 # The "interpreted" MARKER (i.e. the string that bash will show when printing the
 # prompt) must be different from the "raw" MARKER, i.e. the actual value of the
@@ -16,13 +15,35 @@ poll = select.poll()
 MARKER_BASE = '_MARKER_'
 MARKER_RAW = r'\036' + MARKER_BASE
 MARKER = '\036' + MARKER_BASE
-MARKER_BYTES = bytearray(MARKER, 'utf-8')
-output_acc = bytearray()
-marker_acc = bytearray()
+MARKER_BYTES = bytes(MARKER, 'utf-8')
+marker_acc = b''
+
+# Between the two MARKERs, bash sends the list of exported variables (as
+# printed by `export -p`), then this separator, then the actual prompt
+ENV_SEPARATOR_RAW = r'\035'
+ENV_SEPARATOR_BYTES = b'\035'
+
+# When readline redraws the current line (e.g. on SIGWINCH), it only re-prints
+# PS1, i.e. the part of the prompt after the separator; such repaints are not
+# wanted on the tty
+PROMPT_REDISPLAY_REGEX = re.compile(b'(?:\r\x1b\\[K)?\r' + ENV_SEPARATOR_BYTES +
+                                    b'[^\n]*?' + re.escape(MARKER_BYTES))
+
+# The environment of the shell as of the last prompt: the raw `export -p`
+# output, and the variables parsed from it
+env_dump = None
+shell_env = None
+
+# Variables changed in the shell since the last call to take_env_changes(),
+# mapped to their new value (None if they were removed)
+env_changes = {}
 input_buffer = []
 captured_prompt = None
 first_command = True
 
+# Maximum number of bytes read from the shell at once
+CHUNK_SIZE = 65536
+
 def read_stdin(fd):
     global pass_through
     debug('read_stdin os.read')
@@ -52,7 +73,7 @@ def read_stdin(fd):
             return bytearray(chr(0), 'utf-8')
 
 def read_shell(fd):
-    global command_to_run, pass_through, captured_prompt, output_acc, marker_acc, poll
+    global command_to_run, marker_acc
 
     if command_to_run:
         # ensure terminal dimensions match the real terminal
@@ -66,65 +87,178 @@ def read_shell(fd):
         fcntl.ioctl(fd, termios.TIOCSWINSZ, buf)
 
         # bash outputs the command; we swallow it (up to '\r\n')
-        while (b := os.read(fd, 1)[0]) != 10:
-            debug('Swallow `%s`' % b)
-            pass
+        data = b''
+        while (newline := data.find(b'\n')) < 0:
+            chunk = read_chunk(fd)
+            if not chunk:
+                return b''
+            data += chunk
+        debug('Swallow `%s`' % data[:newline + 1])
         command_to_run = None
-        output_acc = bytearray()
-        marker_acc = bytearray()
-        return bytearray(chr(0), 'utf-8')
+        marker_acc = b''
+
+        # Whatever follows is already the command's output
+        return relay_output(fd, data[newline + 1:]) or bytes(chr(0), 'utf-8')
+    elif pass_through:
+        data = os.read(fd, CHUNK_SIZE)
+        if not data:
+            return b''
+        return relay_output(fd, data) or bytes(chr(0), 'utf-8')
     else:
-        if pass_through:
-            poll.register(fd, select.POLLIN)  # there's no obvious better time to do this
-            
-            # Command is running, pass output through until a MARKER is detected
-            while True:
-                ch = os.read(fd, 1)[0] if poll.poll(30) else 0
-
-                # debug('STDOUT %02X' % ch)
-                if ch == MARKER_BYTES[len(marker_acc)]:
-                    # this could still be the marker, push to marker accumulator
-                    marker_acc.append(ch)
-                    if len(marker_acc) == len(MARKER_BYTES):
-                        # first MARKER (begin) has been detected; search for the next one (end)
-                        capture_buffer = bytearray()
-                        while capture_buffer[-len(MARKER_BYTES):] != MARKER_BYTES:
-                            ch = os.read(fd, 1)[0]
-                            if ch == ord('\r'):
-                                # When the prompt is longer than $COLUMNS, some versions of bash re-print
-                                # the first overflowing character preceded by '\r'
-                                os.read(fd, 1)
-                                continue
-                            capture_buffer.append(ch)
-                        captured_prompt = capture_buffer[:-len(MARKER_BYTES)].decode('utf-8')
-                        pass_through = False
-                        command_completed.set()
-                        marker_acc = bytearray()
-                        output = bytes(output_acc)
-                        output_acc = bytearray()
-                        return output + bytes(chr(0), 'utf-8')
-                else:
-                    # we no longer match a marker prefix, move whatever we might have matched already
-                    # into the output accumulator
-                    output_acc.extend(marker_acc)
-                    output_acc.append(ch)
-                    marker_acc = bytearray()
-                    
-                    if ch == 10 or ch == 0:
-                        # return the content of the output accumulator to the tty
-                        output = bytes(output_acc)
-                        output_acc = bytearray()
-                        return output
+        b = os.read(fd, CHUNK_SIZE)
+        debug('Extra %s' % b)
+        return PROMPT_REDISPLAY_REGEX.sub(b'', b) or bytes(chr(0), 'utf-8')
+
+
+def relay_output(fd, data):
+    """
+    Process a chunk of output from a running command: return what should be
+    passed through to the tty, and capture the prompt when the MARKER shows
+    up (this means that the command has completed).
+    """
+    global pass_through, captured_prompt, marker_acc
+
+    data = marker_acc + data
+    marker_acc = b''
+    start = data.find(MARKER_BYTES)
+    if start < 0:
+        # Command is still running, pass the output through right away; only
+        # hold back a trailing partial MARKER, which might be completed by the
+        # next chunk
+        partial = partial_marker_len(data)
+        if partial:
+            marker_acc = data[-partial:]
+            data = data[:-partial]
+        return data
+
+    # first MARKER (begin) has been detected; search for the next one (end)
+    raw = data[start + len(MARKER_BYTES):]
+    while (end := (capture := unwrap(raw)).find(MARKER_BYTES)) < 0:
+        chunk = read_chunk(fd)
+        if not chunk:
+            return b''
+        raw += chunk
+    (dump, separator, prompt) = capture[:end].rpartition(ENV_SEPARATOR_BYTES)
+    captured_prompt = prompt.decode('utf-8')
+    if separator:
+        update_env(dump)
+
+    # Make sure all the output has reached the tty before letting PyCmd
+    # draw its own prompt
+    write_all(pty.STDOUT_FILENO, data[:start])
+    pass_through = False
+    command_completed.set()
+    rest = raw[raw.find(MARKER_BYTES) + len(MARKER_BYTES):]
+    return PROMPT_REDISPLAY_REGEX.sub(b'', rest)
+
+
+def unwrap(data):
+    """Undo the changes made by bash and the tty to the text of the prompt"""
+    # When the prompt is longer than $COLUMNS, some versions of bash re-print
+    # the first overflowing character preceded by '\r'; also, the tty turns
+    # '\n' into '\r\n'
+    return re.sub(b'\r[^\n]', b'', data).replace(b'\r\n', b'\n')
+
+
+def update_env(dump):
+    """Record the variables changed in the shell, given its `export -p` output"""
+    global env_dump, shell_env
+    if dump == env_dump:
+        # Nothing changed (the usual case)
+        return
+    env_dump = dump
+    if shell_env is None:
+        shell_env = dict(os.environ)
+    new_env = parse_env_dump(dump)
+    for (variable, value) in new_env.items():
+        if shell_env.get(variable) != value:
+            env_changes[variable] = value
+    for variable in shell_env.keys() - new_env.keys():
+        env_changes[variable] = None
+    shell_env = new_env
+
+
+def take_env_changes():
+    """Return (and forget) the variables changed in the shell since the last call"""
+    global env_changes
+    (changes, env_changes) = (env_changes, {})
+    return changes
+
+
+# A line of `export -p` output: `declare -x NAME="value"` (or `export ...` in
+# POSIX mode); values containing control chars are $'...' quoted, and older
+# versions of bash print them as multi-line "..." strings
+ENV_LINE_REGEX = re.compile(rb'^(?:declare -x|export) ([^\s=]+)(?:=(\"(?:[^\"\\]|\\.)*\"|\$\'(?:[^\'\\]|\\.)*\'))?$',
+                            re.MULTILINE | re.DOTALL)
+DQUOTE_ESCAPE_REGEX = re.compile(rb'\\([\\"$`])')
+ANSI_C_ESCAPE_REGEX = re.compile(rb'\\(?:([0-7]{1,3})|x([0-9a-fA-F]{1,2})|u([0-9a-fA-F]{1,4})|U([0-9a-fA-F]{1,8})|c(.)|(.))',
+                                 re.DOTALL)
+ANSI_C_ESCAPES = {b'a': b'\a', b'b': b'\b', b'e': b'\x1b', b'E': b'\x1b', b'f': b'\f', b'n': b'\n',
+                  b'r': b'\r', b't': b'\t', b'v': b'\v'}
+
+
+def parse_env_dump(dump):
+    """Parse the output of `export -p` into a dictionary of variables"""
+    env = {}
+    for match in ENV_LINE_REGEX.finditer(dump):
+        (name, value) = match.groups()
+        if value is None:
+            # Exported, but not set
+            continue
+        if value.startswith(b'"'):
+            value = DQUOTE_ESCAPE_REGEX.sub(rb'\1', value[1:-1])
         else:
-            b = os.read(fd, 1)
-            debug('Extra %s' % b)
-            return b
+            value = ANSI_C_ESCAPE_REGEX.sub(ansi_c_unescape, value[2:-1])
+        env[name.decode('utf-8', 'surrogateescape')] = value.decode('utf-8', 'surrogateescape')
+    return env
+
+
+def ansi_c_unescape(match):
+    (octal, hex, unicode16, unicode32, control, char) = match.groups()
+    if octal or hex:
+        return bytes([int(octal, 8) & 0xFF if octal else int(hex, 16)])
+    elif unicode16 or unicode32:
+        return chr(int(unicode16 or unicode32, 16)).encode('utf-8', 'surrogateescape')
+    elif control:
+        return bytes([control[0] & 0x1F])
+    else:
+        return ANSI_C_ESCAPES.get(char, char)
+
+
+def partial_marker_len(data):
+    """Return the length of the longest suffix of data that is a prefix of the MARKER"""
+    # The MARKER starts with its only \036 char, so it is enough to check the last one
+    start = data.rfind(MARKER_BYTES[:1], max(0, len(data) - len(MARKER_BYTES) + 1))
+    if start >= 0 and MARKER_BYTES.startswith(data[start:]):
+        return len(data) - start
+    return 0
+
+
+def read_chunk(fd):
+    """Read the available output from the shell, waiting for some if needed"""
+    select.select([fd], [], [])
+    return os.read(fd, CHUNK_SIZE)
+
+
+def write_all(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def start():
+    global shell_env
 
-        
-def start(env_dump_file):
     # Direct character processing
     tty.setcbreak(sys.stdin)
-    ps1 = MARKER_RAW + r'$PWD|$?' + MARKER_RAW
+
+    # The prompt is framed by MARKERs; the first one, together with the
+    # exported variables, is printed by PROMPT_COMMAND (`export -p` is a
+    # builtin, so this costs neither a fork nor any file I/O)
+    ps1 = ENV_SEPARATOR_RAW + r'$PWD|$?' + MARKER_RAW
+    prompt_command = f'printf "{MARKER_RAW}"; export -p'
+
+    # bash starts from our environment
+    shell_env = dict(os.environ)
 
     # We make the temp file global, otherwise it will be deleted when
     # this function ends -- which could be before beash gets a chance
@@ -132,9 +266,13 @@ def start(env_dump_file):
     global rc      
     try:
         rc = tempfile.NamedTemporaryFile(mode='w', encoding='utf-8')
-        rc.write(open(os.path.expanduser('~/.bashrc'), 'r', encoding='utf-8').read())
+        try:
+            rc.write(open(os.path.expanduser('~/.bashrc'), 'r', encoding='utf-8').read())
+        except OSError:
+            # No .bashrc (or not readable), nothing to include
+            pass
         rc.write(f"PS1='{ps1}'\n")
-        rc.write(f'PROMPT_COMMAND="printenv > {env_dump_file}"\n')
+        rc.write(f"PROMPT_COMMAND='{prompt_command}'\n")
         rc.write('HISTCONTROL=ignorespace\n')
         rc.write("bind 'set enable-bracketed-paste off'\n")
         rc.write(''.join(f'bind -r "\e{i}"\n' for i in range(10)))
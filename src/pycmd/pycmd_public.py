@@ -4,8 +4,12 @@ Public constants, objects and utilities exported by PyCmd.
 These are meant to be used in init.py files; users can rely on them being kept
 unchanged (interface-wise) throughout later versions.
 """
-import os, sys, subprocess
+import os, sys, re, subprocess, threading, time
+from collections import OrderedDict
 from pycmd import common, console
+from pycmd.DirCache import RACY_INTERVAL
+from pycmd.GitRepository import GitRepository, Unsupported
+from pycmd.SvnWorkingCopy import SvnWorkingCopy
 
 def abbrev_path(path = None):
     """
@@ -47,12 +51,11 @@ def abbrev_path(path = None):
     for elem in path.split(os.sep)[ : -1]:
         elem_abbrev = common.abbrev_string(elem)
         try:
-            for other in os.listdir(current_dir):
-                if os.path.isdir(current_dir + os.sep + other) and common.abbrev_string(other).lower() == elem_abbrev.lower() and other.lower() != elem.lower():
-                    # Found other directory with the same abbreviation
-                    # In this case, we use the entire name
-                    elem_abbrev = elem
-                    break
+            others = _abbrev_cache.dirs_by_abbrev(current_dir).get(elem_abbrev.lower(), ())
+            if any(other != elem.lower() for other in others):
+                # Found other directory with the same abbreviation
+                # In this case, we use the entire name
+                elem_abbrev = elem
         except (PermissionError, FileNotFoundError):
             # we were unable to list parent directory to check for collisions
             elem_abbrev = elem
@@ -62,15 +65,130 @@ def abbrev_path(path = None):
     return path_abbrev if path_abbrev == '~' and not path else path_abbrev + os.sep + path.split(os.sep)[-1]
 
 
+class _AbbrevCache(object):
+    """
+    The abbreviations of the subdirectories of the directories shown in the
+    prompt, used by abbrev_path() to find the ambiguous ones.
+
+    The abbreviations of a directory are reused for as long as its
+    modification time stays the same, so that a prompt costs a stat() per
+    path element instead of listing (and checking) all the siblings.
+    """
+    def __init__(self, max_dirs=256):
+        self.max_dirs = max_dirs
+        self._lock = threading.Lock()
+        # Map path -> (mtime_ns, trusted, {abbreviation: set of names}),
+        # least recently used first; all lowercase
+        self._dirs = OrderedDict()
+
+    def dirs_by_abbrev(self, path):
+        """Map the (lowercase) abbreviations of the subdirectories of path to their names"""
+        mtime = os.stat(path).st_mtime_ns
+        with self._lock:
+            cached = self._dirs.get(path)
+            if cached is not None and cached[0] == mtime and cached[1]:
+                self._dirs.move_to_end(path)
+                return cached[2]
+
+        start = time.time()
+        by_abbrev = {}
+        with os.scandir(path) as it:
+            for elem in it:
+                try:
+                    is_dir = elem.is_dir()
+                except OSError:
+                    continue
+                if is_dir:
+                    abbrev = common.abbrev_string(elem.name).lower()
+                    by_abbrev.setdefault(abbrev, set()).add(elem.name.lower())
+
+        trusted = abs(start - mtime / 1e9) > RACY_INTERVAL
+        with self._lock:
+            self._dirs[path] = (mtime, trusted, by_abbrev)
+            self._dirs.move_to_end(path)
+            if len(self._dirs) > self.max_dirs:
+                self._dirs.popitem(last=False)
+        return by_abbrev
+
+
+_abbrev_cache = _AbbrevCache()
+
+
+# The ancestors of a directory are searched again after this many seconds
+# even if the directory itself has not changed (e.g. after a "git init" in
+# one of the ancestors)
+UPDIR_CACHE_TTL = 10
+
+
+class _UpdirCache(object):
+    """
+    The results of find_updir() for the recently visited directories.
+
+    Each prompt looks for .git, .svn etc. in the current directory and all
+    its ancestors (universal_prompt(), then git_prompt() or svn_prompt()).
+    The results are reused for as long as the mtime of the directory stays
+    the same (i.e. nothing was created in or removed from it); the mtime is
+    only checked once per prompt, so that all these lookups cost a single
+    stat(). Changes made in the ancestors are noticed after UPDIR_CACHE_TTL
+    seconds.
+    """
+    def __init__(self, max_dirs=64):
+        self.max_dirs = max_dirs
+        self._lock = threading.Lock()
+        # Map path -> [mtime_ns, time of the lookups, prompt number of the
+        # last check, {name: found}], least recently used first
+        self._dirs = OrderedDict()
+
+    def find(self, name, path):
+        """Cached version of _find_updir()"""
+        with self._lock:
+            entry = self._dirs.get(path)
+            checked = entry is not None and entry[2] == prompt_updates.prompt_number
+        if not checked:
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                return _find_updir(name, path)
+            now = time.time()
+            with self._lock:
+                entry = self._dirs.get(path)
+                if (entry is None or entry[0] != mtime or now - entry[1] > UPDIR_CACHE_TTL
+                    or abs(now - mtime / 1e9) <= RACY_INTERVAL):
+                    entry = self._dirs[path] = [mtime, now, None, {}]
+                entry[2] = prompt_updates.prompt_number
+
+        with self._lock:
+            self._dirs[path] = entry
+            self._dirs.move_to_end(path)
+            if len(self._dirs) > self.max_dirs:
+                self._dirs.popitem(last=False)
+            if name in entry[3]:
+                return entry[3][name]
+
+        found = _find_updir(name, path)
+        with self._lock:
+            entry[3][name] = found
+        return found
+
+
+_updir_cache = _UpdirCache()
+
+
 def find_updir(name, path=None):
     """
     Look for a file/directory named "name" in a given directory and all the
     ancestor directories. 
     If no starting directory is provided, the CWD is assumed.
+
+    The results are cached for as long as the directory is not modified.
     """
     if not path:
         path = os.getcwd()
+    return _updir_cache.find(name, path)
+
 
+def _find_updir(name, path):
+    """Search the ancestors of path for name, see find_updir()"""
     found = None
     while len(path) > 3:
         if os.path.exists(os.path.join(path, name)):
@@ -81,7 +199,7 @@ def find_updir(name, path=None):
     return found
 
 
-def __get_symbolic_git_name():
+def __get_symbolic_git_name(cwd=None):
     """
     Try to get a nicer name for the current head.
     This will output something that might contain a name relative to a revision (including tags).
@@ -90,6 +208,7 @@ def __get_symbolic_git_name():
     # weirdly enough, --always is not enough and needs --no-undefined
     stdout = subprocess.Popen("git name-rev --name-only --always --no-undefined HEAD",
                               shell=True,
+                              cwd=cwd,
                               stdout=subprocess.PIPE,
                               stderr=-1).communicate()[0].decode(sys.stdout.encoding)
     if not stdout:
@@ -98,7 +217,288 @@ def __get_symbolic_git_name():
     return firstLine.strip()
 
 
-def simple_prompt():
+def _git_status(git_dir, work_tree):
+    """
+    Get the status of a repository as a tuple (head_name, ahead, behind,
+    dirty, staged); None if not in a repository.
+
+    The status is read directly from the git dir when possible (see
+    GitRepository.py); git is only run for what is not handled there.
+    """
+    try:
+        return _read_git_status(git_dir, work_tree)
+    except Exception as e:
+        common.debug('reading %s failed, running git: %s' % (git_dir, e))
+        return _run_git_status(work_tree)
+
+
+# The repositories read by _read_git_status(), kept for their cached files
+_git_repositories = {}
+
+
+def _read_git_status(git_dir, work_tree):
+    """Read the status of a repository without running git, see _git_status()"""
+    repository = _git_repositories.get(git_dir)
+    if repository is None or repository.work_tree != work_tree:
+        repository = _git_repositories[git_dir] = GitRepository(git_dir, work_tree)
+    try:
+        return _read_repository_status(repository, work_tree)
+    finally:
+        # Do not keep the pack files open between prompts
+        repository.close()
+
+
+def _read_repository_status(repository, work_tree):
+    (branch, head) = repository.head()
+    if head is None:
+        raise Unsupported('no commits yet')
+
+    if branch is None:
+        # detached HEAD state, try to get a symbolic/relative name
+        head_name = __get_symbolic_git_name(work_tree) or 'HEAD (no branch)'
+    else:
+        head_name = branch
+
+    ahead = behind = ''
+    upstream = repository.upstream(branch) if branch else None
+    upstream_head = repository.resolve_ref(upstream) if upstream else None
+    if upstream_head:
+        (ahead, behind) = (str(n) if n else '' for n in repository.ahead_behind(head, upstream_head))
+    (dirty, staged) = repository.worktree_status(head)
+    return (head_name, ahead, behind, dirty, staged)
+
+
+def _run_git_status(cwd):
+    """Run git to get the status of the repository containing cwd, see _git_status()"""
+    stdout = subprocess.Popen(
+        'git status -b --porcelain -uno',
+        shell=True,
+        cwd=cwd,
+        stdout=subprocess.PIPE,
+        stderr=-1).communicate()[0].decode(sys.stdout.encoding)
+    lines = stdout.split('\n')
+    match_branch = re.match(r'## (.+)\.\.\.(.+)?.*', lines[0])
+    if not match_branch:
+        # Maybe this is not a tracking branch, fallback
+        match_branch = re.match(r'## (.+)', lines[0])
+    if not match_branch:
+        return None
+
+    head_name = ""
+    branch_name = match_branch.group(1)
+    if branch_name == "HEAD (no branch)":
+        # detached HEAD state, try to get a symbolic/relative name
+        # (as git is invoked with --porcelain, i think it's safe to just string compare directly)
+        head_name = __get_symbolic_git_name(cwd)
+    if not head_name:
+        head_name = branch_name
+
+    ahead = behind = ''
+    match_ahead_behind = re.match(r'## .* \[(ahead (\d+))?(, )?(behind (\d+))?\]', lines[0])
+    if match_ahead_behind:
+        ahead = match_ahead_behind.group(2) or ''
+        behind = match_ahead_behind.group(5) or ''
+    dirty_files = lines[1:-1]
+    dirty = any(line[1] in ['M', 'D'] for line in dirty_files)
+    staged = any(line[0] in ['A', 'M', 'D', 'R'] for line in dirty_files)
+    return (head_name, ahead, behind, dirty, staged)
+
+
+class _PromptUpdates(object):
+    """
+    Keep track of the parts of the prompt that are computed in the background.
+
+    PyCmd shows the prompt right away (with the last known values of these
+    parts) and, while some computations are pending, watches for changes
+    so that it can redraw the prompt in place.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._running = 0
+        self._changed = False
+        # Incremented for each new prompt (as opposed to redraws of a prompt)
+        self.prompt_number = 0
+
+    def next_prompt(self):
+        """A new prompt is about to be shown"""
+        with self._lock:
+            self.prompt_number += 1
+            self._changed = False
+
+    def start(self):
+        """A background computation has started"""
+        with self._lock:
+            self._running += 1
+
+    def finish(self, changed):
+        """A background computation has finished; changed tells whether the prompt has changed"""
+        with self._lock:
+            self._running -= 1
+            self._changed = self._changed or changed
+
+    def pending(self):
+        """Whether the prompt might still change"""
+        with self._lock:
+            return self._running > 0 or self._changed
+
+    def take_changed(self):
+        """Return whether the prompt has changed since the last call"""
+        with self._lock:
+            changed = self._changed
+            self._changed = False
+            return changed
+
+
+class PromptSegment(object):
+    """
+    A part of the prompt that is computed in the background, within a time
+    budget.
+
+    Calling the segment returns its text for the current prompt. The
+    function is run in a worker thread once per prompt (and not for the
+    redraws of the same prompt), with the arguments given to the call;
+    the segments that are started together (see join_segments()) are thus
+    computed concurrently. The call waits for the result for at most
+    budget seconds after the start (behavior.prompt_timeout if None); past
+    that, the placeholder (a string, or a function returning one) is shown
+    and PyCmd redraws the prompt in place as soon as the result is
+    available.
+
+    If a stamp function is given, the results are taken to only depend on
+    the arguments and on what the stamp describes (e.g. the mtimes of some
+    files): the last known result for the same arguments is shown instead
+    of the placeholder, and without waiting at all if the stamp is the
+    same as when it was computed. It is still recomputed for each prompt.
+    """
+    def __init__(self, function, budget=None, placeholder='', stamp=None):
+        self.function = function
+        self.budget = budget
+        self.placeholder = placeholder
+        self.stamp = stamp
+        self.__doc__ = function.__doc__
+        self._lock = threading.Lock()
+        # Map args -> {'stamp', 'result', 'result_prompt', 'shown', 'job',
+        # 'prompt', 'started'}, least recently used first
+        self._entries = OrderedDict()
+
+    def start(self, *args):
+        """Start computing the segment for the current prompt, unless already done"""
+        with self._lock:
+            entry = self._entries.get(args)
+            if entry is None:
+                entry = self._entries[args] = {'stamp': None, 'result': None, 'result_prompt': None,
+                                               'shown': None, 'job': None, 'prompt': None,
+                                               'started': None}
+                if len(self._entries) > MAX_SEGMENT_ENTRIES:
+                    self._entries.popitem(last=False)
+            self._entries.move_to_end(args)
+            if (entry['prompt'] != prompt_updates.prompt_number
+                and (entry['job'] is None or entry['job'].is_set())):
+                entry['prompt'] = prompt_updates.prompt_number
+                self._refresh(entry, args)
+            return entry
+
+    def __call__(self, *args):
+        """Return the text of the segment (or the placeholder)"""
+        entry = self.start(*args)
+        stamp = self.stamp(*args) if self.stamp else None
+        with self._lock:
+            job = entry['job']
+            up_to_date = (self.stamp is not None and entry['result'] is not None
+                          and entry['stamp'] == stamp)
+            remaining = entry['started'] + self._budget() - time.time()
+
+        if not up_to_date and remaining > 0:
+            job.wait(remaining)
+        with self._lock:
+            if entry['result_prompt'] == prompt_updates.prompt_number or self.stamp is not None:
+                result = entry['result']
+            else:
+                result = None
+            entry['shown'] = result
+        if result is not None:
+            return result
+        return self.placeholder() if callable(self.placeholder) else self.placeholder
+
+    def _budget(self):
+        return behavior.prompt_timeout if self.budget is None else self.budget
+
+    def _refresh(self, entry, args):
+        """Start computing the segment in the background"""
+        job = entry['job'] = threading.Event()
+        entry['started'] = time.time()
+        prompt = entry['prompt']
+        prompt_updates.start()
+
+        def run():
+            try:
+                result = self.function(*args)
+            except Exception as e:
+                common.debug('prompt segment %s failed: %s' % (self.function.__name__, e))
+                result = None
+            # Taken afterwards, as computing the result might have changed it
+            # (e.g. running git refreshes the index)
+            stamp = self.stamp(*args) if self.stamp else None
+            with self._lock:
+                if result is not None:
+                    entry['stamp'] = stamp
+                    entry['result'] = result
+                    entry['result_prompt'] = prompt
+                changed = result is not None and result != entry['shown']
+                job.set()
+            prompt_updates.finish(changed)
+
+        threading.Thread(target=run, daemon=True).start()
+
+
+def join_segments(*parts):
+    """
+    Concatenate the parts of a prompt: strings, functions returning strings
+    and PromptSegments. The segments are all started first, and the
+    functions are called before waiting for any of them (the functions can
+    start segments of their own, e.g. git_prompt()), so that all the
+    segments are computed concurrently.
+    """
+    for part in parts:
+        if isinstance(part, PromptSegment):
+            part.start()
+    texts = [part() if callable(part) and not isinstance(part, PromptSegment) else part
+             for part in parts]
+    return ''.join(text() if isinstance(text, PromptSegment) else text for text in texts)
+
+
+# Number of different argument lists for which the results of a segment are kept
+MAX_SEGMENT_ENTRIES = 32
+
+# The background computations of the prompt
+prompt_updates = _PromptUpdates()
+
+
+def _git_stamp(git_dir, work_tree=None):
+    """The mtimes of the files changed by git when the status of a repository changes"""
+    stamp = []
+    for name in ('index', 'HEAD'):
+        try:
+            stamp.append(os.stat(os.path.join(git_dir, name)).st_mtime_ns)
+        except OSError:
+            stamp.append(None)
+    return tuple(stamp)
+
+
+def _git_dir(dot_git):
+    """The git directory designated by a .git dir or file (for worktrees, submodules)"""
+    if os.path.isfile(dot_git):
+        try:
+            with open(dot_git) as f:
+                line = f.readline().strip()
+        except OSError:
+            return dot_git
+        if line.startswith('gitdir:'):
+            return os.path.join(os.path.dirname(dot_git), line[len('gitdir:'):].strip())
+    return dot_git
+
+
+def _simple_prompt():
     """
     Return a prompt containg the current path (abbreviated) plus the ERRORLEVEL
     of the previous command.
@@ -124,6 +524,43 @@ def simple_prompt():
     return abbrev_path() + errorlevel + '>' + color.Fore.DEFAULT + color.Back.DEFAULT + ' '
 
 
+def _plain_path_prompt():
+    """The placeholder of simple_prompt: the full path"""
+    return os.getcwd() + '>' + color.Fore.DEFAULT + color.Back.DEFAULT + ' '
+
+
+simple_prompt = PromptSegment(_simple_prompt, placeholder=_plain_path_prompt)
+
+
+def _git_status_prompt(git_dir, work_tree):
+    """The git part of git_prompt(): branch, dirty indicator, ahead/behind"""
+    status = _git_status(git_dir, work_tree)
+    if not status:
+        return ''
+    (head_name, ahead, behind, dirty, staged) = status
+    mark = ''
+    if dirty:
+        mark = color.Fore.RED + '*'
+    if staged:
+        mark = color.Fore.GREEN + '*'
+    ahead = '+' + ahead if ahead else ''
+    behind = '-' + behind if behind else ''
+    return (color.Fore.YELLOW + '[' +
+            mark +
+            color.Fore.YELLOW + head_name +
+            color.Fore.GREEN + ahead +
+            color.Fore.RED + behind +
+            color.Fore.YELLOW + ']' +
+            ' ')
+
+
+# The last known status of a repository is shown right away while it is
+# refreshed, unless the mtimes of .git/index or .git/HEAD have changed
+# (commits, checkouts etc.) -- plain edits of the files in the working tree
+# are only caught by the refresh
+_git_segment = PromptSegment(_git_status_prompt, stamp=_git_stamp)
+
+
 def git_prompt():
     """
     Custom prompt for git repositories.
@@ -134,65 +571,74 @@ def git_prompt():
       * count of unpushed/unpulled commits
     in addition to the typical "abbreviated current path" PyCmd prompt.
 
-    Requires git to be present in the PATH.
+    The status is computed in the background and cached per repository;
+    PyCmd redraws the prompt in place as soon as it is available.
+
+    The status is mostly read directly from the .git directory; git needs
+    to be present in the PATH for the less common cases.
     """
-    # Many common modules (sys, os, subprocess, time, re, ...) are readily
-    # shipped with PyCmd, you can directly import them for use in your
-    # configuration script. If you need extra modules that are not bundled,
-    # manipulate the sys.path so that they can be found (just make sure that the
-    # version is compatible with the one used to build PyCmd -- check
-    # README.txt)
-    import re
+    dot_git = find_updir('.git')
+    if dot_git:
+        args = (_git_dir(dot_git), os.path.dirname(dot_git))
+        _git_segment.start(*args)
+        git_part = lambda: _git_segment(*args)
+    else:
+        git_part = ''
+    return join_segments(git_part,
+                         color.Fore.DEFAULT + appearance.colors.prompt,
+                         appearance.simple_prompt)
 
+
+def _svn_status_prompt(wc_root):
+    """The svn part of svn_prompt(): the dirty indicator"""
     prompt = ''
+    dirty = _svn_dirty(wc_root)
+    prompt += color.Fore.YELLOW + '['
+    if dirty:
+        prompt += color.Fore.RED + '*'
+    else:
+        prompt += color.Fore.GREEN + '=' 
+    prompt += color.Fore.YELLOW + ']' + ' '
+    return prompt
 
-    stdout = subprocess.Popen(
-        'git status -b --porcelain -uno',
-        shell=True,
-        stdout=subprocess.PIPE,
-        stderr=-1).communicate()[0].decode(sys.stdout.encoding)
-    lines = stdout.split('\n')
-    match_branch = re.match(r'## (.+)\.\.\.(.+)?.*', lines[0])
-    if not match_branch:
-        # Maybe this is not a tracking branch, fallback
-        match_branch = re.match(r'## (.+)', lines[0])
 
-    if match_branch:
-        head_name = ""
-
-        branch_name = match_branch.group(1)
-        if branch_name == "HEAD (no branch)":
-            # detached HEAD state, try to get a symbolic/relative name
-            # (as git is invoked with --porcelain, i think it's safe to just string compare directly)
-            head_name = __get_symbolic_git_name()
-        if not head_name:
-            head_name = branch_name
-
-        ahead = behind = ''
-        match_ahead_behind = re.match(r'## .* \[(ahead (\d+))?(, )?(behind (\d+))?\]', lines[0])
-        if match_ahead_behind:
-            ahead = match_ahead_behind.group(2)
-            behind = match_ahead_behind.group(5)
-        dirty_files = lines[1:-1]
-        mark = ''
-        dirty = any(line[1] in ['M', 'D'] for line in dirty_files)
-        staged = any(line[0] in ['A', 'M', 'D', 'R'] for line in dirty_files)
-        if dirty:
-            mark = color.Fore.RED + '*'
-        if staged:
-            mark = color.Fore.GREEN + '*'
-        ahead = '+' + ahead if ahead else ''
-        behind = '-' + behind if behind else ''
-        prompt += (color.Fore.YELLOW + '[' +
-                   mark +
-                   color.Fore.YELLOW + head_name +
-                   color.Fore.GREEN + ahead +
-                   color.Fore.RED + behind +
-                   color.Fore.YELLOW + ']' +
-                   ' ')
-        
-    prompt += color.Fore.DEFAULT + appearance.colors.prompt + appearance.simple_prompt()
-    return prompt
+def _svn_dirty(wc_root):
+    """
+    Whether a working copy has local changes. This is read directly from
+    .svn/wc.db when possible (see SvnWorkingCopy.py); svn is only run for
+    what is not handled there.
+    """
+    try:
+        return SvnWorkingCopy(wc_root).is_dirty()
+    except Exception as e:
+        common.debug('reading %s failed, running svn: %s' % (wc_root, e))
+        return _run_svn_dirty(wc_root)
+
+
+def _run_svn_dirty(wc_root):
+    """Run svn to find whether a working copy has local changes"""
+    stdout = subprocess.Popen('svn stat -q', shell=True,
+                              cwd=wc_root,
+                              stdout=subprocess.PIPE,
+                              stderr=-1).communicate()[0].decode(sys.stdout.encoding)
+    # Changes of the contents in the first column, of the properties in the second one
+    return any(line[:1] in ['A', 'C', 'D', 'M', 'R', '!', '~'] or line[1:2] in ['C', 'M']
+               for line in stdout.splitlines())
+
+
+def _svn_stamp(wc_root):
+    """The mtime of the working copy database, changed by svn operations"""
+    try:
+        return os.stat(os.path.join(wc_root, '.svn', 'wc.db')).st_mtime_ns
+    except OSError:
+        return None
+
+
+# The last known status of a working copy is shown right away while it is
+# refreshed, unless its database has changed (updates, commits, reverts etc.)
+_svn_segment = PromptSegment(_svn_status_prompt,
+                             placeholder=lambda: color.Fore.YELLOW + '[?]' + ' ',
+                             stamp=_svn_stamp)
 
 
 def svn_prompt():
@@ -201,29 +647,25 @@ def svn_prompt():
     This prompt displays a dirty indicator if the current directory is under SVN
     control and the working copy is dirty.
 
-    Requires svn to be present in the PATH.
+    The status is computed in the background and cached per working copy;
+    it is mostly read directly from the .svn directory, svn needs to be
+    present in the PATH for the less common cases.
 
     """
-    import subprocess, os
-
-    prompt = ''
-    path = abbrev_path()
-    stdout = subprocess.Popen('svn stat -q', shell=True,
-                              stdout=subprocess.PIPE,
-                              stderr=-1).communicate()[0].decode(sys.stdout.encoding)
-    dirty = any(line[0] in ['M', 'A', 'D'] for line in stdout)
-    prompt += color.Fore.YELLOW + '['
-    if dirty:
-        prompt += color.Fore.RED + '*'
+    dot_svn = find_updir('.svn')
+    if dot_svn:
+        wc_root = os.path.dirname(dot_svn)
+        _svn_segment.start(wc_root)
+        svn_part = lambda: _svn_segment(wc_root)
     else:
-        prompt += color.Fore.GREEN + '=' 
-    prompt += color.Fore.YELLOW + ']' + ' '
+        # Not in a working copy
+        svn_part = ''
+    return join_segments(svn_part,
+                         color.Fore.DEFAULT + appearance.colors.prompt,
+                         appearance.simple_prompt)
 
-    prompt += color.Fore.DEFAULT + appearance.colors.prompt + appearance.simple_prompt()
-    return prompt
 
-
-def user_at_host():
+def _user_at_host():
     """
     Return a colored string in the format "user@host", meant to be
     included in the prompt (on Linux, this is automatically included
@@ -241,6 +683,9 @@ def user_at_host():
             color.Fore.DEFAULT + color.Back.DEFAULT + appearance.colors.prompt)
 
 
+user_at_host = PromptSegment(_user_at_host)
+
+
 def universal_prompt():
     """
     Universal prompt function
@@ -248,13 +693,13 @@ def universal_prompt():
     This function selects the appropriate prompt sub-function (simple prompt,
     git prompt, svn prompt) based on the current directory.
     """
-    user_host = user_at_host() + ' ' if sys.platform == 'linux'  else ''
+    user_host = (user_at_host, ' ') if sys.platform == 'linux' else ()
     if find_updir('.git'):
-        return user_host + appearance.git_prompt()
+        return join_segments(*user_host, appearance.git_prompt)
     elif find_updir('.svn'):
-        return user_host + appearance.svn_prompt()
+        return join_segments(*user_host, appearance.svn_prompt)
     else:
-        return user_host + appearance.simple_prompt()
+        return join_segments(*user_host, appearance.simple_prompt)
 
 
 class color(object):
@@ -435,6 +880,18 @@ class Behavior(_Settings):
         # Select the completion mode; currently supported: 'bash' and 'zsh'
         self.completion_mode = 'zsh'
 
+        # Maximum number of commands kept in the (persistent) command history
+        self.history_limit = 2000
+
+        # Pick up the commands entered in other (concurrently running) PyCmd
+        # sessions before each new prompt
+        self.share_history = True
+
+        # Time (in seconds) to wait for the out-of-date parts of the prompt that
+        # are computed in the background (e.g. the git status); after that, the
+        # prompt is shown as last known and redrawn when they are available
+        self.prompt_timeout = 0.1
+
         # Chat-related settings
         self.chat = self.Chat()
 
@@ -442,6 +899,15 @@ class Behavior(_Settings):
         if not self.completion_mode in ['bash', 'zsh']:
             print('Invalid setting "' + self.completion_mode + '" for "completion_mode" -- using default "zsh"')
             self.completion_mode = 'zsh'
+        if not isinstance(self.history_limit, int) or self.history_limit <= 0:
+            print('Invalid setting "' + str(self.history_limit) + '" for "history_limit" -- using default 2000')
+            self.history_limit = 2000
+        if not isinstance(self.share_history, bool):
+            print('Invalid setting "' + str(self.share_history) + '" for "share_history" -- using default True')
+            self.share_history = True
+        if not isinstance(self.prompt_timeout, (int, float)) or self.prompt_timeout < 0:
+            print('Invalid setting "' + str(self.prompt_timeout) + '" for "prompt_timeout" -- using default 0.1')
+            self.prompt_timeout = 0.1
 
 
 # Initialize global configuration instances with default values
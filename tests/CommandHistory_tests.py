@@ -0,0 +1,150 @@
+#
+# Unit tests for CommandHistory.py
+#
+import re
+import random
+from unittest import TestCase, TestSuite, defaultTestLoader
+from pycmd.CommandHistory import CommandHistory
+from pycmd.common import fuzzy_score
+
+
+def filtered_list_reference(history, line):
+    """
+    Reference implementation of the history filtering, as done by
+    CommandHistory.start before it was based on an index (plus the ranking
+    of the weakest matches)
+    """
+    words = [re.escape(w) for w in re.findall('[^\\s]+', line)]
+    boundary = '[\\s]+'
+    patterns = [
+        '^' + boundary.join(['(' + word + ')[^\\s]*' for word in words]) + '$',
+        boundary.join(['(' + word + ')[^\\s]*' for word in words]),
+    ]
+    words = [re.escape(w) for w in re.findall('[a-zA-Z0-9]+', line)]
+    boundary = '[\\s\\.\\-\\\\_]+'
+    patterns += [
+        '^' + boundary.join(['(' + word + ')[a-zA-Z0-9]*' for word in words]) + '$',
+        boundary.join(['(' + word + ')[a-zA-Z0-9]*' for word in words]),
+        '(' + re.escape(line) + ')',
+        boundary.join(['(' + word + ').*' for word in words]),
+        ''.join(['(' + word + ').*' for word in words])
+    ]
+    if len(words) <= 1:
+        patterns = [patterns[4]]
+
+    filtered_list = []
+    for (tier, pattern) in enumerate(patterns):
+        tier_list = []
+        for l in reversed(history):
+            if l in [f for (f, p) in filtered_list + tier_list]:
+                continue
+            matches = re.search(pattern, l, re.IGNORECASE)
+            if matches:
+                tier_list.append((l, [matches.span(i) for i in range(1, matches.lastindex + 1)]))
+        if tier >= 5:
+            # The weakest (substring) matches are ranked by relevance
+            lines = list(dict.fromkeys(reversed(history)))[::-1]
+            recency = {l: (i + 1) / len(lines) for (i, l) in enumerate(lines)}
+            tier_list.sort(key=lambda m: -fuzzy_score(m[0], m[1], recency[m[0]]))
+        filtered_list += tier_list
+    return filtered_list[::-1]
+
+
+def navigate_all(cmd_history):
+    """Navigate up through all the matches, return them in the order visited"""
+    while cmd_history.up():
+        pass
+    return cmd_history.trail[1:]
+
+
+class TestCommandHistory(TestCase):
+    """Test the filtering and navigation of the command history"""
+
+    history = ['git checkout master',
+               'git commit -m "fix"',
+               'cd ~/pycmd',
+               'make clean && make',
+               'git-cola',
+               'cat MAKEFILE | grep clean',
+               'python run_tests.py',
+               'git checkout -b feature/new_make',
+               'ls -la',
+               'cd ..']
+
+    filters = ['', 'g', 'git', 'g c m', 'git c', 'make', 'MAKE cl', 'cd', 'cd py',
+               'run.py', 'feat new', '-b', 'xyz', 'ls -', 'git checkout master']
+
+    def setUp(self):
+        self.cmd_history = CommandHistory()
+        self.cmd_history.list = list(self.history)
+
+    def testFilteredList(self):
+        """Compare the filtered list against the reference implementation"""
+        for filter in self.filters:
+            self.cmd_history.start(filter)
+            self.assertEqual(navigate_all(self.cmd_history),
+                             filtered_list_reference(self.history, filter)[::-1], filter)
+
+    def testRandomHistory(self):
+        random.seed(42)
+        words = ['git', 'make', 'cd', 'clean', 'Checkout', 'py', 'run', 'a.b', 'x_y', '-r', '~/dir']
+        history = [' '.join(random.choice(words) for _ in range(random.randint(1, 5))) for _ in range(300)]
+        self.cmd_history.list = history
+        for _ in range(200):
+            filter = ' '.join(random.choice(words)[:random.randint(1, 4)] for _ in range(random.randint(0, 3)))
+            self.cmd_history.start(filter)
+            self.assertEqual(navigate_all(self.cmd_history),
+                             filtered_list_reference(history, filter)[::-1], filter)
+
+    def testAddZap(self):
+        """Check that the index follows additions and removals"""
+        self.cmd_history.start('make')
+        self.cmd_history.add('cmake ..')
+        self.cmd_history.zap('make clean && make')
+        self.cmd_history.add('git checkout master')
+        self.cmd_history.start('make')
+        self.assertEqual([l for (l, _) in navigate_all(self.cmd_history)],
+                         ['cmake ..', 'git checkout -b feature/new_make', 'cat MAKEFILE | grep clean'])
+        self.assertEqual(self.cmd_history.list[-1], 'git checkout master')
+
+    def testListOperations(self):
+        self.cmd_history.list = ['a', 'b', 'a', 'c']
+        self.assertEqual(self.cmd_history.list, ['b', 'a', 'c'])
+        self.cmd_history.add('b')
+        self.cmd_history.add('d')
+        self.assertEqual(self.cmd_history.list, ['a', 'c', 'b', 'd'])
+        self.cmd_history.zap('c')
+        self.cmd_history.zap('x')
+        self.assertEqual(self.cmd_history.list, ['a', 'b', 'd'])
+        self.assertEqual(list(self.cmd_history.recent()), ['d', 'b', 'a'])
+
+    def testNavigation(self):
+        self.cmd_history.start('cd')
+        self.assertTrue(self.cmd_history.up())
+        self.assertEqual(self.cmd_history.current()[0], 'cd ..')
+        self.assertTrue(self.cmd_history.up())
+        self.assertEqual(self.cmd_history.current()[0], 'cd ~/pycmd')
+        self.assertTrue(self.cmd_history.down())
+        self.assertEqual(self.cmd_history.current()[0], 'cd ..')
+        self.assertTrue(self.cmd_history.down())
+        self.assertEqual(self.cmd_history.current()[0], 'cd')
+        self.assertTrue(self.cmd_history.up())
+        self.assertTrue(self.cmd_history.up())
+        self.assertEqual(self.cmd_history.current()[0], 'cd ~/pycmd')
+        self.assertFalse(self.cmd_history.up())
+
+    def testLazyMatching(self):
+        """The first match should not require filtering the whole history"""
+        self.cmd_history.list = ['build %d' % i for i in range(100000)] + ['git status']
+        self.cmd_history.start('git')
+        self.assertTrue(self.cmd_history.up())
+        self.assertEqual(self.cmd_history.current()[0], 'git status')
+        self.cmd_history.start('build')
+        self.assertTrue(self.cmd_history.up())
+        self.assertEqual(self.cmd_history.current()[0], 'build 99999')
+
+
+def suite():
+    suite = TestSuite()
+    suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestCommandHistory))
+    return suite
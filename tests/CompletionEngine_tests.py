@@ -0,0 +1,72 @@
+#
+# Unit tests for CompletionEngine.py
+#
+import threading
+from unittest import TestCase, TestSuite, defaultTestLoader
+from pycmd.CompletionEngine import CompletionEngine
+
+
+class TestCompletionEngine(TestCase):
+    """Test the background computation of completions"""
+
+    def setUp(self):
+        self.calls = []
+        self.proceed = threading.Event()
+        self.proceed.set()
+        self.started = threading.Event()
+        self.engine = CompletionEngine(self.complete)
+
+    def complete(self, line):
+        self.calls.append(line)
+        self.started.set()
+        self.proceed.wait()
+        if line == 'fail':
+            raise ValueError(line)
+        return (line + 'x', [line + 'x'])
+
+    def testResult(self):
+        self.assertEqual(self.engine.result('a'), ('ax', ['ax']))
+        # Results are not reused, the files might have changed since
+        self.assertEqual(self.engine.result('a'), ('ax', ['ax']))
+        self.assertEqual(self.calls, ['a', 'a'])
+        self.assertRaises(ValueError, self.engine.result, 'fail')
+
+    def testPrefetch(self):
+        self.engine.prefetch('a')
+        self.engine.prefetch('a')
+        self.assertEqual(self.engine.result('a'), ('ax', ['ax']))
+        self.assertEqual(self.calls, ['a'])
+
+    def testTimeout(self):
+        self.proceed.clear()
+        self.assertEqual(self.engine.result('a', timeout=0), None)
+        self.assertEqual(self.engine.result('a', timeout=0.01), None)
+        self.proceed.set()
+        self.assertEqual(self.engine.result('a'), ('ax', ['ax']))
+
+    def testSuperseded(self):
+        """Requests are dropped if a newer one arrives before they start"""
+        self.proceed.clear()
+        self.engine.prefetch('a')
+        self.started.wait()
+        for line in ('ab', 'abc', 'abcd'):
+            self.engine.prefetch(line)
+        self.proceed.set()
+        self.assertEqual(self.engine.result('abcd'), ('abcdx', ['abcdx']))
+        self.assertNotIn('ab', self.calls)
+        self.assertNotIn('abc', self.calls)
+
+    def testCancel(self):
+        self.proceed.clear()
+        self.engine.prefetch('a')
+        self.started.wait()
+        self.engine.cancel()
+        self.proceed.set()
+        self.assertEqual(self.engine.result('a'), ('ax', ['ax']))
+        self.assertEqual(self.calls, ['a', 'a'])
+
+
+def suite():
+    suite = TestSuite()
+    suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestCompletionEngine))
+    return suite
@@ -0,0 +1,102 @@
+#
+# Unit tests for DirCache.py
+#
+import os
+import tempfile
+import shutil
+import time
+from unittest import TestCase, TestSuite, defaultTestLoader, skipIf
+from pycmd.DirCache import DirCache
+
+
+class TestDirCache(TestCase):
+    """Test the cache of directory listings"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.dir, 'subdir'))
+        open(os.path.join(self.dir, 'file'), 'w').close()
+        self.set_old_mtime(self.dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def set_old_mtime(self, path, offset=0):
+        """Pretend that a directory was last modified long ago"""
+        os.utime(path, ns=(10 ** 18 + offset, 10 ** 18 + offset))
+
+    def testEntries(self):
+        cache = DirCache()
+        self.assertEqual(sorted(cache.entries(self.dir)),
+                         [('file', False, True), ('subdir', True, False)])
+        self.assertRaises(OSError, cache.entries, os.path.join(self.dir, 'missing'))
+        self.assertRaises(OSError, cache.entries, os.path.join(self.dir, 'file'))
+
+    def testInvalidation(self):
+        cache = DirCache()
+        entries = cache.entries(self.dir)
+        self.assertIs(cache.entries(self.dir + os.sep), entries)
+
+        # Sneak in a change that the cache cannot see...
+        open(os.path.join(self.dir, 'new'), 'w').close()
+        self.set_old_mtime(self.dir)
+        self.assertIs(cache.entries(self.dir), entries)
+
+        # ...until the modification time changes
+        self.set_old_mtime(self.dir, 1)
+        self.assertIn(('new', False, True), cache.entries(self.dir))
+
+    def testRecentlyModified(self):
+        """Listings of directories modified very recently are not reused"""
+        cache = DirCache()
+        os.utime(self.dir)
+        entries = cache.entries(self.dir)
+        self.assertIsNot(cache.entries(self.dir), entries)
+
+    def testEviction(self):
+        cache = DirCache(max_dirs=2)
+        dirs = [self.dir] + [os.path.join(self.dir, d) for d in ('a', 'b')]
+        for d in dirs[1:]:
+            os.mkdir(d)
+            self.set_old_mtime(d)
+        self.set_old_mtime(self.dir)
+        listings = [cache.entries(d) for d in dirs[:2]]
+        self.assertIs(cache.entries(dirs[0]), listings[0])
+        cache.entries(dirs[2])
+        self.assertIs(cache.entries(dirs[0]), listings[0])
+        self.assertIsNot(cache.entries(dirs[1]), listings[1])
+
+    @skipIf(not hasattr(os, 'symlink') or os.name == 'nt', 'requires symlinks')
+    def testSymlinkParent(self):
+        """".." after a symlink is the parent of the link target"""
+        cache = DirCache()
+        real = os.path.join(self.dir, 'a', 'real')
+        os.makedirs(os.path.join(real, 'sub'))
+        open(os.path.join(real, 'target_file'), 'w').close()
+        open(os.path.join(self.dir, 'other_file'), 'w').close()
+        os.symlink(os.path.join('a', 'real', 'sub'), os.path.join(self.dir, 'link'))
+        cwd = os.getcwd()
+        os.chdir(self.dir)
+        try:
+            names = [e[0] for e in cache.entries('link' + os.sep + '..' + os.sep)]
+        finally:
+            os.chdir(cwd)
+        self.assertIn('target_file', names)
+        self.assertNotIn('other_file', names)
+
+    def testTimeout(self):
+        """Directories that are slow to read are cached in the background"""
+        cache = DirCache()
+        self.assertIsNone(cache.entries(self.dir, timeout=-1))
+        for i in range(100):
+            entries = cache.entries(self.dir, timeout=-1)
+            if entries is not None:
+                break
+            time.sleep(0.05)
+        self.assertEqual(sorted(entries), [('file', False, True), ('subdir', True, False)])
+
+
+def suite():
+    suite = TestSuite()
+    suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestDirCache))
+    return suite
@@ -0,0 +1,65 @@
+#
+# Unit tests for EnvSync.py
+#
+from unittest import TestCase, TestSuite, defaultTestLoader
+from pycmd.EnvSync import EnvSync
+
+
+class RecordingEnviron(dict):
+    """A dict that records the assignments and deletions"""
+
+    def __init__(self, *args):
+        dict.__init__(self, *args)
+        self.writes = []
+
+    def __setitem__(self, name, value):
+        self.writes.append(name)
+        dict.__setitem__(self, name, value)
+
+    def __delitem__(self, name):
+        self.writes.append(name)
+        dict.__delitem__(self, name)
+
+
+class TestEnvSync(TestCase):
+    """Test the synchronization of the environment"""
+
+    def setUp(self):
+        self.environ = RecordingEnviron({'HOME': '/root', 'PATH': '/bin', 'OLD': '1'})
+        self.sync = EnvSync(self.environ)
+        self.notified = []
+        self.sync.subscribe(self.notified.append)
+
+    def testApply(self):
+        changed = self.sync.apply({'HOME': '/root', 'PATH': '/usr/bin:/bin', 'OLD': None, 'GONE': None})
+        self.assertEqual(changed, {'PATH', 'OLD'})
+        self.assertEqual(self.environ, {'HOME': '/root', 'PATH': '/usr/bin:/bin'})
+        self.assertEqual(sorted(self.environ.writes), ['OLD', 'PATH'])
+        self.assertEqual(self.notified, [{'PATH', 'OLD'}])
+
+    def testUpdate(self):
+        changed = self.sync.update({'HOME': '/root', 'PATH': '/bin', 'NEW': 'x'})
+        self.assertEqual(changed, {'OLD', 'NEW'})
+        self.assertEqual(self.environ, {'HOME': '/root', 'PATH': '/bin', 'NEW': 'x'})
+        self.assertEqual(sorted(self.environ.writes), ['NEW', 'OLD'])
+
+    def testNoChange(self):
+        self.assertEqual(self.sync.update(dict(self.environ)), set())
+        self.assertEqual(self.environ.writes, [])
+        self.assertEqual(self.notified, [])
+
+    def testFailingSubscriber(self):
+        """A failing subscriber does not prevent notifying the others"""
+        def fail(names):
+            raise ValueError(names)
+        self.sync.unsubscribe(self.notified.append)
+        self.sync.subscribe(fail)
+        self.sync.subscribe(self.notified.append)
+        self.sync.apply({'NEW': 'x'})
+        self.assertEqual(self.notified, [{'NEW'}])
+
+
+def suite():
+    suite = TestSuite()
+    suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestEnvSync))
+    return suite
@@ -0,0 +1,208 @@
+#
+# Unit tests for GitRepository.py
+#
+import os
+import shutil
+import subprocess
+import tempfile
+from os.path import join
+from unittest import TestCase, TestSuite, defaultTestLoader, skipIf
+from pycmd.GitRepository import GitRepository, Unsupported, parse_config, map_refspec
+
+
+def git(cwd, *args):
+    """Run git in the given directory, return its output"""
+    return subprocess.check_output(('git', '-c', 'user.name=PyCmd', '-c', 'user.email=pycmd@example.com',
+                                    '-c', 'init.defaultBranch=main') + args,
+                                   cwd=cwd, stderr=subprocess.DEVNULL).decode()
+
+
+@skipIf(not shutil.which('git'), 'requires git')
+class TestGitRepository(TestCase):
+    """Compare what is read from real repositories with what git says"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.repo = join(self.dir, 'repo')
+        os.mkdir(self.repo)
+        git(self.repo, 'init', '-q')
+        self.write('file.txt', ''.join('line %d\n' % i for i in range(200)))
+        self.write('dir/sub/other.txt', 'other\n')
+        self.commit('first')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, path, content, repo=None):
+        path = join(repo or self.repo, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def commit(self, message, repo=None):
+        git(repo or self.repo, 'add', '-A')
+        git(repo or self.repo, 'commit', '-q', '-m', message)
+
+    def reader(self, repo=None):
+        return GitRepository(join(repo or self.repo, '.git'))
+
+    def status(self, repo=None):
+        reader = self.reader(repo)
+        return reader.worktree_status(reader.head()[1])
+
+    def testHead(self):
+        git(self.repo, 'checkout', '-q', '-b', 'topic')
+        head = git(self.repo, 'rev-parse', 'HEAD').strip()
+        self.assertEqual(self.reader().head(), ('topic', head))
+        git(self.repo, 'pack-refs', '--all')
+        self.assertFalse(os.path.exists(join(self.repo, '.git', 'refs', 'heads', 'topic')))
+        self.assertEqual(self.reader().head(), ('topic', head))
+        git(self.repo, 'checkout', '-q', '--detach')
+        self.assertEqual(self.reader().head(), (None, head))
+
+    def testObjects(self):
+        for i in range(5):
+            self.write('file.txt', ''.join('line %d\n' % (j * (i + 2)) for j in range(200)))
+            self.commit('change %d' % i)
+
+        def check_objects():
+            reader = self.reader()
+            for line in git(self.repo, 'rev-list', '--objects', '--all').splitlines():
+                sha = line.split()[0]
+                obj_type = git(self.repo, 'cat-file', '-t', sha).strip()
+                content = subprocess.check_output(['git', 'cat-file', obj_type, sha], cwd=self.repo)
+                self.assertEqual(reader.read_object(sha), (obj_type.encode(), content))
+
+        check_objects()
+        # Packed objects, stored as deltas
+        git(self.repo, 'repack', '-q', '-a', '-d', '-f', '--depth=10')
+        self.assertFalse(os.path.exists(join(self.repo, '.git', 'objects', 'ab')))
+        check_objects()
+        with self.assertRaises(KeyError):
+            self.reader().read_object('0' * 40)
+
+    @skipIf(not os.path.exists('/proc/self/maps'), 'requires /proc')
+    def testClosePacks(self):
+        """The pack files are only mapped until close()"""
+        def mapped_packs():
+            with open('/proc/self/maps') as f:
+                return [line for line in f if join(self.repo, '.git', 'objects', 'pack') in line]
+
+        git(self.repo, 'repack', '-q', '-a', '-d')
+        reader = self.reader()
+        head = reader.head()[1]
+        self.assertEqual(reader.commit(head)[0], [])
+        self.assertTrue(mapped_packs())
+        reader.close()
+        self.assertEqual(mapped_packs(), [])
+
+        # Mapped again when needed
+        self.assertEqual(reader.read_object(head)[0], b'commit')
+        self.assertTrue(mapped_packs())
+        reader.close()
+        self.assertEqual(mapped_packs(), [])
+
+    def testAheadBehind(self):
+        clone = join(self.dir, 'clone')
+        git(self.dir, 'clone', '-q', self.repo, clone)
+        reader = self.reader(clone)
+        self.assertEqual(reader.upstream('main'), 'refs/remotes/origin/main')
+
+        for i in range(3):
+            self.write('new%d.txt' % i, str(i), repo=clone)
+            self.commit('local %d' % i, repo=clone)
+        for i in range(2):
+            self.write('file%d.txt' % i, str(i))
+            self.commit('remote %d' % i)
+        git(clone, 'fetch', '-q')
+        git(clone, 'merge', '-q', '--no-edit', 'origin/main')
+        self.write('last.txt', '', repo=clone)
+        self.commit('last', repo=clone)
+        self.write('remote.txt', '')
+        self.commit('remote again')
+        git(clone, 'fetch', '-q')
+        git(clone, 'gc', '-q')
+
+        expected = git(clone, 'rev-list', '--left-right', '--count', 'HEAD...@{u}').split()
+        (branch, head) = reader.head()
+        upstream = reader.resolve_ref(reader.upstream(branch))
+        self.assertEqual(reader.ahead_behind(head, upstream), tuple(int(n) for n in expected))
+        self.assertEqual(reader.ahead_behind(head, head), (0, 0))
+
+    def testWorktreeStatus(self):
+        self.assertEqual(self.status(), (False, False))
+        self.write('file.txt', 'changed\n')
+        self.assertEqual(self.status(), (True, False))
+        git(self.repo, 'add', 'file.txt')
+        self.assertEqual(self.status(), (False, True))
+        self.commit('second')
+        self.assertEqual(self.status(), (False, False))
+
+        os.remove(join(self.repo, 'dir', 'sub', 'other.txt'))
+        self.assertEqual(self.status(), (True, False))
+        git(self.repo, 'rm', '-q', join('dir', 'sub', 'other.txt'))
+        self.assertEqual(self.status(), (False, True))
+        git(self.repo, 'reset', '-q', '--hard')
+
+        # Same contents, different mtime
+        os.utime(join(self.repo, 'file.txt'), (0, 0))
+        self.assertEqual(self.status(), (False, False))
+        os.chmod(join(self.repo, 'file.txt'), 0o755)
+        self.assertEqual(self.status(), (True, False))
+        os.chmod(join(self.repo, 'file.txt'), 0o644)
+
+        # Untracked files are ignored (as with git status -uno)
+        self.write('untracked.txt', '')
+        self.assertEqual(self.status(), (False, False))
+
+    def testIndexVersion4(self):
+        git(self.repo, 'update-index', '--index-version', '4')
+        self.assertEqual(self.status(), (False, False))
+        self.write('dir/sub/other.txt', 'changed\n')
+        self.assertEqual(self.status(), (True, False))
+
+    def testUnsupported(self):
+        self.write('file.txt', 'conflict 1\n')
+        self.commit('main change')
+        git(self.repo, 'checkout', '-q', '-b', 'topic', 'HEAD~1')
+        self.write('file.txt', 'conflict 2\n')
+        self.commit('topic change')
+        with self.assertRaises(subprocess.CalledProcessError):
+            git(self.repo, 'merge', '-q', 'main')
+        with self.assertRaises(Unsupported):
+            self.status()
+
+    def testLinkedWorktree(self):
+        worktree = join(self.dir, 'worktree')
+        git(self.repo, 'worktree', 'add', '-q', '-b', 'other', worktree)
+        with open(join(worktree, '.git')) as f:
+            git_dir = f.read().split(':', 1)[1].strip()
+        reader = GitRepository(git_dir, worktree)
+        self.assertEqual(reader.head(), ('other', git(self.repo, 'rev-parse', 'HEAD').strip()))
+        self.assertEqual(reader.worktree_status(reader.head()[1]), (False, False))
+
+
+class TestParseConfig(TestCase):
+    def testParseConfig(self):
+        config = parse_config(b'[core]\n\tbare = false\n\tfilemode\n'
+                              b'[remote "origin"]\n\turl = "/some/path" ; comment\n'
+                              b'\tfetch = +refs/heads/*:refs/remotes/origin/*\n'
+                              b'\tfetch = +refs/tags/*:refs/tags/*\n'
+                              b'[Branch "Main"] # comment\n\tMerge = refs/heads/main\n')
+        self.assertEqual(config[('core', '')], {'bare': ['false'], 'filemode': ['true']})
+        self.assertEqual(config[('remote', 'origin')]['url'], ['/some/path'])
+        self.assertEqual(len(config[('remote', 'origin')]['fetch']), 2)
+        self.assertEqual(config[('branch', 'Main')], {'merge': ['refs/heads/main']})
+
+    def testMapRefspec(self):
+        refspec = '+refs/heads/*:refs/remotes/origin/*'
+        self.assertEqual(map_refspec(refspec, 'refs/heads/a/b'), 'refs/remotes/origin/a/b')
+        self.assertEqual(map_refspec(refspec, 'refs/tags/a'), None)
+        self.assertEqual(map_refspec('refs/heads/x:refs/remotes/y', 'refs/heads/x'), 'refs/remotes/y')
+
+
+def suite():
+    suite = TestSuite()
+    suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestGitRepository))
+    suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestParseConfig))
+    return suite
@@ -0,0 +1,102 @@
+#
+# Unit tests for HistoryFile.py
+#
+import os
+import tempfile
+import shutil
+import threading
+from unittest import TestCase, TestSuite, defaultTestLoader
+from pycmd.HistoryFile import HistoryFile, replay, TOMBSTONE
+
+
+class TestHistoryFile(TestCase):
+    """Test the journaled history storage"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'history')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def records(self):
+        with open(self.filename, encoding='utf8') as f:
+            return [l.rstrip('\n') for l in f]
+
+    def testReplay(self):
+        self.assertEqual(replay(['a', 'b', 'c', 'a', TOMBSTONE + 'b', TOMBSTONE + 'x']), ['c', 'a'])
+
+    def testPlainFile(self):
+        """History files from previous versions are read as they are"""
+        with open(self.filename, 'w', encoding='utf8') as f:
+            f.write('ls\ncd ..\nmake\n')
+        self.assertEqual(HistoryFile(self.filename, 10).read(), ['ls', 'cd ..', 'make'])
+        self.assertEqual(HistoryFile(self.filename, 2).read(), ['cd ..', 'make'])
+
+    def testAddRemove(self):
+        history = HistoryFile(self.filename, 10)
+        history.add('ls')
+        history.add('make')
+        history.add('ls')
+        history.remove('make')
+        self.assertEqual(self.records(), ['ls', 'make', 'ls', TOMBSTONE + 'make'])
+        self.assertEqual(HistoryFile(self.filename, 10).read(), ['ls'])
+
+    def testCompaction(self):
+        history = HistoryFile(self.filename, 3)
+        for i in range(6):
+            history.add('cmd %d' % i)
+        self.assertEqual(len(self.records()), 6)
+        history.add('cmd 6')
+        self.assertEqual(self.records(), ['cmd 4', 'cmd 5', 'cmd 6'])
+        self.assertEqual(history.read(), ['cmd 4', 'cmd 5', 'cmd 6'])
+
+    def testConcurrentSessions(self):
+        """Concurrent writers must not lose each other's updates"""
+        def session(n):
+            history = HistoryFile(self.filename, 1000)
+            history.read()
+            for i in range(100):
+                history.add('session %d command %d' % (n, i))
+
+        # Create the journal beforehand, reading a missing one prints a warning
+        HistoryFile(self.filename, 1000).add('first command')
+        threads = [threading.Thread(target=session, args=(n,)) for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(HistoryFile(self.filename, 1000).read()), 401)
+
+    def testReadNew(self):
+        """Records appended by other sessions are picked up incrementally"""
+        mine = HistoryFile(self.filename, 10)
+        other = HistoryFile(self.filename, 10)
+        mine.add('ls')
+        self.assertEqual(mine.read(), ['ls'])
+        self.assertEqual(mine.read_new(), [])
+        other.add('make')
+        mine.add('cd ..')
+        other.remove('ls')
+        self.assertEqual(mine.read_new(), ['make', 'cd ..', TOMBSTONE + 'ls'])
+        mine.add('pwd')
+        self.assertEqual(mine.read_new(), [])
+
+    def testReadNewAfterCompaction(self):
+        """A journal rewritten by another session must be read again"""
+        mine = HistoryFile(self.filename, 2)
+        other = HistoryFile(self.filename, 2)
+        mine.add('ls')
+        mine.read()
+        for i in range(5):
+            other.add('cmd %d' % i)
+        self.assertEqual(mine.read_new(), None)
+        self.assertEqual(mine.read(), ['cmd 3', 'cmd 4'])
+        self.assertEqual(mine.read_new(), [])
+
+
+
+def suite():
+    suite = TestSuite()
+    suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestHistoryFile))
+    return suite
@@ -0,0 +1,88 @@
+#
+# Unit tests for LineRenderer.py
+#
+import re
+import sys
+from unittest import TestCase, TestSuite, defaultTestLoader, skipIf
+from pycmd import console
+from pycmd import LineRenderer as line_renderer
+from pycmd.LineRenderer import LineRenderer
+
+
+@skipIf(sys.platform == 'win32', 'inspects the buffered output on Linux')
+class TestLineRenderer(TestCase):
+    """Test the incremental drawing of the input line"""
+
+    def setUp(self):
+        from pycmd.console import console_linux
+        self.console = console_linux
+        self.orig_get_buffer_size = console_linux.get_buffer_size
+        self.width = 20
+        for module in (console_linux, console, line_renderer):
+            module.get_buffer_size = lambda: (self.width, 10)
+        console_linux.flush_output()
+        console_linux.current_cursor[:] = [0, 0]
+        self.renderer = LineRenderer()
+        self.line = ('', '', '', '')
+
+    def tearDown(self):
+        for module in (self.console, console, line_renderer):
+            module.get_buffer_size = self.orig_get_buffer_size
+        self.console.output_buffer.clear()
+
+    def render(self, prompt, before_cursor, after_cursor='', suggestion=''):
+        """Render a line, return the output and the resulting cursor position"""
+        self.console.output_buffer.clear()
+        line = (prompt, before_cursor, after_cursor, suggestion)
+        self.renderer.render(prompt + before_cursor + after_cursor + suggestion, line, self.line)
+        self.line = line
+        # Keep the cursor movements, drop the colors
+        output = re.sub('\x1b\\[[0-9;]*m', '', ''.join(self.console.output_buffer))
+        return (output, tuple(self.console.current_cursor))
+
+    def testAppend(self):
+        """Typing at the end of the line only writes the new char"""
+        self.assertIn('\r> ', self.render('> ', 'ab')[0])
+        (output, cursor) = self.render('> ', 'abc')
+        self.assertNotIn('\r', output)
+        self.assertTrue(output.endswith('c'))
+        self.assertEqual(cursor, (5, 0))
+
+    def testInsert(self):
+        """Inserting moves the cursor back to the insertion point"""
+        self.render('> ', 'ab', 'cd')
+        self.assertEqual(self.console.current_cursor, [4, 0])
+        (output, cursor) = self.render('> ', 'abX', 'cd')
+        self.assertTrue(output.endswith('Xcd\x1b[2D'))
+        self.assertEqual(cursor, (5, 0))
+
+    def testErase(self):
+        self.render('> ', 'abcd')
+        (output, cursor) = self.render('> ', 'ab')
+        self.assertIn('  ', output)
+        self.assertEqual(cursor, (4, 0))
+
+    def testWrap(self):
+        """Positions are computed across wrapped lines"""
+        self.render('> ', 'x' * 25)
+        self.assertEqual(self.console.current_cursor, [7, 1])
+        (output, cursor) = self.render('> ', 'x' * 25, 'y')
+        self.assertEqual(cursor, (7, 1))
+        (output, cursor) = self.render('> ', 'x' * 2, 'y')
+        self.assertEqual(cursor, (4, 0))
+
+    def testFullRepaint(self):
+        """Fall back to a full repaint if the screen might differ"""
+        self.render('> ', 'ab')
+        self.width = 30
+        self.assertIn('\r> ', self.render('> ', 'abc')[0])
+        self.renderer.invalidate()
+        self.assertIn('\r> ', self.render('> ', 'abcd')[0])
+        self.line = ('> ', 'other', '', '')
+        self.assertIn('\r> ', self.render('> ', 'abcde')[0])
+
+
+def suite():
+    suite = TestSuite()
+    suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestLineRenderer))
+    return suite
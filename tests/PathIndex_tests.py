@@ -0,0 +1,75 @@
+#
+# Unit tests for PathIndex.py
+#
+import os
+import sys
+import tempfile
+import shutil
+from unittest import TestCase, TestSuite, defaultTestLoader, skipIf
+from pycmd.PathIndex import PathIndex
+
+
+@skipIf(sys.platform == 'win32', 'relies on the executable permission')
+class TestPathIndex(TestCase):
+    """Test the index of executables in the PATH"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.bin1 = os.path.join(self.dir, 'bin1')
+        self.bin2 = os.path.join(self.dir, 'bin2')
+        os.mkdir(self.bin1)
+        os.mkdir(self.bin2)
+        for name in ('git', 'gitk', 'Gimp', 'make'):
+            self.create(self.bin1, name)
+        self.create(self.bin2, 'git')
+        self.create(self.bin2, 'gcc')
+        self.create(self.bin2, 'notes.txt', executable=False)
+        os.mkdir(os.path.join(self.bin2, 'gdir'))
+        self.orig_path = os.environ['PATH']
+        os.environ['PATH'] = os.pathsep.join([self.bin1, self.bin2])
+        self.index = PathIndex(check_interval=0)
+
+    def tearDown(self):
+        os.environ['PATH'] = self.orig_path
+        shutil.rmtree(self.dir)
+
+    def create(self, dir, name, executable=True):
+        path = os.path.join(dir, name)
+        open(path, 'w').close()
+        if executable:
+            os.chmod(path, 0o755)
+        os.utime(dir, ns=(10 ** 18, 10 ** 18))
+
+    def testLookup(self):
+        self.assertEqual(self.index.lookup('g'), ['gcc', 'Gimp', 'git', 'gitk'])
+        self.assertEqual(self.index.lookup('GI'), ['Gimp', 'git', 'gitk'])
+        self.assertEqual(self.index.lookup('git'), ['git', 'gitk'])
+        self.assertEqual(self.index.lookup('x'), [])
+        self.assertEqual(self.index.lookup(), ['gcc', 'Gimp', 'git', 'gitk', 'make'])
+
+    def testRefresh(self):
+        self.index.lookup()
+        listing = self.index._listings[self.bin1]
+        self.create(self.bin2, 'gdb')
+        os.utime(self.bin2, ns=(10 ** 18 + 1, 10 ** 18 + 1))
+        self.assertEqual(self.index.lookup('gd'), ['gdb'])
+        self.assertIs(self.index._listings[self.bin1], listing)
+
+        os.environ['PATH'] = self.bin1
+        self.assertEqual(self.index.lookup('g'), ['Gimp', 'git', 'gitk'])
+        self.assertIs(self.index._listings[self.bin1], listing)
+
+    def testCheckInterval(self):
+        index = PathIndex(check_interval=3600)
+        self.assertEqual(index.lookup('m'), ['make'])
+        self.create(self.bin2, 'mc')
+        os.utime(self.bin2, ns=(10 ** 18 + 1, 10 ** 18 + 1))
+        self.assertEqual(index.lookup('m'), ['make'])
+        index.refresh(force=True)
+        self.assertEqual(index.lookup('m'), ['make', 'mc'])
+
+
+def suite():
+    suite = TestSuite()
+    suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestPathIndex))
+    return suite
@@ -0,0 +1,140 @@
+#
+# Unit tests for SvnWorkingCopy.py
+#
+import os
+import shutil
+import sqlite3
+import subprocess
+import hashlib
+import tempfile
+from os.path import join
+from unittest import TestCase, TestSuite, defaultTestLoader, skipIf
+from pycmd.SvnWorkingCopy import SvnWorkingCopy, Unsupported
+
+
+# The parts of the wc.db schema that are read
+SCHEMA = """
+CREATE TABLE nodes (wc_id INTEGER, local_relpath TEXT, op_depth INTEGER, presence TEXT,
+                    kind TEXT, properties BLOB, checksum TEXT, translated_size INTEGER,
+                    last_mod_time INTEGER, file_external BOOLEAN);
+CREATE TABLE actual_node (wc_id INTEGER, local_relpath TEXT, properties BLOB,
+                          conflict_old TEXT, conflict_working TEXT, prop_reject TEXT,
+                          conflict_data BLOB);
+CREATE TABLE work_queue (id INTEGER PRIMARY KEY, work BLOB);
+PRAGMA user_version = 31;
+"""
+
+
+class TestSvnWorkingCopy(TestCase):
+    """Test reading the status from a (hand-made) wc.db"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        os.mkdir(join(self.dir, '.svn'))
+        os.mkdir(join(self.dir, 'sub'))
+        self.db = sqlite3.connect(join(self.dir, '.svn', 'wc.db'))
+        self.db.executescript(SCHEMA)
+        self.add_node('', 'dir')
+        self.add_node('sub', 'dir')
+        self.add_file('sub/file.txt', b'contents\n')
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.dir)
+
+    def add_node(self, relpath, kind, op_depth=0, props=None, checksum=None, size=None, mtime=None):
+        self.db.execute('INSERT INTO nodes VALUES (1, ?, ?, ?, ?, ?, ?, ?, ?, NULL)',
+                        (relpath, op_depth, 'normal', kind, props, checksum, size, mtime))
+        self.db.commit()
+
+    def add_file(self, relpath, content, props=None):
+        """Add a checked out file, as recorded by svn"""
+        path = join(self.dir, *relpath.split('/'))
+        with open(path, 'wb') as f:
+            f.write(content)
+        st = os.stat(path)
+        self.add_node(relpath, 'file', props=props,
+                      checksum='$sha1$' + hashlib.sha1(content).hexdigest(),
+                      size=st.st_size, mtime=st.st_mtime_ns // 1000)
+
+    def is_dirty(self):
+        return SvnWorkingCopy(self.dir).is_dirty()
+
+    def testClean(self):
+        self.assertFalse(self.is_dirty())
+        # Same contents, different mtime
+        os.utime(join(self.dir, 'sub', 'file.txt'), (0, 0))
+        self.assertFalse(self.is_dirty())
+
+    def testModified(self):
+        with open(join(self.dir, 'sub', 'file.txt'), 'wb') as f:
+            f.write(b'contenTs\n')
+        self.assertTrue(self.is_dirty())
+
+    def testMissing(self):
+        os.remove(join(self.dir, 'sub', 'file.txt'))
+        self.assertTrue(self.is_dirty())
+
+    def testScheduled(self):
+        self.add_node('sub/new.txt', 'file', op_depth=2)
+        self.assertTrue(self.is_dirty())
+
+    def testProperties(self):
+        self.db.execute("INSERT INTO actual_node VALUES (1, 'sub', X'28292929', NULL, NULL, NULL, NULL)")
+        self.db.commit()
+        self.assertTrue(self.is_dirty())
+
+    def testUnsupported(self):
+        self.add_file('eol.txt', b'line\n', props=b'(svn:eol-style 6 native)')
+        self.assertFalse(self.is_dirty())
+        os.utime(join(self.dir, 'eol.txt'), (0, 0))
+        with self.assertRaises(Unsupported):
+            self.is_dirty()
+
+        self.db.execute('PRAGMA user_version = 20')
+        with self.assertRaises(Unsupported):
+            self.is_dirty()
+        with self.assertRaises(Unsupported):
+            SvnWorkingCopy(join(self.dir, 'sub')).is_dirty()
+
+
+def svn(cwd, *args):
+    subprocess.check_call(('svn',) + args, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+@skipIf(not shutil.which('svn') or not shutil.which('svnadmin'), 'requires svn')
+class TestSvnWorkingCopyWithSvn(TestCase):
+    """Compare with what svn says about real working copies"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        repo = join(self.dir, 'repo')
+        subprocess.check_call(['svnadmin', 'create', repo])
+        self.wc = join(self.dir, 'wc')
+        svn(self.dir, 'checkout', '-q', 'file://' + repo.replace(os.sep, '/'), self.wc)
+        with open(join(self.wc, 'file.txt'), 'w') as f:
+            f.write('contents\n')
+        svn(self.wc, 'add', '-q', 'file.txt')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testStatus(self):
+        reader = SvnWorkingCopy(self.wc)
+        self.assertTrue(reader.is_dirty())
+        svn(self.wc, 'commit', '-q', '-m', 'first')
+        self.assertFalse(reader.is_dirty())
+        with open(join(self.wc, 'file.txt'), 'a') as f:
+            f.write('more\n')
+        self.assertTrue(reader.is_dirty())
+        svn(self.wc, 'revert', '-q', 'file.txt')
+        self.assertFalse(reader.is_dirty())
+        svn(self.wc, 'propset', '-q', 'some:prop', 'value', 'file.txt')
+        self.assertTrue(reader.is_dirty())
+
+
+def suite():
+    suite = TestSuite()
+    suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestSvnWorkingCopy))
+    suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestSvnWorkingCopyWithSvn))
+    return suite
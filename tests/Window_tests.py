@@ -2,8 +2,10 @@
 # Unit tests for Window.py
 #
 
-from unittest import TestCase, TestSuite, defaultTestLoader
+import sys
+from unittest import TestCase, TestSuite, defaultTestLoader, skipIf
 from pycmd.Window import Window
+from pycmd.common import FuzzyMatcher
 from pycmd.completion import wildcard_to_regex
 from pycmd.console import get_buffer_size
 
@@ -60,6 +62,64 @@ class TestWindow(TestCase):
         self.assertEqual(self.window_large.num_columns, 1)
         self.assertEqual(self.window_large.num_lines, 1)
 
+    def testIncrementalFilter(self):
+        """Narrowing down the previous results gives the same entries"""
+        entries = ['git status', 'git stash', 'grep stat x', 'Git Stat', 'ls', 'make stats']
+        window = Window(entries, wildcard_to_regex('*'), width=40)
+        for filter in ['g', 'gi', 'git', 'git ', 'git s', 'git st', 'git s', 'gi', '', 'stat', 'stat ', 'stat x']:
+            window.filter = filter
+            self.assertEqual(window.entries, [entries[i] for i in FuzzyMatcher(window.filter).rank(entries)])
+
+    def testRanking(self):
+        """The entries are sorted by relevance, the history ones in reverse"""
+        entries = ['docker commit', 'git commit', 'tig', 'legit']
+        window = Window(entries, wildcard_to_regex('*'), width=40)
+        self.assertEqual(window.entries, entries)
+        window.filter = 'git'
+        self.assertEqual(window.entries, ['git commit', 'legit'])
+        window.filter = 'co'
+        self.assertEqual(window.entries, ['git commit', 'docker commit'])
+
+        window = Window(entries, wildcard_to_regex('*'), width=40, history=True)
+        window.filter = 'co'
+        self.assertEqual(window.entries, ['docker commit', 'git commit'])
+
+    def testHistoryOrder(self):
+        """Without a filter, the history is shown as is and the newest entry is selected"""
+        window = Window(['oldest', 'middle', 'newest'], wildcard_to_regex('*'), width=40, history=True)
+        self.assertEqual(window.entries, ['oldest', 'middle', 'newest'])
+        # As set up by interact(default_selection_last=True)
+        window._default_selection_last = True
+        window.selected_line = window.selected_column = 0
+        for filter in ('d', ''):
+            window.filter = filter
+            selected = window.entries[window.selected_line + window.selected_column * window.num_lines]
+            self.assertEqual(selected, 'middle' if filter else 'newest')
+        self.assertEqual(window.entries, ['oldest', 'middle', 'newest'])
+
+    @skipIf(sys.platform == 'win32', 'inspects the buffered output on Linux')
+    def testRedrawChangedRows(self):
+        """Only the rows that have changed are drawn again"""
+        from pycmd.console import console_linux
+        orig_get_buffer_size = console_linux.get_buffer_size
+        console_linux.get_buffer_size = lambda: (80, 25)
+        self.addCleanup(setattr, console_linux, 'get_buffer_size', orig_get_buffer_size)
+        window = Window(['entry%d' % i for i in range(5)], wildcard_to_regex('*'), width=40)
+        window.selected_line = window.selected_column = 0
+        console_linux.output_buffer.clear()
+        window.display()
+        first = ''.join(console_linux.output_buffer)
+        self.assertTrue(all(('entry%d' % i) in first for i in range(5)))
+
+        console_linux.output_buffer.clear()
+        window.selected_line = 1
+        window.display()
+        second = ''.join(console_linux.output_buffer)
+        console_linux.output_buffer.clear()
+        self.assertIn('entry0', second)
+        self.assertIn('entry1', second)
+        self.assertFalse(any(('entry%d' % i) in second for i in range(2, 5)))
+
 
 def suite():
     suite = TestSuite()
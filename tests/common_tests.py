@@ -3,10 +3,81 @@
 #
 import os
 import sys
+import string
+import random
 from unittest import TestCase, TestSuite, defaultTestLoader
 from pycmd.common import parse_line, escape_special_chars_in_quotes, unescape, fuzzy_match
+from pycmd.common import FuzzyMatcher, fuzzy_score
 from pycmd.common import associated_application, full_executable_path, is_gui_application
-from pycmd.common import abbrev_tilde
+from pycmd.common import abbrev_tilde, tokenize, parse_line_spans, IncrementalTokenizer, common_prefix_len
+from pycmd import fsm
+
+
+def parse_line_fsm(line):
+    """
+    Reference tokenizer, built on top of fsm.FSM; this is the implementation
+    parse_line used before the tokenizer was compiled into a table.
+    """
+
+    def accumulate(fsm):
+        fsm.memory[-1] = fsm.memory[-1] + fsm.input_symbol
+
+    def start_empty_token(fsm):
+        if fsm.memory[-1] != '':
+            fsm.memory.append('')
+
+    def start_token(fsm):
+        start_empty_token(fsm)
+        accumulate(fsm)
+
+    def accumulate_last(fsm):
+        accumulate(fsm)
+        start_empty_token(fsm)
+
+    f = fsm.FSM('init', [''])
+
+    f.add_transition_list(string.whitespace, 'init', start_empty_token, 'whitespace')
+    f.add_transition('"', 'init', accumulate, 'in_string')
+    f.add_transition('|', 'init', start_token, 'pipe')
+    f.add_transition('&', 'init', start_token, 'amp')
+    f.add_transition('>', 'init', start_token, 'gt')
+    f.add_transition('<', 'init', accumulate, 'awaiting_&')
+    f.add_transition('^', 'init', accumulate, 'escape')
+    f.add_transition_list(string.digits, 'init', accumulate, 'redir')
+    f.add_transition_any('init', accumulate, 'init')
+    f.add_transition_list(string.whitespace, 'whitespace', None, 'whitespace')
+    f.add_empty_transition('whitespace', 'init')
+    f.add_transition('"', 'in_string', accumulate, 'init')
+    f.add_transition_any('in_string', accumulate, 'in_string')
+    f.add_transition('|', 'pipe', accumulate_last, 'init')
+    f.add_empty_transition('pipe', 'init', start_empty_token)
+    f.add_transition('&', 'amp', accumulate_last, 'init')
+    f.add_empty_transition('amp', 'init', start_empty_token)
+    f.add_transition('>', 'gt', accumulate, 'awaiting_&')
+    f.add_transition('&', 'gt', accumulate, 'awaiting_nr')
+    f.add_empty_transition('gt', 'init', start_empty_token)
+    f.add_transition('<', 'redir', accumulate, 'awaiting_&')
+    f.add_transition('>', 'redir', accumulate, 'gt')
+    f.add_empty_transition('redir', 'init')
+    f.add_transition('&', 'awaiting_&', accumulate, 'awaiting_nr')
+    f.add_empty_transition('awaiting_&', 'init', start_empty_token)
+    f.add_transition_list(string.digits, 'awaiting_nr', accumulate_last, 'init')
+    f.add_empty_transition('awaiting_nr', 'init', start_empty_token)
+    f.add_transition_any('escape', accumulate, 'init')
+
+    f.process_list(line)
+    if len(f.memory) > 0 and f.memory[-1] == '':
+        del f.memory[-1]
+    return f.memory
+
+
+def tokenize_fsm(line):
+    """Reference version of tokenize, built on top of parse_line_fsm"""
+    tokens = parse_line_fsm(line)
+    if tokens == [] or (line[-1] in ' |&><' and parse_line_fsm(line) == parse_line_fsm(line + ' ')):
+        tokens += ['']
+    return tokens
+
 
 class TestParseLine(TestCase):
 
@@ -202,6 +273,11 @@ class TestParseLine(TestCase):
             second_parse = parse_line(' '.join(first_parse))
             self.assertEqual(first_parse, second_parse)
 
+    def testParseLineSpans(self):
+        """Test that the token spans point back into the original line"""
+        for input, expected in self.lines_to_parse:
+            self.assertEqual([input[start:end] for (start, end) in parse_line_spans(input)], expected)
+
     def testUnescape(self):
         """Test that result of unescape equals expected result."""
         for input, expected in self.strings_to_unescape:
@@ -214,6 +290,60 @@ class TestParseLine(TestCase):
 
 
 
+class TestTokenizerDifferential(TestCase):
+    """Compare the compiled tokenizer against the reference FSM implementation"""
+
+    alphabet = 'ab1 2\t"|&><^%/\\'
+
+    def corpus(self):
+        random.seed(1234)
+        lines = [input for (input, _) in TestParseLine.lines_to_parse]
+        lines += [''.join(random.choice(self.alphabet) for _ in range(random.randint(0, 20)))
+                  for _ in range(3000)]
+        # Also check all the prefixes, as seen while typing
+        return lines + [l[:i] for l in lines[:len(TestParseLine.lines_to_parse)] for i in range(len(l))]
+
+    def testParseLine(self):
+        for line in self.corpus():
+            self.assertEqual(parse_line(line), parse_line_fsm(line), repr(line))
+
+    def testTokenize(self):
+        for line in self.corpus():
+            self.assertEqual(tokenize(line), tokenize_fsm(line), repr(line))
+
+
+class TestIncrementalTokenizer(TestCase):
+    """Check that incremental tokenization matches tokenizing from scratch"""
+
+    def testTyping(self):
+        tokenizer = IncrementalTokenizer()
+        for input, _ in TestParseLine.lines_to_parse:
+            for i in range(len(input) + 1):
+                self.assertEqual(tokenizer.tokenize(input[:i]), tokenize(input[:i]))
+            for i in range(len(input), -1, -1):
+                self.assertEqual(tokenizer.tokenize(input[:i]), tokenize(input[:i]))
+
+    def testRandomEdits(self):
+        random.seed(4321)
+        tokenizer = IncrementalTokenizer()
+        line = ''
+        for _ in range(5000):
+            pos = random.randint(0, len(line))
+            if random.random() < 0.6:
+                text = ''.join(random.choice(TestTokenizerDifferential.alphabet)
+                               for _ in range(random.randint(1, 3)))
+                line = line[:pos] + text + line[pos:]
+            else:
+                line = line[:pos] + line[pos + random.randint(1, 5):]
+            self.assertEqual(tokenizer.tokenize(line), tokenize(line), repr(line))
+
+    def testCommonPrefixLen(self):
+        self.assertEqual(common_prefix_len('', 'abc'), 0)
+        self.assertEqual(common_prefix_len('abc', 'abc'), 3)
+        self.assertEqual(common_prefix_len('abcd', 'abxd'), 2)
+        self.assertEqual(common_prefix_len('abc', 'abcdef'), 3)
+
+
 class TestFuzzyMatch(TestCase):
     match_tests = [
         ('first', 'this first line will match first', [(5, 10)]),
@@ -229,6 +359,27 @@ class TestFuzzyMatch(TestCase):
         for (substr, str, result) in self.match_tests:
             self.assertEqual(fuzzy_match(substr, str), result)
 
+    def testRank(self):
+        entries = ['make stats', 'git status', 'grep stat x', 'digest', 'git stash', 'ls']
+        matcher = FuzzyMatcher('g st')
+        self.assertEqual([entries[i] for i in matcher.rank(entries)],
+                         ['git stash', 'git status', 'grep stat x', 'digest'])
+        # The recent (last) entries are preferred when ranking a history
+        self.assertEqual([entries[i] for i in matcher.rank(entries, recency=True)][:2],
+                         ['git stash', 'git status'])
+        self.assertEqual(matcher.rank(entries, indices=[3, 1]), [1, 3])
+        # An empty filter keeps the order
+        self.assertEqual(FuzzyMatcher('').rank(entries), list(range(len(entries))))
+
+    def testScore(self):
+        # Word boundaries, contiguous words and shorter strings score higher
+        self.assertGreater(fuzzy_score('git status', [(0, 3)]), fuzzy_score('legit', [(2, 5)]))
+        self.assertGreater(fuzzy_score('runTests', [(3, 4)]), fuzzy_score('runtests', [(3, 4)]))
+        self.assertGreater(fuzzy_score('git st', [(0, 3), (4, 6)]),
+                           fuzzy_score('git xx st', [(0, 3), (7, 9)]))
+        self.assertGreater(fuzzy_score('ls', [(0, 2)]), fuzzy_score('ls -la', [(0, 2)]))
+        self.assertGreater(fuzzy_score('ls', [(0, 2)], 1), fuzzy_score('ls', [(0, 2)], 0.5))
+
 class TestAppIdentification(TestCase):
     """
     Test various functions used for identifying the executable
@@ -289,6 +440,8 @@ class TestPathManipulation(TestCase):
 def suite():
     suite = TestSuite()
     suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestParseLine))
+    suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestTokenizerDifferential))
+    suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestIncrementalTokenizer))
     suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestFuzzyMatch))
     if sys.platform == 'win32':
         suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestAppIdentification))
@@ -2,7 +2,8 @@
 # Unit tests for console.py
 #
 
-from unittest import TestCase, TestSuite, defaultTestLoader
+import sys
+from unittest import TestCase, TestSuite, defaultTestLoader, skipIf
 from pycmd import console
 from sys import stdout
 from pycmd.console import get_text_attributes, set_text_attributes
@@ -107,9 +108,72 @@ class TestColors(TestCase):
         attr = get_text_attributes()
         self.assertEqual(attr , self.orig_attr)
 
+    def testParseColorCodes(self):
+        """Text is split in runs with the same attributes"""
+        (runs, attr) = console.parse_color_codes('a' + color.Fore.SET_RED + 'b' + color.Fore.TOGGLE_RED
+                                                 + color.Back.SET_BLUE + color.Back.CLEAR_BLUE + 'c',
+                                                 console.FOREGROUND_GREEN)
+        self.assertEqual(runs, ((console.FOREGROUND_GREEN, 'a'),
+                                (console.FOREGROUND_GREEN | console.FOREGROUND_RED, 'b'),
+                                (console.FOREGROUND_GREEN, 'c')))
+        self.assertEqual(attr, console.FOREGROUND_GREEN)
+
+    def testRemoveEscapeSequences(self):
+        self.assertEqual(console.remove_escape_sequences(color.Fore.RED + 'ab' + color.Back.DEFAULT
+                                                         + 'c' + color.Fore.TOGGLE_BRIGHT),
+                         'abc')
+        self.assertEqual(console.remove_escape_sequences('no colors'), 'no colors')
+
+
+@skipIf(sys.platform == 'win32', 'the output is buffered on Linux only')
+class TestSaneCursor(TestCase):
+    """Test the cursor tracking and line wrapping of the buffered output"""
+
+    def setUp(self):
+        from pycmd.console import console_linux
+        self.console = console_linux
+        self.orig_get_buffer_size = console_linux.get_buffer_size
+        console_linux.get_buffer_size = lambda: (10, 5)
+        console_linux.flush_output()
+        console_linux.current_cursor[:] = [0, 0]
+
+    def tearDown(self):
+        self.console.get_buffer_size = self.orig_get_buffer_size
+        self.console.output_buffer.clear()
+
+    def write(self, s):
+        """Write s, return the queued output and the cursor position"""
+        self.console.output_buffer.clear()
+        self.console.write_with_sane_cursor(s)
+        return (''.join(self.console.output_buffer), tuple(self.console.current_cursor))
+
+    def testSimple(self):
+        self.assertEqual(self.write('abc'), ('abc', (3, 0)))
+        self.assertEqual(self.write('\bd\n'), ('\bd\n\r', (0, 1)))
+        self.assertEqual(self.write('xy\rz'), ('xy\rz', (1, 1)))
+
+    def testWrap(self):
+        self.console.current_cursor[:] = [7, 0]
+        self.assertEqual(self.write('abc'), ('abc\r\n', (0, 1)))
+        self.assertEqual(self.write('0123456789' * 2 + 'x'),
+                         ('0123456789\r\n0123456789\r\nx', (1, 3)))
+
+    def testBottom(self):
+        """The cursor does not go below the last line"""
+        self.assertEqual(self.write('\n' * 7 + '0123456789ab')[1], (2, 4))
+
+    def testSingleWrite(self):
+        """Nothing reaches the terminal before flushing"""
+        stdout.write(color.Fore.RED + 'abc' + color.Fore.DEFAULT)
+        console.move_cursor(0, 0)
+        self.assertTrue(self.console.output_buffer)
+        stdout.flush()
+        self.assertEqual(self.console.output_buffer, [])
+
 
 def suite():
     suite = TestSuite()
     suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestColors))
+    suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestSaneCursor))
     return suite
 
@@ -0,0 +1,129 @@
+#
+# Unit tests for pty_control.py
+#
+import os
+import sys
+from unittest import TestCase, TestSuite, defaultTestLoader, skipIf
+if sys.platform != 'win32':
+    from pycmd import pty_control
+    from pycmd.pty_control import MARKER_BYTES, ENV_SEPARATOR_BYTES, relay_output, partial_marker_len
+    from pycmd.pty_control import parse_env_dump, take_env_changes
+
+
+@skipIf(sys.platform == 'win32', 'the pty relay is Linux-only')
+class TestRelayOutput(TestCase):
+    """Test the detection of the prompt MARKER in the shell output"""
+
+    def setUp(self):
+        # Additional shell output is read from a pipe; the output flushed by
+        # the relay when the prompt is detected goes to another pipe
+        (self.shell, self.shell_write) = os.pipe()
+        (self.tty, tty_write) = os.pipe()
+        self.stdout = os.dup(1)
+        os.dup2(tty_write, 1)
+        os.close(tty_write)
+        pty_control.pass_through = True
+        pty_control.marker_acc = b''
+        pty_control.command_completed.clear()
+        pty_control.env_dump = None
+        pty_control.shell_env = {'HOME': '/root', 'OLD': '1'}
+        take_env_changes()
+
+    def tearDown(self):
+        os.dup2(self.stdout, 1)
+        for fd in (self.stdout, self.shell, self.shell_write, self.tty):
+            os.close(fd)
+
+    def relay(self, chunks):
+        """Relay the given chunks of shell output, return what reaches the tty"""
+        output = b''
+        for (i, chunk) in enumerate(chunks):
+            os.write(self.shell_write, b''.join(chunks[i + 1:]))
+            relayed = relay_output(self.shell, chunk)
+            if not pty_control.pass_through:
+                # The output before the prompt is written out directly; any
+                # output left after the prompt is relayed as is
+                os.close(1)
+                os.set_blocking(self.shell, False)
+                try:
+                    extra = os.read(self.shell, 65536)
+                except BlockingIOError:
+                    extra = b''
+                return output + os.read(self.tty, 65536) + relayed + extra
+            output += relayed
+            os.read(self.shell, 65536) if i + 1 < len(chunks) else None
+        return output
+
+    def testPartialMarker(self):
+        self.assertEqual(partial_marker_len(b'abc'), 0)
+        self.assertEqual(partial_marker_len(b'abc' + MARKER_BYTES[:1]), 1)
+        self.assertEqual(partial_marker_len(b'abc' + MARKER_BYTES[:-1]), len(MARKER_BYTES) - 1)
+        self.assertEqual(partial_marker_len(MARKER_BYTES[:3] + b'x'), 0)
+
+    def testPassThrough(self):
+        self.assertEqual(relay_output(self.shell, b'no newline'), b'no newline')
+        self.assertEqual(relay_output(self.shell, b'abc' + MARKER_BYTES[:4]), b'abc')
+        self.assertEqual(relay_output(self.shell, b'xyz'), MARKER_BYTES[:4] + b'xyz')
+        self.assertTrue(pty_control.pass_through)
+
+    def testSplitMarker(self):
+        """The MARKERs must be detected wherever the chunks are split"""
+        data = b'output\n' + MARKER_BYTES + b'/tmp|0' + MARKER_BYTES + b'extra'
+        for split in range(1, len(data)):
+            for split2 in (split + 1, split + 7, len(data)):
+                self.tearDown()
+                self.setUp()
+                chunks = [data[:split], data[split:split2], data[split2:]]
+                self.assertEqual(self.relay([c for c in chunks if c]), b'output\nextra')
+                self.assertFalse(pty_control.pass_through)
+                self.assertEqual(pty_control.captured_prompt, '/tmp|0')
+                self.assertTrue(pty_control.command_completed.is_set())
+
+    def testWrappedPrompt(self):
+        """Characters re-printed by bash after '\\r' are dropped from the prompt"""
+        data = b'out' + MARKER_BYTES + b'/very/lo\rong|0' + MARKER_BYTES
+        self.assertEqual(self.relay([data]), b'out')
+        self.assertEqual(pty_control.captured_prompt, '/very/long|0')
+
+    def testEnvironment(self):
+        """The variables changed in the shell are sent along with the prompt"""
+        def prompt(dump):
+            return MARKER_BYTES + dump + ENV_SEPARATOR_BYTES + b'/tmp|0' + MARKER_BYTES
+
+        dump = b'declare -x HOME="/root"\r\ndeclare -x NEW="a b"\r\n'
+        self.assertEqual(self.relay([b'out\n' + prompt(dump)]), b'out\n')
+        self.assertEqual(pty_control.captured_prompt, '/tmp|0')
+        self.assertEqual(take_env_changes(), {'NEW': 'a b', 'OLD': None})
+        self.assertEqual(take_env_changes(), {})
+
+        # Same environment as before
+        self.tearDown()
+        self.setUp()
+        pty_control.env_dump = dump.replace(b'\r', b'')
+        pty_control.shell_env = {'HOME': '/root', 'NEW': 'a b'}
+        self.relay([prompt(dump)[:20], prompt(dump)[20:]])
+        self.assertEqual(take_env_changes(), {})
+
+    def testPromptRedisplay(self):
+        """Repaints of the prompt by readline (e.g. on SIGWINCH) are dropped"""
+        redisplay = b'\r\x1b[K\r' + ENV_SEPARATOR_BYTES + b'/tmp|0' + MARKER_BYTES
+        data = MARKER_BYTES + ENV_SEPARATOR_BYTES + b'/tmp|0' + MARKER_BYTES
+        self.assertEqual(self.relay([b'out' + data + redisplay + b'job\n']), b'outjob\n')
+        self.assertEqual(pty_control.captured_prompt, '/tmp|0')
+
+    def testParseEnvDump(self):
+        dump = (b'declare -x BAR="x\'y\\"\\$z\\\\w"\n'
+                b'declare -x EMPTY=""\n'
+                b"declare -x FOO=$'a\\nb \\303\\251\\u00e9\\x41\\e'\n"
+                b'declare -x NOVAL\n'
+                b'declare -x OLD="line1\nline2"\n'
+                b'export POSIX="1"\n')
+        self.assertEqual(parse_env_dump(dump),
+                         {'BAR': 'x\'y"$z\\w', 'EMPTY': '', 'FOO': 'a\nb \u00e9\u00e9A\x1b',
+                          'OLD': 'line1\nline2', 'POSIX': '1'})
+
+
+def suite():
+    suite = TestSuite()
+    suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestRelayOutput))
+    return suite
@@ -1,6 +1,14 @@
+import os
 import sys
-from unittest import TestCase, TestSuite, defaultTestLoader
-from pycmd.pycmd_public import abbrev_path
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from unittest import TestCase, TestSuite, defaultTestLoader, skipIf
+from pycmd import pycmd_public
+from pycmd.pycmd_public import abbrev_path, find_updir, behavior, prompt_updates
+from pycmd.pycmd_public import PromptSegment, join_segments
 from os.path import join, expanduser
 import getpass
 
@@ -31,7 +39,245 @@ class TestAbbrevPath(TestCase):
             assert abbrev_path('/usr/lib/something') == '/u/lib/something'
             assert(abbrev_path('/usr/lib64/something')) == '/u/l64/something'
 
+    def testAbbrevCache(self):
+        """The abbreviations are computed again when the parent dir changes"""
+        parent = tempfile.mkdtemp()
+        try:
+            os.mkdir(join(parent, 'SomeDir'))
+            # Old enough for the cached abbreviations to be trusted
+            os.utime(parent, (0, 0))
+            path = join(parent, 'SomeDir', 'x')
+            prefix = os.path.dirname(abbrev_path(join(parent, 'x')))
+            self.assertEqual(abbrev_path(path), join(prefix, 'SD', 'x'))
+
+            listed = []
+            orig_scandir = os.scandir
+            os.scandir = lambda path: listed.append(path) or orig_scandir(path)
+            try:
+                self.assertEqual(abbrev_path(path), join(prefix, 'SD', 'x'))
+            finally:
+                os.scandir = orig_scandir
+            self.assertNotIn(parent, listed)
+
+            os.mkdir(join(parent, 'SomeData'))
+            self.assertEqual(abbrev_path(path), join(prefix, 'SomeDir', 'x'))
+        finally:
+            shutil.rmtree(parent)
+
+
+class TestFindUpdir(TestCase):
+    """Test the caching of the lookups in the ancestor directories"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.sub = join(self.dir, 'sub')
+        os.mkdir(self.sub)
+        os.mkdir(join(self.dir, '.git'))
+        # Old enough for the cached results to be trusted
+        os.utime(self.sub, (0, 0))
+        self.orig_exists = os.path.exists
+        self.checked = []
+        os.path.exists = lambda path: self.checked.append(path) or self.orig_exists(path)
+
+    def tearDown(self):
+        os.path.exists = self.orig_exists
+        shutil.rmtree(self.dir)
+
+    def find(self, name):
+        """Look for name from a new prompt"""
+        prompt_updates.next_prompt()
+        return find_updir(name, self.sub)
+
+    def testCached(self):
+        self.assertEqual(self.find('.git'), join(self.dir, '.git'))
+        self.assertTrue(self.checked)
+        del self.checked[:]
+        self.assertEqual(self.find('.git'), join(self.dir, '.git'))
+        self.assertEqual(self.checked, [])
+
+        # Looked up again when the directory changes (as seen by the next prompt)
+        os.mkdir(join(self.sub, '.git'))
+        self.assertEqual(find_updir('.git', self.sub), join(self.dir, '.git'))
+        self.assertEqual(self.find('.git'), join(self.sub, '.git'))
+
+    def testExpired(self):
+        self.assertIsNone(self.find('.svn'))
+        os.mkdir(join(self.dir, '.svn'))
+        self.assertIsNone(self.find('.svn'))
+        orig_ttl = pycmd_public.UPDIR_CACHE_TTL
+        pycmd_public.UPDIR_CACHE_TTL = -1
+        try:
+            self.assertEqual(self.find('.svn'), join(self.dir, '.svn'))
+        finally:
+            pycmd_public.UPDIR_CACHE_TTL = orig_ttl
+
+
+def git(cwd, *args):
+    subprocess.check_call(('git', '-c', 'user.name=PyCmd', '-c', 'user.email=pycmd@example.com') + args,
+                          cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+class TestPromptSegment(TestCase):
+    """Test the background computation of the prompt segments"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.git_dir = join(self.dir, '.git')
+        os.mkdir(self.git_dir)
+        for name in ('index', 'HEAD'):
+            open(join(self.git_dir, name), 'w').close()
+        self.segment = PromptSegment(self.compute, stamp=pycmd_public._git_stamp)
+        self.results = []
+        self.release = threading.Event()
+        self.orig_timeout = behavior.prompt_timeout
+        prompt_updates.next_prompt()
+
+    def tearDown(self):
+        self.release.set()
+        behavior.prompt_timeout = self.orig_timeout
+        shutil.rmtree(self.dir)
+        while prompt_updates.pending():
+            prompt_updates.take_changed()
+
+    def compute(self, *args):
+        """Fake segment computation, finished when self.release is set"""
+        self.release.wait()
+        return self.results.pop(0)
+
+    def get(self):
+        return self.segment(self.git_dir, self.dir)
+
+    def wait_refresh(self):
+        self.release.set()
+        while prompt_updates.pending() and not prompt_updates.take_changed():
+            threading.Event().wait(0.01)
+        self.release.clear()
+
+    def testRefresh(self):
+        # Nothing known yet, the first result is awaited for prompt_timeout
+        behavior.prompt_timeout = 0.01
+        self.results = ['[main] ', '[*main] ']
+        self.assertEqual(self.get(), '')
+        self.assertTrue(prompt_updates.pending())
+        self.wait_refresh()
+        self.assertEqual(self.get(), '[main] ')
+        self.assertFalse(prompt_updates.pending())
+
+        # Same stamp: the last known result is shown while refreshing
+        prompt_updates.next_prompt()
+        self.assertEqual(self.get(), '[main] ')
+        self.wait_refresh()
+        self.assertEqual(self.get(), '[*main] ')
+        self.assertFalse(prompt_updates.pending())
+
+    def testOutOfDate(self):
+        """A result known to be out of date is awaited (for a while)"""
+        behavior.prompt_timeout = 5
+        self.results = ['[main] ', '[dev] ']
+        self.release.set()
+        self.assertEqual(self.get(), '[main] ')
+        self.release.clear()
+        prompt_updates.next_prompt()
+        os.utime(join(self.git_dir, 'HEAD'), ns=(0, 0))
+        threading.Timer(0.05, self.release.set).start()
+        self.assertEqual(self.get(), '[dev] ')
+
+    def testPlaceholder(self):
+        """Without a stamp, the results of the previous prompts are not shown"""
+        self.segment = PromptSegment(self.compute, budget=0.01, placeholder=lambda: '?')
+        self.results = ['1', '2']
+        self.assertEqual(self.segment(), '?')
+        self.wait_refresh()
+        self.assertEqual(self.segment(), '1')
+        prompt_updates.next_prompt()
+        self.assertEqual(self.segment(), '?')
+        self.wait_refresh()
+        self.assertEqual(self.segment(), '2')
+
+    def testConcurrent(self):
+        """Joined segments are computed at the same time"""
+        def slow(text):
+            threading.Event().wait(0.2)
+            return text
+        segments = [PromptSegment(lambda text=text: slow(text), budget=1) for text in 'abc']
+        start = time.time()
+        self.assertEqual(join_segments(segments[0], '-', segments[1], lambda: '-', segments[2]), 'a-b-c')
+        self.assertLess(time.time() - start, 0.5)
+
+        # Also the segments started by the functions among the parts (such
+        # as git_prompt within universal_prompt)
+        segments = [PromptSegment(lambda text=text: slow(text), budget=1) for text in 'de']
+        start = time.time()
+        self.assertEqual(join_segments(segments[0], lambda: join_segments(segments[1], '!')), 'de!')
+        self.assertLess(time.time() - start, 0.35)
+
+    @skipIf(not shutil.which('git'), 'requires git')
+    def testGitStatus(self):
+        shutil.rmtree(self.git_dir)
+        git(self.dir, 'init', '-q')
+        git(self.dir, 'checkout', '-q', '-b', 'topic')
+        with open(join(self.dir, 'file'), 'w') as f:
+            f.write('1')
+        git(self.dir, 'add', 'file')
+        git(self.dir, 'commit', '-q', '-m', 'first')
+        self.assertGitStatus(('topic', '', '', False, False))
+        with open(join(self.dir, 'file'), 'w') as f:
+            f.write('2')
+        self.assertGitStatus(('topic', '', '', True, False))
+        git(self.dir, 'add', 'file')
+        self.assertGitStatus(('topic', '', '', False, True))
+
+        # The pack files are not kept open between prompts
+        git(self.dir, 'repack', '-q', '-a', '-d')
+        self.assertGitStatus(('topic', '', '', False, True))
+        packs = pycmd_public._git_repositories[self.git_dir]._packs
+        self.assertTrue(packs)
+        self.assertTrue(all(pack.idx is None and pack.data is None for (_, pack) in packs))
+
+        # Fall back to running git
+        git(self.dir, 'update-index', '--split-index')
+        self.assertEqual(pycmd_public._git_status(self.git_dir, self.dir), ('topic', '', '', False, True))
+
+    def assertGitStatus(self, status):
+        """Both the status read from .git and the one from running git are as expected"""
+        self.assertEqual(pycmd_public._read_git_status(self.git_dir, self.dir), status)
+        self.assertEqual(pycmd_public._run_git_status(self.dir), status)
+
+
+@skipIf(sys.platform == 'win32', 'uses a fake svn shell script')
+class TestSvnStatus(TestCase):
+    """Test the parsing of the svn status output"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.orig_path = os.environ['PATH']
+        os.environ['PATH'] = self.dir + os.pathsep + self.orig_path
+
+    def tearDown(self):
+        os.environ['PATH'] = self.orig_path
+        shutil.rmtree(self.dir)
+
+    def fake_svn(self, output):
+        with open(join(self.dir, 'svn'), 'w') as f:
+            f.write('#!/bin/sh\nprintf "%s"\n' % output)
+        os.chmod(join(self.dir, 'svn'), 0o755)
+
+    def testDirty(self):
+        self.fake_svn('')
+        self.assertFalse(pycmd_public._svn_dirty(self.dir))
+        self.fake_svn('M       file.txt\\n')
+        self.assertTrue(pycmd_public._svn_dirty(self.dir))
+        self.fake_svn(' M      dir\\n')
+        self.assertTrue(pycmd_public._svn_dirty(self.dir))
+        # The file name used to be taken for status characters
+        self.fake_svn('\\nPerforming status on external item at \'MAD\':\\n')
+        self.assertFalse(pycmd_public._svn_dirty(self.dir))
+
+
 def suite():
     suite = TestSuite()
     suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestAbbrevPath))
+    suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestFindUpdir))
+    suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestPromptSegment))
+    suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestSvnStatus))
     return suite